@@ -0,0 +1,91 @@
+"""
+Benchmark for the storage codecs (see storage.CODECS).
+
+Builds synthetic teachers.json and enrollments.json databases, then times a
+whole-file save and load through each codec and reports the on-disk size.
+
+    python bench_codec.py                  # 10k and 100k records
+    python bench_codec.py --sizes 1000 --repeat 5
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import storage
+
+
+def synthetic_teachers(n, rng):
+    subjects = [("Math", "数学"), ("English", "英语"), ("Science", "科学"), ("Art", "美术")]
+    teachers = {}
+    for i in range(n):
+        subject_en, subject_zh = rng.choice(subjects)
+        teachers[f"teacher-{i:06d}"] = {
+            "name": f"Teacher {i}",
+            "subject_en": subject_en,
+            "subject_zh": subject_zh,
+            "grade": str(rng.randint(1, 12)),
+            "description_en": f"{subject_en} class for grade {rng.randint(1, 12)} students.",
+            "description_zh": f"{subject_zh}课程，欢迎报名。",
+            "is_active": rng.random() < 0.9,
+            "allow_enroll": rng.random() < 0.8,
+            "enrollment_cap": rng.choice([None, 10, 20, 30]),
+            "timezone": "Asia/Shanghai",
+        }
+    return teachers
+
+
+def synthetic_enrollments(n, rng):
+    """n rosters of 1-30 students drawn from a pool of 10*n student IDs."""
+    pool = 10 * n
+    return {f"teacher-{i:06d}": storage.Roster(f"student-{rng.randrange(pool):07d}" for _ in range(rng.randint(1, 30)))
+            for i in range(n)}
+
+
+def best_of(repeat, func):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench(name, data, repeat, directory):
+    path = os.path.join(directory, name)
+    rows = []
+    for codec in storage.CODECS.values():
+        payload = codec.encode(data)
+        save = best_of(repeat, lambda: storage.atomic_write(path, codec.encode(data)))
+
+        def load():
+            with open(path, "rb") as f:
+                codec.decode(f.read())
+
+        rows.append((codec.name, len(payload), save, best_of(repeat, load)))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the storage codecs")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000], help="Records per database")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement (best is reported)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    accelerator = "orjson" if storage.orjson else "msgspec" if storage.msgspec else "none (stdlib)"
+    print(f"fast codec accelerator: {accelerator}")
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            for name, data in (("teachers.json", synthetic_teachers(size, rng)),
+                               ("enrollments.json", synthetic_enrollments(size, rng))):
+                print(f"\n{name}, {size} records")
+                print(f"{'codec':<8} {'size (KB)':>10} {'save (ms)':>10} {'load (ms)':>10}")
+                for codec_name, nbytes, save, load in bench(name, data, args.repeat, directory):
+                    print(f"{codec_name:<8} {nbytes / 1024:>10.0f} {save * 1000:>10.1f} {load * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+"""
+Content-addressed, versioned storage for teacher courseware.
+
+Every distinct file is stored once, as blobs/<first two hex digits>/<sha256>
+under the upload root. Each version of a teacher's file is a hard link to that
+blob at <root>/<teacher folder>/<original filename>/v<version>, so the file
+system's link count is the reference count: uploading a deck that is already
+stored (by anyone) writes nothing but a link, and a blob whose only remaining
+link is its own name is unreferenced and removed by collect_garbage(). The
+upload root must therefore support hard links: put() raises OSError where it
+cannot link rather than storing a copy that garbage collection cannot see.
+
+A teacher can have any number of files. Uploading a file under a name they
+already use publishes a new version: the link is made under a temp name and
+renamed into place, then the index is rewritten (also temp file + rename), so
+readers see either the old latest version or the new one, never a partial
+file. Old versions are pruned by a background job according to the retention
+policy (keep_versions newest versions per file, optionally dropping older ones
+past max_age_days); the latest version of a file is never pruned.
+
+What each teacher has is kept in <root>/index.json:
+
+    {teacher_id: {"latest": filename most recently published,
+                  "files": {filename: [{"version", "size", "mime", "sha256", "mtime"}, ... oldest first]}}}
+
+It is updated on every put(), remove() and prune() and held in memory; writes
+in this process replace the in-memory copy directly, and writes by other
+processes (the CLI) are noticed by a stat of index.json at most every
+check_interval seconds. So the "latest" pointer and the file list a teacher
+card shows are dict lookups, and the file system is only touched to serve the
+bytes. Blob counts for stats() are kept up to date as blobs are added and
+removed rather than by walking the store. A missing (or pre-versioning)
+index is rebuilt once from the teacher folders, moving older layouts into
+this one.
+
+Uploads are streamed: put() copies from a file object in CHUNK_SIZE pieces,
+hashing as it writes to a temp file that is renamed into place, so a large
+deck is never held twice in memory.
+
+    python courseware.py gc       # Remove unreferenced blobs
+    python courseware.py prune    # Apply the retention policy now
+"""
+import argparse
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import storage
+
+log = logging.getLogger(__name__)
+
+BLOB_DIR = "blobs"
+INDEX_FILE = "index.json"
+CHUNK_SIZE = 1024 * 1024
+
+
+def folder_name(teacher_id):
+    """Teacher ID -> the name of their folder under the upload root ("" if nothing usable is left)."""
+    return "".join(c for c in str(teacher_id or "") if c.isalnum() or c in ("_", "-")).rstrip()
+
+
+def safe_filename(filename):
+    """Drops any directory part of an uploaded file's name."""
+    name = os.path.basename(str(filename or "").replace("\\", "/"))
+    if name in ("", ".", "..") or name == BLOB_DIR:
+        raise ValueError(f"Invalid courseware file name: {filename!r}")
+    return name
+
+
+class CoursewareStore:
+    def __init__(self, root, keep_versions=5, max_age_days=None, check_interval=5.0):
+        self.root = root
+        self.blob_root = os.path.join(root, BLOB_DIR)
+        self.index_path = os.path.join(root, INDEX_FILE)
+        self.keep_versions = max(1, keep_versions)  # Per file, the latest included
+        self.max_age_days = max_age_days  # None: versions are only pruned by count
+        self.deduplicated = 0  # Uploads whose content was already stored
+        self.pruned = 0  # Versions removed by the retention policy
+        self.check_interval = check_interval  # Seconds between looks for index.json changes by other processes
+        self.version = 0  # Bumped whenever the index changes; lets callers cache derived views
+        self._index = None  # {teacher_id: entry}; replaced, never mutated, so readers need no lock
+        self._index_signature = None
+        self._next_check = 0.0  # time.monotonic() after which index() stats index.json again
+        self._blob_totals = None  # [blobs, bytes], counted once and then kept up to date
+        self._lock = threading.Lock()  # Link / unlink / collect / index writes as one step per process
+        self._pruner = None
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_root, digest[:2], digest)
+
+    def teacher_dir(self, teacher_id):
+        name = folder_name(teacher_id)
+        if not name or name == BLOB_DIR:
+            raise ValueError("User ID resulted in an invalid folder name after sanitization.")
+        return os.path.join(self.root, name)
+
+    def version_path(self, teacher_id, filename, version):
+        return os.path.join(self.teacher_dir(teacher_id), safe_filename(filename), f"v{version}")
+
+    # Index
+    def index(self):
+        """
+        {teacher_id: {"latest", "files"}} (see the module docstring). No file
+        system access unless check_interval has passed since the last check.
+        """
+        if self._index is not None and time.monotonic() < self._next_check:
+            return self._index
+        with self._lock:
+            signature = storage.JsonFileCache.signature(self.index_path)
+            if signature is None:
+                self._save_index(self._rebuild_index())
+            elif self._index is None or signature != self._index_signature:
+                with open(self.index_path, "rb") as f:
+                    index = json.loads(f.read())
+                if any("files" not in entry for entry in index.values()):
+                    self._save_index(self._rebuild_index(index))  # One file per teacher, before versioning
+                else:
+                    self._index, self._index_signature = index, signature
+                    self._blob_totals = None  # Another process wrote it; recount blobs when asked
+                    self.version += 1
+            self._next_check = time.monotonic() + self.check_interval
+        return self._index
+
+    def info(self, teacher_id, filename=None):
+        """
+        Latest version of the teacher's file (default: the file they published
+        last) as {"filename", "version", "size", "mime", "sha256", "mtime"},
+        or None if there is none.
+        """
+        entry = self.index().get(teacher_id)
+        if not entry:
+            return None
+        filename = filename or entry["latest"]
+        versions = entry["files"].get(filename)
+        return {**versions[-1], "filename": filename} if versions else None
+
+    def files(self, teacher_id):
+        """Latest version of each of the teacher's files, most recently published first, with a "versions" count."""
+        entry = self.index().get(teacher_id)
+        if not entry:
+            return []
+        files = [{**versions[-1], "filename": name, "versions": len(versions)}
+                 for name, versions in entry["files"].items()]
+        return sorted(files, key=lambda f: f["mtime"], reverse=True)
+
+    def path(self, teacher_id, filename=None, version=None):
+        """Path of a version of the teacher's file (default: latest version of the latest file), or None."""
+        latest = self.info(teacher_id, filename)
+        if latest is None:
+            return None
+        return self.version_path(teacher_id, latest["filename"], version or latest["version"])
+
+    def _save_index(self, index):
+        os.makedirs(self.root, exist_ok=True)
+        storage.atomic_write(self.index_path, json.dumps(index, ensure_ascii=False, indent=2).encode("utf-8"))
+        self._index, self._index_signature = index, storage.JsonFileCache.signature(self.index_path)
+        self.version += 1
+
+    def _rebuild_index(self, previous=None):
+        """
+        Index entries for whatever the teacher folders hold (folder names stand in
+        for teacher IDs). Files from older layouts - a single file directly in the
+        teacher folder - become version 1 of that file (keeping the version and
+        MIME type `previous` recorded for them), and anything that is not a blob
+        link yet is moved into the blob store.
+        """
+        index = {}
+        if not os.path.isdir(self.root):
+            return index
+        for folder in os.scandir(self.root):
+            if not folder.is_dir() or folder.name == BLOB_DIR:
+                continue
+            old = (previous or {}).get(folder.name) or {}
+            files = {}
+            for item in os.scandir(folder.path):
+                if item.name.startswith("."):
+                    continue  # Temp names
+                if item.is_file():
+                    same = old.get("filename") == item.name
+                    version, mime = (old.get("version", 1), old.get("mime")) if same else (1, None)
+                    staged = os.path.join(folder.path, f".{item.name}.migrating")
+                    os.replace(item.path, staged)
+                    os.makedirs(item.path)
+                    os.replace(staged, os.path.join(item.path, f"v{version}"))
+                    files[item.name] = [self._adopt(os.path.join(item.path, f"v{version}"), version, mime)]
+                elif item.is_dir():
+                    found = sorted((int(e.name[1:]), e.path) for e in os.scandir(item.path)
+                                   if e.is_file() and e.name[:1] == "v" and e.name[1:].isdigit())
+                    if found:
+                        files[item.name] = [self._adopt(path, version, None) for version, path in found]
+            if files:
+                latest = max(files, key=lambda name: files[name][-1]["mtime"])
+                index[folder.name] = {"latest": latest, "files": files}
+        return index
+
+    def _adopt(self, path, version, mime):
+        """Makes the file at path a link to its blob. Returns its version entry."""
+        with open(path, "rb") as f:
+            temp_path, digest = self._receive(f)
+        self._publish(temp_path, digest)
+        blob = self.blob_path(digest)
+        if not os.path.samefile(path, blob):
+            self._link(blob, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        return self._version(os.path.basename(os.path.dirname(path)), version, digest, mime,
+                             os.stat(path).st_mtime)
+
+    def _version(self, filename, version, digest, mime, mtime=None):
+        return {"version": version, "size": os.stat(self.blob_path(digest)).st_size,
+                "mime": mime or mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                "sha256": digest, "mtime": mtime or time.time()}
+
+    # Blobs
+    def _receive(self, source):
+        """Streams source (a binary file object) into a temp file while hashing it. Returns (temp path, sha256)."""
+        os.makedirs(self.blob_root, exist_ok=True)
+        sha = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.blob_root, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                    sha.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return temp_path, sha.hexdigest()
+
+    def put(self, teacher_id, filename, source, mime=None):
+        """
+        Publishes source (a binary file object, read from its current position)
+        as the next version of the teacher's file `filename` and makes it their
+        latest. Earlier versions are kept until prune(). Returns (path, sha256).
+        """
+        filename = safe_filename(filename)
+        self.teacher_dir(teacher_id)  # Reject unusable IDs before reading the upload
+        temp_path, digest = self._receive(source)  # Outside the lock: other uploads are not held up
+        self.index()  # Loaded (or rebuilt) before taking the lock
+        with self._lock:
+            self._publish(temp_path, digest)
+            entry = self._index.get(teacher_id) or {"latest": filename, "files": {}}
+            versions = entry["files"].get(filename, [])
+            if versions and versions[-1]["sha256"] == digest:
+                # Same content again: no new version, but it is now what the teacher published last
+                files = {**entry["files"], filename: versions[:-1] + [{**versions[-1], "mtime": time.time()}]}
+                self._save_index({**self._index, teacher_id: {"latest": filename, "files": files}})
+                return self.version_path(teacher_id, filename, versions[-1]["version"]), digest
+            version = versions[-1]["version"] + 1 if versions else 1
+            target = self.version_path(teacher_id, filename, version)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            self._link(self.blob_path(digest), target + ".tmp")
+            os.replace(target + ".tmp", target)
+            files = {**entry["files"], filename: versions + [self._version(filename, version, digest, mime)]}
+            self._save_index({**self._index, teacher_id: {"latest": filename, "files": files}})
+        return target, digest
+
+    def remove(self, teacher_id, filename=None):
+        """Drops one of the teacher's files (all versions), or all of them, and any blob nobody else references."""
+        directory = self.teacher_dir(teacher_id)
+        target = directory if filename is None else os.path.join(directory, safe_filename(filename))
+        self.index()
+        with self._lock:
+            if os.path.isdir(target):
+                self._collect(self._unlink_tree(target))
+            entry = self._index.get(teacher_id)
+            if entry is None:
+                return
+            files = {} if filename is None else {k: v for k, v in entry["files"].items() if k != filename}
+            index = {k: v for k, v in self._index.items() if k != teacher_id}
+            if files:
+                latest = entry["latest"] if entry["latest"] in files else max(files, key=lambda k: files[k][-1]["mtime"])
+                index[teacher_id] = {"latest": latest, "files": files}
+            elif os.path.isdir(directory):
+                self._unlink_tree(directory)
+            self._save_index(index)
+
+    def _publish(self, temp_path, digest):
+        """Moves a received temp file to its blob path, or drops it if that content is stored already."""
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            os.unlink(temp_path)
+            self.deduplicated += 1
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(temp_path, blob)
+            self._count_blob(1, os.path.getsize(blob))
+
+    @staticmethod
+    def _link(blob, target):
+        try:
+            os.link(blob, target)
+        except OSError as e:  # A copy would have st_nlink == 1 and be collected while still in use
+            raise OSError(e.errno, f"Courseware needs hard links on the upload file system: {e.strerror}",
+                          target) from e
+
+    @staticmethod
+    def _unlink_tree(directory):
+        """Removes directory and everything in it; returns the (device, inode) pairs of the files that were there."""
+        removed = set()
+        for parent, _, names in os.walk(directory):
+            for name in names:
+                stat = os.lstat(os.path.join(parent, name))
+                removed.add((stat.st_dev, stat.st_ino))
+        shutil.rmtree(directory)
+        return removed
+
+    def _collect(self, inodes):
+        """Removes the blobs among inodes that are no longer linked from any teacher."""
+        if not inodes:
+            return
+        for path in self._blobs():
+            stat = os.stat(path)
+            if (stat.st_dev, stat.st_ino) in inodes and stat.st_nlink <= 1:
+                os.unlink(path)
+                self._count_blob(-1, -stat.st_size)
+
+    def _blobs(self):
+        if not os.path.isdir(self.blob_root):
+            return
+        for prefix in os.scandir(self.blob_root):
+            if prefix.is_dir():
+                for entry in os.scandir(prefix.path):
+                    if entry.is_file() and not entry.name.startswith("."):
+                        yield entry.path
+
+    def _count_blob(self, blobs, size):
+        if self._blob_totals is not None:
+            self._blob_totals[0] += blobs
+            self._blob_totals[1] += size
+
+    def collect_garbage(self):
+        """Removes every blob with no teacher link left. Returns (blobs removed, bytes freed)."""
+        removed = freed = 0
+        with self._lock:
+            for path in list(self._blobs()):
+                stat = os.stat(path)
+                if stat.st_nlink <= 1:
+                    os.unlink(path)
+                    removed += 1
+                    freed += stat.st_size
+                    self._count_blob(-1, -stat.st_size)
+        return removed, freed
+
+    # Retention
+    def _expired(self, versions, now):
+        """The versions the retention policy drops (never the latest)."""
+        keep = versions[-self.keep_versions:]
+        if self.max_age_days is not None:
+            cutoff = now - self.max_age_days * 86400
+            keep = [v for v in keep[:-1] if v["mtime"] >= cutoff] + keep[-1:]
+        kept = {v["version"] for v in keep}
+        return [v for v in versions if v["version"] not in kept]
+
+    def prune(self, now=None):
+        """Applies the retention policy to every file. Returns the number of versions removed."""
+        now = time.time() if now is None else now
+        self.index()
+        with self._lock:
+            index, removed, inodes = dict(self._index), 0, set()
+            for teacher_id, entry in self._index.items():
+                files = {}
+                for filename, versions in entry["files"].items():
+                    expired = self._expired(versions, now)
+                    for version in expired:
+                        path = self.version_path(teacher_id, filename, version["version"])
+                        try:
+                            stat = os.lstat(path)
+                            inodes.add((stat.st_dev, stat.st_ino))
+                            os.unlink(path)
+                        except FileNotFoundError:
+                            pass
+                    files[filename] = [v for v in versions if v not in expired]
+                    removed += len(expired)
+                if files != entry["files"]:
+                    index[teacher_id] = {**entry, "files": files}
+            if removed:
+                self._collect(inodes)
+                self._save_index(index)
+                self.pruned += removed
+        return removed
+
+    def start_pruning(self, interval):
+        """Runs prune() every `interval` seconds on a daemon thread."""
+        if self._pruner is None or not self._pruner.is_alive():
+            self._pruner = threading.Thread(target=self._prune_loop, args=(interval,),
+                                            name="courseware-pruner", daemon=True)
+            self._pruner.start()
+
+    def _prune_loop(self, interval):
+        while True:
+            try:
+                removed = self.prune()
+                if removed:
+                    log.info("Pruned %d old courseware versions", removed)
+            except Exception:  # Keep the thread alive; the next pass retries
+                log.exception("Courseware pruning failed")
+            time.sleep(interval)
+
+    def stats(self):
+        index = self.index()
+        with self._lock:
+            if self._blob_totals is None:
+                blobs = list(self._blobs())
+                self._blob_totals = [len(blobs), sum(os.path.getsize(p) for p in blobs)]
+            blobs, size = self._blob_totals
+        return {"blobs": blobs, "bytes": size, "teachers": len(index),
+                "files": sum(len(e["files"]) for e in index.values()),
+                "versions": sum(len(v) for e in index.values() for v in e["files"].values()),
+                "deduplicated": self.deduplicated, "pruned": self.pruned}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store(root=None, prune=True):
+    """
+    Returns the process-wide CoursewareStore, pruning old versions in the
+    background unless prune=False. Configuration:
+
+        ENROLL_UPLOAD_DIR                  root (default user_specific_uploads)
+        ENROLL_COURSEWARE_KEEP             versions kept per file (default 5)
+        ENROLL_COURSEWARE_MAX_AGE_DAYS     also drop older versions past this age (default: no limit)
+        ENROLL_COURSEWARE_PRUNE_INTERVAL   seconds between pruning passes (default 3600)
+        ENROLL_COURSEWARE_INDEX_CHECK      seconds between looks for index.json edits by other processes (default 5)
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            max_age = os.environ.get("ENROLL_COURSEWARE_MAX_AGE_DAYS")
+            _store = CoursewareStore(root or os.environ.get("ENROLL_UPLOAD_DIR", "user_specific_uploads"),
+                                     keep_versions=int(os.environ.get("ENROLL_COURSEWARE_KEEP", "5")),
+                                     max_age_days=float(max_age) if max_age else None,
+                                     check_interval=float(os.environ.get("ENROLL_COURSEWARE_INDEX_CHECK", "5")))
+        if prune:
+            _store.start_pruning(float(os.environ.get("ENROLL_COURSEWARE_PRUNE_INTERVAL", "3600")))
+        return _store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Courseware blob store maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("gc", help="Remove blobs no teacher references")
+    commands.add_parser("prune", help="Apply the retention policy (ENROLL_COURSEWARE_KEEP / _MAX_AGE_DAYS) now")
+    args = parser.parse_args(argv)
+
+    store = get_store(prune=False)
+    if args.command == "gc":
+        removed, freed = store.collect_garbage()
+        print(f"Removed {removed} unreferenced blobs ({freed / 1024 / 1024:.1f} MB)")
+    elif args.command == "prune":
+        print(f"Removed {store.prune()} old versions; {store.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""
+Runs the enrollment / rating schedule saved in switch.json.
+
+The admin page stores a template cycle: four UTC instants ("Open Enrollment
+Date", "Close Enrollment Date", "Open Ratings Date", "Close Ratings Date",
+formatted as TIME_FORMAT) plus "Open Enrollment Delay", the gap between the end
+of ratings and the next enrollment. Recurrence repeats that cycle every
+(close ratings + delay - open enrollment); single cycles can be moved or skipped
+with overrides stored under OVERRIDES_KEY, keyed by the cycle's scheduled
+opening. Without a delay the template runs once.
+
+One ScheduleExecutor thread per server applies each transition when its instant
+arrives:
+
+    open_enrollment   all_closed = False
+    close_enrollment  all_closed = True
+    open_ratings      rating = True
+    close_ratings     rating = False
+
+The last boundary applied is saved in switch.json under FIRED_KEY together with
+the schedule it belongs to, so each transition fires exactly once, including
+across restarts. When the admin saves a different schedule the flags are first
+synced to whatever phase that schedule says "now" is. Everything the executor
+does is appended to schedule_log.jsonl. Page renders only read switch.json.
+
+get_timeline() compiles the next LOOKAHEAD cycles into a Timeline once per change
+of switch.json, so "which phase is it now" and "what happens next" are a bisect
+instead of re-parsing dates on every rerun. Rolling over into later cycles is
+just compiling the next window when the current one runs out: nothing is
+written, so it cannot double-fire whoever triggers it.
+"""
+import bisect
+import collections
+import datetime
+import json
+import logging
+import math
+import os
+import threading
+
+import storage
+
+log = logging.getLogger(__name__)
+
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+FIRED_KEY = "Schedule Fired"  # {"schedule": schedule_signature(), "at": last boundary applied}
+OVERRIDES_KEY = "Schedule Overrides"  # {cycle key: {"skip": True} or {date key: TIME_FORMAT instant, ...}}
+MANUAL_RATINGS_KEY = "Manual Ratings Opened"  # When the admin last enabled ratings by hand (TIME_FORMAT)
+LOOKAHEAD = int(os.environ.get("ENROLL_SCHEDULE_LOOKAHEAD", "8"))  # Cycles materialized ahead of now
+DATE_KEYS = ("Open Enrollment Date", "Close Enrollment Date", "Open Ratings Date", "Close Ratings Date")
+DELAY_KEY = "Open Enrollment Delay"
+
+OPEN_ENROLLMENT = "open_enrollment"
+CLOSE_ENROLLMENT = "close_enrollment"
+OPEN_RATINGS = "open_ratings"
+CLOSE_RATINGS = "close_ratings"
+SYNC = "sync"
+ACTIONS = (OPEN_ENROLLMENT, CLOSE_ENROLLMENT, OPEN_RATINGS, CLOSE_RATINGS)  # In DATE_KEYS order
+
+# Phases of one cycle, in order
+BEFORE = "before"  # Schedule saved, enrollment not open yet
+ENROLLMENT = "enrollment"
+CLOSED = "closed"  # Enrollment over, ratings not open yet
+RATING = "rating"
+GAP = "gap"  # Ratings over, waiting for the next cycle
+
+
+def parse_instant(text):
+    """"2025-03-01 08:00" (UTC) -> aware datetime, or None if missing/invalid."""
+    try:
+        return datetime.datetime.strptime(text, TIME_FORMAT).replace(tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+def format_instant(instant):
+    return instant.astimezone(datetime.timezone.utc).strftime(TIME_FORMAT)
+
+
+def parse_delay(text):
+    """str(timedelta) such as "3 days, 12:03:00" or "12:03:00" -> timedelta, or None."""
+    if not text:
+        return None
+    try:
+        days, _, clock = text.rpartition(" day")
+        if days:
+            clock = clock.split(", ", 1)[1]
+        hours, minutes, seconds = map(int, clock.split(":"))
+        return datetime.timedelta(days=int(days or 0), hours=hours, minutes=minutes, seconds=seconds)
+    except (IndexError, ValueError):
+        return None
+
+
+def schedule_signature(switch):
+    """Identifies the saved schedule (template and overrides); changes whenever the admin edits it."""
+    overrides = json.dumps(switch.get(OVERRIDES_KEY) or {}, sort_keys=True)
+    return "|".join([str(switch.get(key) or "") for key in DATE_KEYS + (DELAY_KEY,)] + [overrides])
+
+
+# --- Recurrence ---
+Cycle = collections.namedtuple("Cycle", "index key instants skipped overridden")
+Cycle.__doc__ = """One enrollment->rating cycle. key is its scheduled opening (TIME_FORMAT);
+instants are the four boundaries in DATE_KEYS order after any override."""
+
+
+class Recurrence:
+    """The template cycle from switch.json, repeated every `period`, with per-cycle overrides."""
+
+    def __init__(self, switch):
+        self.template = [parse_instant(switch.get(key)) for key in DATE_KEYS]
+        self.valid = None not in self.template
+        delay = parse_delay(switch.get(DELAY_KEY))
+        self.period = self.template[3] + delay - self.template[0] if self.valid and delay is not None else None
+        if self.period is not None and self.period <= datetime.timedelta(0):
+            self.period = None
+        self.overrides = switch.get(OVERRIDES_KEY) or {}
+
+    def __bool__(self):
+        return self.valid
+
+    def index_at(self, now):
+        """Index of the cycle whose scheduled span [open, next open) contains now (0 before the first)."""
+        if self.period is None or now <= self.template[0]:
+            return 0
+        return math.floor((now - self.template[0]) / self.period)
+
+    def scheduled_start(self, index):
+        return self.template[0] + index * self.period if self.period is not None else self.template[0]
+
+    def cycle(self, index):
+        shift = index * self.period if self.period is not None else datetime.timedelta(0)
+        instants = [instant + shift for instant in self.template]
+        key = format_instant(instants[0])
+        override = self.overrides.get(key) or {}
+        if override.get("skip"):
+            return Cycle(index, key, instants, True, True)
+        for i, date_key in enumerate(DATE_KEYS):
+            if parse_instant(override.get(date_key)) is not None:
+                instants[i] = parse_instant(override[date_key])
+        return Cycle(index, key, instants, False, bool(override))
+
+    def cycles(self, start, count):
+        """count consecutive cycles from index start (just cycle 0 for a one-off schedule)."""
+        if not self.valid:
+            return []
+        if self.period is None:
+            return [self.cycle(0)] if start <= 0 else []
+        return [self.cycle(i) for i in range(max(start, 0), max(start, 0) + count)]
+
+    def upcoming(self, now, count=LOOKAHEAD):
+        """The cycle in progress at `now` and the ones after it: what the admin previews."""
+        return self.cycles(self.index_at(now), count)
+
+
+def validate_cycle(instants, previous_end=None, next_start=None):
+    """Raises ValueError unless enrollment, then ratings, fit in order between the neighbouring cycles."""
+    open_enr, close_enr, open_rat, close_rat = instants
+    if not open_enr < close_enr <= open_rat < close_rat:
+        raise ValueError("Enrollment must open before it closes, and ratings must open after enrollment closes")
+    if previous_end is not None and open_enr < previous_end:
+        raise ValueError(f"Enrollment must open after the previous cycle's ratings close at {format_instant(previous_end)}")
+    if next_start is not None and close_rat > next_start:
+        raise ValueError(f"Ratings must close before the next cycle opens at {format_instant(next_start)}")
+
+
+def with_override(switch, key, instants=None, skip=False):
+    """
+    Returns a copy of switch with cycle `key` moved to `instants` (four aware
+    datetimes, DATE_KEYS order), skipped, or - with neither - back to the template.
+    """
+    recurrence = Recurrence(switch)
+    start = parse_instant(key)
+    cycle = next(iter(recurrence.cycles(recurrence.index_at(start), 1)), None) if start and recurrence else None
+    if cycle is None or cycle.key != key:
+        raise ValueError(f"{key} is not the start of a scheduled cycle")
+    overrides = dict(recurrence.overrides)
+    if skip:
+        overrides[key] = {"skip": True}
+    elif instants is not None:
+        neighbours = (None, None)
+        if recurrence.period is not None:
+            previous = recurrence.cycle(cycle.index - 1) if cycle.index > 0 else None
+            neighbours = (previous.instants[3] if previous and not previous.skipped else None,
+                          recurrence.cycle(cycle.index + 1).instants[0])
+        validate_cycle(instants, *neighbours)
+        overrides[key] = {date_key: format_instant(i) for date_key, i in zip(DATE_KEYS, instants)}
+    else:
+        overrides.pop(key, None)
+    return {**switch, OVERRIDES_KEY: overrides}
+
+
+class Timeline:
+    """
+    The schedule compiled into sorted UTC boundaries for a window of cycles.
+
+    `instants[i]` is when `actions[i]` fires and `phases[i + 1]` is the phase from
+    then on (`phases[0]` is the phase before the first boundary). The window
+    starts one cycle before `now` and holds `lookahead` cycles after it, so
+    phase_at(), next_transition() and due() are a bisect over at most
+    4 * (lookahead + 2) instants with no parsing. expired() says when the window
+    has run out and the next one must be compiled.
+    """
+
+    __slots__ = ("signature", "recurrence", "cycles", "instants", "actions", "phases", "flags", "valid_until")
+
+    def __init__(self, switch, now=None, lookahead=LOOKAHEAD):
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        self.signature = schedule_signature(switch)
+        self.recurrence = Recurrence(switch)
+        first = self.recurrence.index_at(now) - 1
+        self.cycles = self.recurrence.cycles(first, lookahead + 2)
+        self.valid_until = self.recurrence.scheduled_start(first + lookahead + 1) \
+            if self.recurrence.period is not None else None
+        bounds = sorted((instant, action) for cycle in self.cycles if not cycle.skipped
+                        for instant, action in zip(cycle.instants, ACTIONS))
+        self.instants = [instant for instant, _ in bounds]
+        self.actions = [action for _, action in bounds]
+
+        # Walk the boundaries once to precompute the phase and flags after each of them
+        enrollment, rating, phase = False, False, BEFORE
+        self.phases, self.flags = [phase], [{"all_closed": True, "rating": False}]
+        for action in self.actions:
+            enrollment = {OPEN_ENROLLMENT: True, CLOSE_ENROLLMENT: False}.get(action, enrollment)
+            rating = {OPEN_RATINGS: True, CLOSE_RATINGS: False}.get(action, rating)
+            phase = ENROLLMENT if enrollment else RATING if rating else \
+                {CLOSE_ENROLLMENT: CLOSED, CLOSE_RATINGS: GAP}.get(action, phase)
+            self.phases.append(phase)
+            self.flags.append({"all_closed": not enrollment, "rating": rating})
+
+    def __bool__(self):
+        return bool(self.instants)
+
+    def expired(self, now):
+        return self.valid_until is not None and now >= self.valid_until
+
+    def boundaries(self):
+        return list(zip(self.instants, self.actions))
+
+    def _index(self, now):
+        return bisect.bisect_right(self.instants, now)  # Boundaries at or before now have fired
+
+    def phase_at(self, now):
+        """BEFORE, ENROLLMENT, CLOSED, RATING or GAP; None if no schedule is saved."""
+        return self.phases[self._index(now)] if self.instants else None
+
+    def flags_at(self, now):
+        """The all_closed / rating flags the schedule calls for at `now`."""
+        return dict(self.flags[self._index(now)])
+
+    def next_transition(self, now):
+        """(instant, action) of the next boundary after `now`, or None."""
+        i = self._index(now)
+        return (self.instants[i], self.actions[i]) if i < len(self.instants) else None
+
+    def rating_window(self, now):
+        """(open, close) of the scheduled ratings window that `now` falls in, or None."""
+        for cycle in self.cycles:
+            if not cycle.skipped and cycle.instants[2] <= now < cycle.instants[3]:
+                return tuple(cycle.instants[2:])
+        return None
+
+    def due(self, now, after=None):
+        """[(instant, action)] with after < instant <= now."""
+        start = 0 if after is None else bisect.bisect_right(self.instants, after)
+        end = self._index(now)
+        return list(zip(self.instants[start:end], self.actions[start:end]))
+
+
+_timeline = None
+_timeline_version = None
+_timeline_lock = threading.Lock()
+
+
+def get_timeline(backend, now=None):
+    """
+    The compiled Timeline for the saved schedule; recompiled only when switch.json
+    changes or `now` has moved past the materialized cycles.
+    """
+    global _timeline, _timeline_version
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    path = backend.paths[storage.SWITCH]
+    with _timeline_lock:
+        version = backend.version(path)
+        if _timeline is None or version is None or (path, version) != _timeline_version or _timeline.expired(now):
+            _timeline = Timeline(backend.load(path), now)
+            _timeline_version = (path, version)  # Versions of different files are not comparable
+        return _timeline
+
+
+def rating_period(backend, now=None):
+    """
+    The key ratings are stored under for the current rating window:
+    "<open>-<close>" in TIME_FORMAT (UTC), the same for every student whatever
+    their time zone. Outside the scheduled windows, ratings the admin opened by
+    hand (the "rating" switch) go under "manual <MANUAL_RATINGS_KEY>". None if
+    ratings are not open.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    window = get_timeline(backend, now).rating_window(now)
+    if window is not None:
+        return f"{format_instant(window[0])}-{format_instant(window[1])}"
+    switch = backend.load(backend.paths[storage.SWITCH])
+    if not switch.get("rating"):
+        return None
+    return f"manual {switch.get(MANUAL_RATINGS_KEY) or ''}".rstrip()
+
+
+class ScheduleExecutor:
+    """
+    Background thread that applies due schedule transitions.
+
+    It sleeps until the next boundary (or poll_interval, to notice edits made by
+    another process); call wake() right after saving a new schedule.
+    """
+
+    def __init__(self, backend, poll_interval=30.0, log_path=None):
+        self.backend = backend
+        self.switch_path = backend.paths[storage.SWITCH]
+        self.poll_interval = poll_interval
+        self.log_path = log_path or os.path.join(os.path.dirname(os.path.abspath(self.switch_path)),
+                                                 "schedule_log.jsonl")
+        self.history = collections.deque(maxlen=50)  # Most recent actions, newest last
+        self._lock = threading.Lock()  # One run_pending() at a time
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Lifecycle
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="schedule-executor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        """Re-reads the schedule now instead of at the next boundary."""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_pending()
+                timeout = self._seconds_to_next_boundary()
+            except Exception as e:  # Keep the thread alive; the next pass retries
+                self._record("error", None, {"error": repr(e)})
+                timeout = self.poll_interval
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def _seconds_to_next_boundary(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        upcoming = get_timeline(self.backend, now).next_transition(now)
+        if upcoming is None:
+            return self.poll_interval
+        return min(self.poll_interval, max((upcoming[0] - now).total_seconds(), 0.0))
+
+    # Transitions
+    def run_pending(self, now=None):
+        """Applies every transition due at `now` that has not been applied yet. Returns the actions taken."""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            switch = dict(self.backend.load(self.switch_path))
+            timeline = get_timeline(self.backend, now)
+            if not timeline:
+                return []
+            fired = switch.get(FIRED_KEY) or {}
+            if fired.get("schedule") != timeline.signature:
+                # A schedule we have not run yet: jump straight to its current phase
+                pending = [(max((i for i, _ in timeline.due(now)), default=None), SYNC)]
+            else:
+                pending = timeline.due(now, after=parse_instant(fired.get("at")))
+            if not pending:
+                return []
+            for instant, action in pending:
+                self._apply(switch, timeline, action, now)
+                self._record(action, instant, {})
+            last = pending[-1][0]
+            switch[FIRED_KEY] = {"schedule": timeline.signature, "at": None if last is None else format_instant(last)}
+            self.backend.save(self.switch_path, switch)  # Commit point: flags and marker together
+            return [action for _, action in pending]
+
+    def _apply(self, switch, timeline, action, now):
+        if action == SYNC:
+            flags = timeline.flags_at(now)
+        else:
+            flags = {OPEN_ENROLLMENT: {"all_closed": False}, CLOSE_ENROLLMENT: {"all_closed": True},
+                     OPEN_RATINGS: {"rating": True}, CLOSE_RATINGS: {"rating": False}}[action]
+        switch.update(flags)  # Layered over each teacher's own allow_enroll at read time (models.AvailabilityView)
+
+    def _record(self, action, instant, details):
+        entry = {"action": action, "at": None if instant is None else format_instant(instant),
+                 "fired_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"), **details}
+        self.history.append(entry)
+        log.log(logging.ERROR if action == "error" else logging.INFO, "schedule: %s", entry)
+        try:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        except IOError as e:  # The in-memory history still has it
+            log.warning("schedule: could not append to %s: %r", self.log_path, e)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(backend):
+    """Returns the process-wide ScheduleExecutor, starting its thread on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ScheduleExecutor(backend, float(os.environ.get("ENROLL_SCHEDULE_POLL", "30")))
+            _executor.start()
+        return _executor
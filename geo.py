@@ -0,0 +1,584 @@
+"""
+Geolocation services shared by every session in the server process.
+
+TimezoneService wraps a single TimezoneFinder. Creating one loads the timezone
+polygon data, which is far too slow to repeat on every geolocation callback, so
+get_timezone_service() builds it once and warms it on a background thread at
+server start. With ENROLL_TZ_IN_MEMORY=1 the polygons are read fully into
+memory (more RAM, faster lookups, and lookups need no lock); otherwise
+lookups read the data files and are serialized.
+
+ReverseGeocoder is a long-lived worker thread around reverse_geocoder. The
+dataset and its KD-tree are loaded once when the worker starts, and lookups
+are queued: requests arriving within ENROLL_RG_BATCH_MS (default 5) of each
+other are answered by a single vectorized rg.search() call, run in-process
+(mode=1) so no multiprocessing pool is spawned.
+
+LocationResolver puts both behind a cache of full results keyed on
+coordinates snapped to a grid (ENROLL_GEO_GRID_KM, default 1 km): students
+from the same school or town resolve once, then hit the cache. Entries are
+evicted least recently used beyond ENROLL_GEO_CACHE_SIZE and expire after
+ENROLL_GEO_CACHE_TTL seconds.
+
+CityTimezoneIndex answers (country, city, optional state) -> IANA timezone
+for manually entered locations. It is built once from geonamescache (the
+most populous matching city wins, and only zones zoneinfo knows are kept)
+into a sorted text file, ENROLL_TZ_INDEX (default city_timezones.idx),
+which is memory-mapped and binary-searched, so a lookup touches a few pages
+instead of scanning every city. Rebuild it with
+
+    python geo.py build-tz-index
+
+backfill_locations() checks every student in the students database against
+that index in one pass (one lookup per distinct country/state/city, not per
+student), fills in or corrects timezones that are missing or not among
+ALLOWED_TIMEZONES, writes them back with one bulk update_records() and returns
+a report. Run it from the admin page or with
+
+    python geo.py backfill [--dry-run] [--report report.json]
+
+Every lookup is timed; stats() reports counts and latency percentiles for the
+admin page.
+"""
+import argparse
+import collections
+import concurrent.futures
+import functools
+import json
+import logging
+import mmap
+import os
+import queue
+import threading
+import time
+import unicodedata
+import zoneinfo
+
+import pycountry
+import reverse_geocoder as rg
+from timezonefinder import TimezoneFinder
+
+import models
+import storage
+
+log = logging.getLogger(__name__)
+
+# Timezones students and teachers may pick (only those zoneinfo knows are offered)
+ALLOWED_TIMEZONES = ("Asia/Shanghai", "America/Los_Angeles", "America/Chicago", "America/New_York", "Europe/Berlin",
+                     "Japan", "America/Sao_Paulo", "America/Mexico_City", "Asia/Dhaka")
+
+
+class LatencyStats:
+    """Count, mean and percentiles of the most recent `window` durations (seconds)."""
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self._recent.append(seconds)
+
+    def percentile(self, fraction):
+        with self._lock:
+            recent = sorted(self._recent)
+        return recent[min(int(fraction * len(recent)), len(recent) - 1)] if recent else 0.0
+
+    def as_dict(self):
+        return {"lookups": self.count, "mean_ms": 1000 * self.total / self.count if self.count else 0.0,
+                "p50_ms": 1000 * self.percentile(0.5), "p95_ms": 1000 * self.percentile(0.95),
+                "max_ms": 1000 * self.max}
+
+
+# --- Timezones ---
+class TimezoneService:
+    """One TimezoneFinder for the whole process; timezone_at() is safe to call from any session."""
+
+    def __init__(self, in_memory=False):
+        self.in_memory = in_memory
+        self.latency = LatencyStats()
+        self.warm_seconds = None  # How long loading the polygon data took
+        self.misses = 0  # Lookups that found no timezone (e.g. open sea)
+        self._finder = None
+        self._lock = threading.Lock()
+
+    def _get_finder(self):
+        with self._lock:
+            if self._finder is None:
+                start = time.perf_counter()
+                self._finder = TimezoneFinder(in_memory=self.in_memory)
+                self._finder.timezone_at(lng=0.0, lat=51.5)  # Touch the data so the first real lookup is warm
+                self.warm_seconds = time.perf_counter() - start
+            return self._finder
+
+    def warm(self):
+        """Loads the polygon data now. Returns self."""
+        self._get_finder()
+        return self
+
+    def timezone_at(self, latitude, longitude):
+        """IANA timezone name at the coordinates, or None."""
+        finder = self._get_finder()
+        start = time.perf_counter()
+        if self.in_memory:
+            timezone = finder.timezone_at(lng=longitude, lat=latitude)
+        else:
+            with self._lock:  # File-backed lookups seek shared file handles
+                timezone = finder.timezone_at(lng=longitude, lat=latitude)
+        self.latency.add(time.perf_counter() - start)
+        if timezone is None:
+            self.misses += 1
+        return timezone
+
+    def stats(self):
+        return {**self.latency.as_dict(), "misses": self.misses, "in_memory": self.in_memory,
+                "warm_ms": None if self.warm_seconds is None else 1000 * self.warm_seconds}
+
+
+_timezones = None
+_timezones_lock = threading.Lock()
+
+
+def get_timezone_service():
+    """Returns the process-wide TimezoneService, warming it in the background on first use."""
+    global _timezones
+    with _timezones_lock:
+        if _timezones is None:
+            _timezones = TimezoneService(in_memory=os.environ.get("ENROLL_TZ_IN_MEMORY", "0") == "1")
+            threading.Thread(target=_timezones.warm, name="timezone-warmup", daemon=True).start()
+        return _timezones
+
+
+# --- Reverse geocoding ---
+Place = collections.namedtuple("Place", "city admin1 country_code country_name")
+
+
+@functools.lru_cache(maxsize=None)
+def country_name(country_code):
+    """"US" -> "United States"; "Unknown" if pycountry does not know the code."""
+    country = pycountry.countries.get(alpha_2=country_code) if country_code else None
+    return country.name if country else "Unknown"
+
+
+class ReverseGeocoder:
+    """Worker thread answering (latitude, longitude) -> Place, batching lookups that arrive together."""
+
+    def __init__(self, batch_window=0.005, max_batch=256):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.latency = LatencyStats()  # Queue wait included: what a caller actually waits
+        self.batches = 0
+        self.warm_seconds = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="reverse-geocoder", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def lookup(self, latitude, longitude, timeout=30.0):
+        """The Place nearest to the coordinates. Raises whatever rg.search raised, or TimeoutError."""
+        start = time.perf_counter()
+        future = concurrent.futures.Future()
+        self._queue.put(((latitude, longitude), future))
+        try:
+            return future.result(timeout)
+        finally:
+            self.latency.add(time.perf_counter() - start)
+
+    def _next_batch(self, first):
+        """first plus whatever else arrives within batch_window; None in the batch means stop."""
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while first is not None and len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is None:
+                break
+        return batch
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            rg.search([(0.0, 0.0)], mode=1, verbose=False)  # Loads the dataset and builds the KD-tree
+            self.warm_seconds = time.perf_counter() - start
+        except Exception:  # Lookups still run, and report the error themselves
+            log.exception("reverse_geocoder warm-up failed")
+        while True:
+            batch = self._next_batch(self._queue.get())
+            requests = [item for item in batch if item is not None]
+            if requests:
+                self._answer(requests)
+            if len(requests) < len(batch):
+                return
+
+    def _answer(self, requests):
+        self.batches += 1
+        try:
+            results = rg.search([coordinates for coordinates, _ in requests], mode=1, verbose=False)
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(requests, results):
+            code = result.get("cc")
+            future.set_result(Place(result.get("name"), result.get("admin1"), code, country_name(code)))
+
+    def stats(self):
+        lookups = self.latency.count
+        return {**self.latency.as_dict(), "batches": self.batches,
+                "per_batch": lookups / self.batches if self.batches else 0.0,
+                "warm_ms": None if self.warm_seconds is None else 1000 * self.warm_seconds}
+
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+
+
+def get_reverse_geocoder():
+    """Returns the process-wide ReverseGeocoder; its thread loads the dataset as soon as it starts."""
+    global _geocoder
+    with _geocoder_lock:
+        if _geocoder is None:
+            _geocoder = ReverseGeocoder(float(os.environ.get("ENROLL_RG_BATCH_MS", "5")) / 1000)
+            _geocoder.start()
+        return _geocoder
+
+
+# --- Cached coordinate -> location resolution ---
+Location = collections.namedtuple("Location", "timezone city admin1 country_code country_name")
+
+KM_PER_DEGREE = 111.32  # Along a meridian; cells get narrower east-west towards the poles, which is fine here
+
+
+class GridCache:
+    """LRU + TTL cache keyed by (latitude, longitude) snapped to a grid of `grid_km` cells."""
+
+    def __init__(self, grid_km=1.0, maxsize=10000, ttl=86400.0):
+        self.step = grid_km / KM_PER_DEGREE  # Degrees per cell
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # cell -> (expires, value), least recently used first
+        self._lock = threading.Lock()
+
+    def cell(self, latitude, longitude):
+        return round(latitude / self.step), round(longitude / self.step)
+
+    def get(self, latitude, longitude, compute):
+        """The cached value for the coordinates' cell, or compute() stored for next time."""
+        cell = self.cell(latitude, longitude)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cell)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(cell)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = compute()  # Outside the lock: a miss must not hold up hits from other sessions
+        with self._lock:
+            self._entries[cell] = (now + self.ttl, value)
+            self._entries.move_to_end(cell)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                    "hit_rate": self.hits / total if total else 0.0}
+
+
+class LocationResolver:
+    """(latitude, longitude) -> Location from the timezone service and reverse geocoder, cached per grid cell."""
+
+    def __init__(self, timezones, geocoder, cache):
+        self.timezones = timezones
+        self.geocoder = geocoder
+        self.cache = cache
+
+    def _compute(self, latitude, longitude):
+        place = self.geocoder.lookup(latitude, longitude)  # Raises on failure, so nothing is cached
+        return Location(self.timezones.timezone_at(latitude, longitude), *place)
+
+    def resolve(self, latitude, longitude):
+        return self.cache.get(latitude, longitude, lambda: self._compute(latitude, longitude))
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_location_resolver():
+    """Returns the process-wide LocationResolver over the shared timezone service and reverse geocoder."""
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            cache = GridCache(float(os.environ.get("ENROLL_GEO_GRID_KM", "1")),
+                              int(os.environ.get("ENROLL_GEO_CACHE_SIZE", "10000")),
+                              float(os.environ.get("ENROLL_GEO_CACHE_TTL", "86400")))
+            _resolver = LocationResolver(get_timezone_service(), get_reverse_geocoder(), cache)
+        return _resolver
+
+
+# --- City -> timezone index ---
+def normalize_name(text):
+    """Case-, accent- and whitespace-insensitive form of a place name: " São  Paulo" -> "sao paulo"."""
+    decomposed = unicodedata.normalize("NFKD", str(text or ""))
+    text = "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+    return " ".join(text.replace("|", " ").split())
+
+
+def _index_key(*parts):
+    return "|".join(parts).encode("utf-8")
+
+
+def build_city_timezone_index(path):
+    """
+    Writes the index file for CityTimezoneIndex from geonamescache. Each line is
+    "<key>\t<value>", sorted by key:
+
+        C|<country name, ISO2 or ISO3>      -> country code (geonamescache and pycountry names)
+        Z|<cc>|<city>|                      -> zones of the matching cities, most populous first
+        Z|<cc>|<city>|<state code or name>  -> the same, for cities in that state
+
+    Returns the number of lines written.
+    """
+    import geonamescache  # Only needed to build the index
+
+    gc = geonamescache.GeonamesCache()
+    known_zones = zoneinfo.available_timezones()
+    entries = {}
+    for code, country in gc.get_countries().items():
+        for name in (code, country.get("iso3"), country.get("name")):
+            if name:
+                entries[_index_key("C", normalize_name(name))] = code
+    for country in pycountry.countries:  # The names the location picker stores, e.g. "Korea, Republic of"
+        for name in (country.name, getattr(country, "official_name", None), getattr(country, "common_name", None)):
+            if name:
+                entries.setdefault(_index_key("C", normalize_name(name)), country.alpha_2)
+
+    state_names = {code: state.get("name") for code, state in gc.get_us_states().items()}
+    ranked = collections.defaultdict(list)  # key -> [(population, zone)]
+    for city in gc.get_cities().values():
+        zone = city.get("timezone")
+        if zone not in known_zones:
+            continue
+        cc, name, admin1 = city.get("countrycode", ""), normalize_name(city.get("name")), city.get("admin1code", "")
+        states = {admin1, state_names.get(admin1) if cc == "US" else None} - {None, ""}
+        for state in {""} | {normalize_name(state) for state in states}:
+            ranked[_index_key("Z", cc, name, state)].append((city.get("population") or 0, zone))
+    for key, candidates in ranked.items():
+        zones = []
+        for _, zone in sorted(candidates, reverse=True):
+            if zone not in zones:
+                zones.append(zone)
+        entries[key] = ",".join(zones)
+
+    storage.atomic_write(path, b"".join(key + b"\t" + value.encode("utf-8") + b"\n"
+                                        for key, value in sorted(entries.items())))
+    return len(entries)
+
+
+class CityTimezoneIndex:
+    """Read side of build_city_timezone_index(): a memory-mapped, sorted file searched in place."""
+
+    def __init__(self, path):
+        self.path = path
+        self.latency = LatencyStats()
+        self.error = None  # Why the index could not be opened or built, for the admin page
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._map is None:
+                try:
+                    if not os.path.exists(self.path):
+                        log.info("Building %s: %d entries", self.path, build_city_timezone_index(self.path))
+                    with open(self.path, "rb") as f:
+                        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                            if os.path.getsize(self.path) else b""
+                except (ImportError, OSError) as e:  # Index missing and geonamescache not installed to build it
+                    log.error("City timezone index %s unavailable: %r", self.path, e)
+                    self.error = e
+                    raise
+                self.error = None
+            return self._map
+
+    def warm(self):
+        self._open()
+        return self
+
+    def _get(self, key):
+        """Value of the line whose key is `key`, by binary search over the line starts; None if absent."""
+        data = self._open()
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b"\n", 0, mid) + 1
+            end = data.find(b"\n", start)
+            end = len(data) if end < 0 else end
+            line_key, _, value = data[start:end].partition(b"\t")
+            if line_key < key:
+                lo = end + 1
+            elif line_key > key:
+                hi = start
+            else:
+                return value.decode("utf-8")
+        return None
+
+    def country_code(self, country_name_or_code):
+        """"United States", "US" or "USA" -> "US"; None if unknown."""
+        code = self._get(_index_key("C", normalize_name(country_name_or_code)))
+        if code is None and country_name_or_code:
+            try:  # Index files built before pycountry names were added
+                code = pycountry.countries.lookup(country_name_or_code).alpha_2
+            except LookupError:
+                pass
+        return code
+
+    def candidates(self, country_name_or_code, city_name, state_province_name=None):
+        """Valid IANA zones for the city, most populous match first; narrowed to the state when it matches."""
+        start = time.perf_counter()
+        try:
+            code = self.country_code(country_name_or_code)
+            if code is None:
+                return []
+            city = normalize_name(city_name)
+            zones = None
+            if state_province_name:
+                zones = self._get(_index_key("Z", code, city, normalize_name(state_province_name)))
+            if zones is None:
+                zones = self._get(_index_key("Z", code, city, ""))
+            return zones.split(",") if zones else []
+        finally:
+            self.latency.add(time.perf_counter() - start)
+
+    def timezone(self, country_name_or_code, city_name, state_province_name=None):
+        """The IANA zone of the best-matching city, or None."""
+        zones = self.candidates(country_name_or_code, city_name, state_province_name)
+        return zones[0] if zones else None
+
+    def stats(self):
+        return self.latency.as_dict()
+
+
+_city_timezones = None
+_city_timezones_lock = threading.Lock()
+
+
+def get_city_timezones():
+    """Returns the process-wide CityTimezoneIndex, mapping (or first building) its file in the background."""
+    global _city_timezones
+    with _city_timezones_lock:
+        if _city_timezones is None:
+            _city_timezones = CityTimezoneIndex(os.environ.get("ENROLL_TZ_INDEX", "city_timezones.idx"))
+            threading.Thread(target=_city_timezones.warm, name="city-timezones-warmup", daemon=True).start()
+        return _city_timezones
+
+
+# --- Bulk backfill ---
+def backfill_locations(backend, index=None, allowed_zones=ALLOWED_TIMEZONES, dry_run=False):
+    """
+    Resolves every student's timezone from their country/state/city and
+    compares it with the stored one. Each student gets a status:
+
+        ok           stored timezone is allowed and agrees with the location (or the location is unknown)
+        filled       no timezone stored; the resolved one was written
+        fixed        stored timezone is not allowed; the resolved one was written
+        mismatch     stored timezone is allowed but the location resolves to another allowed one (not changed)
+        not offered  the location resolves to a timezone outside allowed_zones (not changed)
+        unresolved   the location is not in the index (not changed)
+        no location  country or city is empty (not changed)
+
+    Returns {"counts": {status: n}, "written": n, "issues": [row per student not ok], "seconds": s}.
+    """
+    start = time.perf_counter()
+    index = index or get_city_timezones()
+    path = backend.paths[storage.STUDENTS]
+    students = {sid: models.Student.from_dict(record) for sid, record in backend.load(path).items()}
+    allowed = set(allowed_zones) & zoneinfo.available_timezones()
+
+    places = {(s.country, s.city, s.state) for s in students.values() if s.country and s.city}
+    resolved = {place: index.timezone(*place) for place in places}
+
+    counts = collections.Counter()
+    changes, issues = {}, []
+    for sid, student in students.items():
+        zone = resolved.get((student.country, student.city, student.state))
+        if not (student.country and student.city):
+            status = "ok" if student.timezone in allowed else "no location"
+        elif zone is None:
+            status = "ok" if student.timezone in allowed else "unresolved"
+        elif zone not in allowed:
+            status = "ok" if student.timezone in allowed else "not offered"
+        elif student.timezone in allowed:
+            status = "ok" if student.timezone == zone else "mismatch"
+        else:
+            status = "fixed" if student.timezone else "filled"
+            changes[sid] = {"timezone": zone}
+        counts[status] += 1
+        if status != "ok":
+            issues.append({"student_id": sid, "name": student.name, "location": student.location,
+                           "timezone": student.timezone, "resolved": zone, "status": status})
+
+    if changes and not dry_run:
+        backend.update_records(path, changes)
+    return {"counts": dict(counts), "written": 0 if dry_run else len(changes), "issues": issues,
+            "seconds": time.perf_counter() - start}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline geolocation data")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build-tz-index", help="(Re)build the city -> timezone index")
+    build.add_argument("--path", default=os.environ.get("ENROLL_TZ_INDEX", "city_timezones.idx"))
+    backfill = commands.add_parser("backfill", help="Fill in / check student timezones from their locations")
+    backfill.add_argument("--dry-run", action="store_true", help="Report only; write nothing")
+    backfill.add_argument("--report", help="Also write the full report (every issue) to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.command == "build-tz-index":
+        start = time.perf_counter()
+        count = build_city_timezone_index(args.path)
+        print(f"Wrote {count} entries to {args.path} in {time.perf_counter() - start:.1f} s")
+    elif args.command == "backfill":
+        report = backfill_locations(storage.get_backend(), dry_run=args.dry_run)
+        for status, count in sorted(report["counts"].items()):
+            print(f"{status:<12} {count}")
+        print(f"{'(dry run) ' if args.dry_run else ''}wrote {report['written']} timezones in {report['seconds']:.2f} s")
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,22 +2,16 @@
 import datetime
 import streamlit as st
 from streamlit_geolocation import streamlit_geolocation
-from timezonefinder import TimezoneFinder
 import pytz
-import reverse_geocoder as rg  # For reverse geocoding
-import pycountry             # For getting country name from code
-
-import pycountry
 import json
-import shutil
 import calendar
 import os
-import mimetypes
 from zoneinfo import *
 import hmac
 import streamlit_autorefresh as st_autorefresh
 from streamlit_date_picker import date_range_picker, date_picker, PickerType
 import hashlib
+import sqlite3
 import pandas as pd
 import uuid
 from itertools import chain
@@ -26,6 +20,14 @@ import time
 from streamlit_geolocation import streamlit_geolocation
 from streamlit_star_rating import st_star_rating
 from streamlit_cookies_manager import EncryptedCookieManager
+import storage
+import seats
+import models
+import enroll_schedule
+import live
+import geo
+import locations
+import courseware
 
 # This should be on top of your script
 cookies = EncryptedCookieManager(
@@ -134,86 +136,20 @@ def string_to_params(string):
 def get_timezone_from_location_name(country_name_or_code, city_name, state_province_name=None):
     """
     Attempts to find the IANA timezone string for a given location (country, city, optionally state/province)
-    using the offline geonamescache library.
+    using the prebuilt city -> timezone index (geo.CityTimezoneIndex, built from geonamescache).
 
     Args:
-        country_name_or_code (str): The full country name (e.g., "United States") or its ISO 3166-1 alpha-2 code (e.g., "US").
+        country_name_or_code (str): The full country name (e.g., "United States") or its ISO code (e.g., "US", "USA").
         city_name (str): The name of the city.
-        state_province_name (str, optional): The name of the state or province.
+        state_province_name (str, optional): The name or code of the state or province.
                                              This helps disambiguate cities with the same name. Defaults to None.
 
     Returns:
         str or None: The IANA timezone string (e.g., "America/New_York") if found, otherwise None.
     """
-    gc = geonamescache.GeonamesCache()
-
-    # 1. Normalize country input to country code
-    country_code = None
-    countries_data = gc.get_countries() # Dict of country_code: {details}
-    country_name_or_code_lower = country_name_or_code.lower()
-
-    if len(country_name_or_code_lower) == 2: # Assume it's a code
-        if country_name_or_code_lower.upper() in countries_data:
-            country_code = country_name_or_code_lower.upper()
-    else: # Assume it's a name
-        for code, details in countries_data.items():
-            if details.get('name', '').lower() == country_name_or_code_lower:
-                country_code = code
-                break
-            # Check common aliases or alternative names if needed (more complex)
-
-    if not country_code:
-        # print(f"Debug: Country '{country_name_or_code}' not found in geonamescache.")
-        return None
-
-    # 2. Get cities and filter by country and name
-    cities_data = gc.get_cities() # Dict of city_id: {details}
-    candidate_cities = []
-    city_name_lower = city_name.lower()
-    state_province_name_lower = state_province_name.lower() if state_province_name else None
-
-    for city_id, city_details in cities_data.items():
-        if city_details.get('countrycode') == country_code and \
-           city_details.get('name', '').lower() == city_name_lower:
-
-            # If state/province is provided, try to match it
-            if state_province_name_lower:
-                # 'admin1' in geonamescache city data often holds the state/province name or code.
-                # It might not always be the full name, could be an abbreviation or code.
-                city_admin1 = city_details.get('admin1', '').lower()
-                if state_province_name_lower in city_admin1 or city_admin1 in state_province_name_lower : # Partial match
-                    candidate_cities.append(city_details)
-                # For more precise matching, you might need admin1 code lookup if available
-            else:
-                candidate_cities.append(city_details)
-
-    if not candidate_cities:
-        # print(f"Debug: City '{city_name}' in country '{country_code}' not found.")
-        return None
-
-    # 3. Handle multiple matches or get timezone
-    # If multiple cities match (e.g., "Springfield" in "US"), prioritize by population or return first valid.
-    # For simplicity, we'll take the first one with a valid timezone.
-    # A more robust solution might sort by population if available (city_details.get('population'))
-    # or require state/province if multiple are found without it.
-
-    found_timezone = None
-    for city_info in sorted(candidate_cities, key=lambda c: c.get('population', 0), reverse=True): # Prioritize by population
-        tz_name = city_info.get('timezone')
-        if tz_name:
-            # Validate if it's a known timezone by pytz to be safe
-            try:
-                pytz.timezone(tz_name)
-                found_timezone = tz_name
-                break # Found a valid timezone for a matching city
-            except pytz.exceptions.UnknownTimeZoneError:
-                # print(f"Debug: Geonamescache listed timezone '{tz_name}' for {city_name} but pytz doesn't know it.")
-                continue # Try next candidate city if any
-
-    if found_timezone:
-        return found_timezone
-    else:
-        # print(f"Debug: No valid timezone found for the specified location criteria among candidates.")
+    try:
+        return city_timezones.timezone(country_name_or_code, city_name, state_province_name)
+    except (ImportError, OSError):  # Recorded in city_timezones.error and shown on the admin page
         return None
 # --- End Translation Setup ---
 
@@ -224,6 +160,12 @@ USER_DB_PATH = "user_db.json"
 ENROLLMENTS_DB_PATH = "enrollments.json"
 TEACHERS_DB_PATH = "teachers.json"
 SWITCH_DB_PATH = "switch.json"
+RATINGS_DB_PATH = "ratings.json"  # {teacher_id: {student_id: {period: {stars, feedback}}}}
+# Backend behind load_data/save_data (JSON files by default, ENROLL_STORAGE=sqlite for SQLite/WAL)
+storage_backend = storage.get_backend({storage.STUDENTS: USER_DB_PATH, storage.TEACHERS: TEACHERS_DB_PATH,
+                                       storage.ENROLLMENTS: ENROLLMENTS_DB_PATH, storage.RATINGS: RATINGS_DB_PATH,
+                                       storage.SWITCH: SWITCH_DB_PATH})
+models.ensure_schema(storage_backend)  # One-time normalization of legacy record shapes (see models.py)
 
 # --- RESTORED Bilingual Texts Dictionary (for UI elements) ---
 texts = {
@@ -253,7 +195,7 @@ texts = {
         "register_raz_label": "RAZ Level",  # <-- Added RAZ Label
         "register_country_label": "Country", "register_state_label": "State/Province", "register_city_label": "City",
         "select_country": "--- Select Country ---", "select_state": "--- Select State/Province ---",
-        "select_city": "--- Select City ---",
+        "select_city": "--- Select City ---", "search_city": "Type to search cities",
         "fill_all_fields": "Please fill in Name and select a valid Country, State/Province, City, and Time Zone.",
         # RAZ not mandatory here, adjust if needed
         "already_enrolled_warning": "Already enrolled.", "registered_success": "Registered {name}! Reloading page.",
@@ -292,7 +234,10 @@ texts = {
         "teacher_description_header": "Teacher Description",
         "no_description_available": "No description available.",  # For Student View
         "admin_manage_teachers_desc_en": "Description EN",  # Column header in Admin
-        "admin_manage_teachers_desc_zh": "Description ZH", "selectzone": "Select your time zone"
+        "admin_manage_teachers_desc_zh": "Description ZH", "selectzone": "Select your time zone",
+        "my_classes": "My classes: {names}",
+        "schedule_open_enrollment": "Enrollment opens: {time}", "schedule_close_enrollment": "Enrollment closes: {time}",
+        "schedule_open_ratings": "Feedback opens: {time}", "schedule_close_ratings": "Feedback closes: {time}"
     },
     "中文": {
         "ERR_NO_RATE": "请给老师一个评分！", "RATED": "已在{time}完成对老师的反馈！感谢！","autcompl":"自动输入位置并时区信息（处理需要几秒钟）","mancompl":"手动输入",
@@ -315,6 +260,7 @@ texts = {
         "register_raz_label": "RAZ 等级",  # <-- Added RAZ Label
         "register_country_label": "国家", "register_state_label": "州/省", "register_city_label": "城市",
         "select_country": "--- 选择国家 ---", "select_state": "--- 选择州/省 ---", "select_city": "--- 选择城市 ---",
+        "search_city": "输入以搜索城市",
         "fill_all_fields": "请填写姓名并选择有效的国家、州/省、城市和时区。",  # RAZ not mandatory here, adjust if needed
         "already_enrolled_warning": "已报名。", "registered_success": "已注册 {name}! 正在重新加载页面。",
         "you_marker": "你",
@@ -349,16 +295,49 @@ texts = {
         "teacher_description_header": "教师描述",  # 教师仪表板部分
         "no_description_available": "暂无描述。",  # 学生视图
         "admin_manage_teachers_desc_en": "描述 EN",  # 管理员中的列标题
-        "admin_manage_teachers_desc_zh": "描述 ZH", "selectzone": "请选择你的时区"
+        "admin_manage_teachers_desc_zh": "描述 ZH", "selectzone": "请选择你的时区",
+        "my_classes": "我的课程：{names}",
+        "schedule_open_enrollment": "报名开始：{time}", "schedule_close_enrollment": "报名截止：{time}",
+        "schedule_open_ratings": "反馈开始：{time}", "schedule_close_ratings": "反馈截止：{time}"
     }
 }
-# --- Simplified Location Data (English Only) ---
-location_data = {
-    "USA": {"California": ["Los Angeles", "San Francisco"], "New York": ["New York City", "Buffalo"]},
-    "China": {"Beijing Municipality": ["Beijing"], "Shanghai Municipality": ["Shanghai"]},
-    "Canada": {"Ontario": ["Toronto", "Ottawa"], "Quebec": ["Montreal", "Quebec City"]},
-    # Add more...
-}
+# --- Location Pickers (country/state/city lists come from locations.LocationCatalog) ---
+CITY_OPTION_LIMIT = 200  # Longer city lists get a search box instead of one huge selectbox
+
+
+def _with_detected(placeholder, detected, options):
+    """[placeholder, detected, *options without detected]; detected comes preselected when given."""
+    head = [placeholder] + ([detected] if detected else [])
+    return head + [option for option in options if option != detected], 1 if detected else 0
+
+
+def location_selectboxes(lang, language, detected=None):
+    """
+    Country / state / city selectboxes for registration. Values are English names;
+    labels follow `language`. detected (a geo.Location from the browser's position)
+    preselects its country, state and city. Returns (country, state, city).
+    """
+    options, index = _with_detected(lang["select_country"], detected and detected.country_name,
+                                    location_catalog.countries(language))
+    country = st.selectbox(lang["register_country_label"], options=options, key="reg_country", index=index,
+                           format_func=lambda name: location_catalog.label(name, language))
+    no_country = country == lang["select_country"]
+
+    subdivisions = () if no_country else location_catalog.subdivisions(country, language)
+    if not no_country and not subdivisions:
+        subdivisions = (country,)  # No ISO subdivisions (e.g. city states): the country is its own state
+    options, index = _with_detected(lang["select_state"], detected and detected.admin1, subdivisions)
+    state = st.selectbox(lang["register_state_label"], options=options, key="reg_state", index=index,
+                         disabled=no_country, format_func=lambda name: location_catalog.label(name, language, country))
+    no_state = state == lang["select_state"]
+
+    cities = [] if no_state else location_catalog.cities(country, state)
+    if len(cities) > CITY_OPTION_LIMIT:
+        prefix = st.text_input(lang["search_city"], key="reg_city_search")
+        cities = location_catalog.search_cities(country, prefix, state, limit=CITY_OPTION_LIMIT)
+    options, index = _with_detected(lang["select_city"], detected and detected.city, cities)
+    city = st.selectbox(lang["register_city_label"], options=options, key="reg_city", index=index, disabled=no_state)
+    return country, state, city
 
 timezozs = {
     "China": "Asia/Shanghai"
@@ -431,21 +410,144 @@ def is_within_range(start_day_str, start_time_str, end_day_str, end_time_str, cu
 
 # --- File Database Helper Functions ---
 def load_data(path):
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                content = f.read(); return json.loads(content) if content else {}
-        except (json.JSONDecodeError, IOError) as e:
-            st.error(f"Error loading {path}: {e}"); return {}
-    return {}
+    try:
+        return storage_backend.load(path)
+    except (json.JSONDecodeError, IOError, sqlite3.Error) as e:
+        st.error(f"Error loading {path}: {e}"); return {}
 
 
 def save_data(path, data):
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except IOError as e:
+        if path == ENROLLMENTS_DB_PATH:
+            # Rosters are rewritten wholesale: hold seat grants off and re-seed the counters from the result
+            seat_inventory.reset(lambda: storage_backend.save(path, data))
+        else:
+            storage_backend.save(path, data)
+    except (IOError, sqlite3.Error) as e:
         st.error(f"Error saving {path}: {e}")
+    if path in (SWITCH_DB_PATH, TEACHERS_DB_PATH):
+        live_hub.wake()  # Push the change to subscribed sessions now
+
+
+def enroll_student(teacher_id, student_id, cap):
+    """Reserves a seat (never more than cap) and persists it. Returns a seats.* outcome."""
+    try:
+        return seat_inventory.reserve(teacher_id, student_id, cap)
+    except (IOError, sqlite3.Error) as e:
+        st.error(f"Error saving enrollment: {e}"); return None
+
+
+def cancel_enrollment(teacher_id, student_id):
+    try:
+        return seat_inventory.release(teacher_id, student_id)
+    except (IOError, sqlite3.Error) as e:
+        st.error(f"Error saving enrollment: {e}"); return False
+
+
+def enroll_many(pairs):
+    """Admin bulk enroll of (teacher_id, student_id) pairs; bypasses the enrollment cap."""
+    try:
+        seat_inventory.reset(lambda: storage_backend.enroll_many(pairs))
+    except (IOError, sqlite3.Error) as e:
+        st.error(f"Error saving enrollment: {e}")
+
+
+def cancel_many(pairs):
+    """Admin bulk un-enroll of (teacher_id, student_id) pairs; costs O(len(pairs))."""
+    try:
+        seat_inventory.reset(lambda: storage_backend.cancel_many(pairs))
+    except (IOError, sqlite3.Error) as e:
+        st.error(f"Error saving enrollment: {e}")
+
+
+seat_inventory = seats.get_inventory(storage_backend, ENROLLMENTS_DB_PATH)
+schedule_executor = enroll_schedule.get_executor(storage_backend)  # Applies Open/Close Enrollment/Ratings on time
+live_hub = live.get_hub(storage_backend)  # Counts switch / teacher availability changes for live_subscribe()
+timezone_service = geo.get_timezone_service()  # One TimezoneFinder per process, loaded at startup
+reverse_geocoder = geo.get_reverse_geocoder()  # Coordinates -> city/state/country, batched across sessions
+city_timezones = geo.get_city_timezones()  # (country, city, state) -> timezone, memory-mapped index
+location_resolver = geo.get_location_resolver()  # Both of the above for coordinates, cached per ~1 km cell
+location_catalog = locations.get_catalog()  # Countries / subdivisions / cities for the registration pickers
+
+
+LIVE_REFRESH_SECONDS = float(os.environ.get("ENROLL_LIVE_REFRESH", "2"))
+
+
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def _live_poll(topics):
+    """Reruns the page once the hub has published one of topics since the page rendered."""
+    if live_hub.token(topics) != st.session_state.get("live_token"):
+        st.rerun(scope="app")
+
+
+def live_subscribe(teacher_ids=()):
+    """Reruns this session when switch.json or one of teacher_ids' availability changes."""
+    topics = (live.SWITCH_TOPIC,) + tuple(live.teacher_topic(t) for t in teacher_ids)
+    st.session_state.live_token = live_hub.token(topics)
+    _live_poll(topics)
+
+
+# --- Record-level updates (only the changed records are written) ---
+def update_records(path, changes):
+    """changes: {record_id: {field: value}}; missing records are created."""
+    if not changes:
+        return
+    try:
+        storage_backend.update_records(path, changes)
+    except (IOError, sqlite3.Error) as e:
+        st.error(f"Error saving {path}: {e}")
+    if path == TEACHERS_DB_PATH:
+        live_hub.wake()
+
+
+def update_teacher(teacher_id, **fields): update_records(TEACHERS_DB_PATH, {teacher_id: fields})
+
+
+def update_teachers(changes): update_records(TEACHERS_DB_PATH, changes)
+
+
+def update_student(student_id, **fields): update_records(USER_DB_PATH, {student_id: fields})
+
+
+def update_students(changes): update_records(USER_DB_PATH, changes)
+
+
+def append_rating(teacher_id, student_id, stars, feedback):
+    """
+    Saves one student's rating of a teacher for the current rating period
+    (replaces an earlier one for that period). Returns True if it was saved.
+    """
+    try:
+        models.submit_rating(storage_backend, teacher_id, student_id, stars, feedback)
+        return True
+    except (ValueError, IOError, sqlite3.Error) as e:
+        st.error(f"Error saving rating: {e}")
+        return False
+
+
+# --- Typed views (rebuilt only when the underlying file changes) ---
+def load_teachers():
+    """{teacher_id: models.Teacher}"""
+    try:
+        return models.get_view(storage_backend, TEACHERS_DB_PATH, models.Teacher).get()
+    except (json.JSONDecodeError, IOError, sqlite3.Error) as e:
+        st.error(f"Error loading {TEACHERS_DB_PATH}: {e}"); return {}
+
+
+def load_availability():
+    """{teacher_id: models.Availability}: each teacher's own flags with the global switches layered on top."""
+    try:
+        return models.get_availability(storage_backend)
+    except (json.JSONDecodeError, IOError, sqlite3.Error) as e:
+        st.error(f"Error loading {TEACHERS_DB_PATH}: {e}"); return {}
+
+
+def load_students():
+    """{student_id: models.Student}"""
+    try:
+        return models.get_view(storage_backend, USER_DB_PATH, models.Student).get()
+    except (json.JSONDecodeError, IOError, sqlite3.Error) as e:
+        st.error(f"Error loading {USER_DB_PATH}: {e}"); return {}
 
 
 # --- Load file databases ---
@@ -454,10 +556,10 @@ enrollments_global = load_data(ENROLLMENTS_DB_PATH)
 teachers_database_global = load_data(TEACHERS_DB_PATH)
 broadcasted_info = load_data(SWITCH_DB_PATH)
 if (broadcasted_info == {}):
-    save_data(SWITCH_DB_PATH, {"rating": False, "all_hidden": False, "all_closed": False})
+    save_data(SWITCH_DB_PATH, models.SwitchState(schema_version=models.SCHEMA_VERSION).to_dict())
     broadcasted_info = load_data(SWITCH_DB_PATH)
 days_of_week = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-allowed_zms=["Asia/Shanghai","America/Los_Angeles","America/Chicago",'America/New_York','Europe/Berlin',"Japan","America/Sao_Paulo",'America/Mexico_City',"Asia/Dhaka",]
+allowed_zms=geo.ALLOWED_TIMEZONES
 avtimezones=[x for x in list(available_timezones()) if x in allowed_zms]
 # --- Encryption & ID Generation ---
 #if "secret_key" not in st.secrets: st.error("`secret_key` missing."); st.stop()
@@ -521,49 +623,49 @@ def is_date_in_range(start_date: datetime.date, end_date: datetime.date, date_to
     return start_date <= date_to_check <= end_date
 BASE_UPLOAD_DIRECTORY = "user_specific_uploads" # Main folder for all user uploads
 SUPPORTED_TYPES = ["pptx", "xlsx", "xls", "docx", "txt", "pdf"]
+courseware_store = courseware.get_store(BASE_UPLOAD_DIRECTORY)  # Versioned, sha256-named blobs; prunes old versions
+
 def save_file_for_user(user_id, uploaded_file_obj):
     """
-    Saves the uploaded file to a user-specific directory.
-    Deletes any previously existing files in that user's directory.
-    Returns the path to the saved file and the file bytes.
+    Publishes the uploaded file as the next version of the user's courseware
+    file of that name (their other files are kept). The upload is copied in
+    chunks; content that is already stored (e.g. the same deck uploaded again)
+    is linked, not rewritten.
+    Returns the path to the saved file, its name and its MIME type.
     """
     if not user_id:
         raise ValueError("User ID cannot be empty.")
 
-    # Sanitize user_id for directory naming (basic example)
-    # In a real app, use a more robust sanitization or hashing method
-    safe_user_id_folder_name = "".join(c for c in user_id if c.isalnum() or c in ('_', '-')).rstrip()
-    if not safe_user_id_folder_name:
-        raise ValueError("User ID resulted in an invalid folder name after sanitization.")
-
-    user_specific_dir = os.path.join(BASE_UPLOAD_DIRECTORY, safe_user_id_folder_name)
-
-    # 1. Create the base upload directory if it doesn't exist
-    os.makedirs(BASE_UPLOAD_DIRECTORY, exist_ok=True)
-
-    # 2. Clear and create/recreate the user's specific directory
-    if os.path.exists(user_specific_dir):
-        # Delete all contents of the user's directory
-        for item_name in os.listdir(user_specific_dir):
-            item_path = os.path.join(user_specific_dir, item_name)
-            try:
-                if os.path.isfile(item_path) or os.path.islink(item_path):
-                    os.unlink(item_path)
-                elif os.path.isdir(item_path):
-                    shutil.rmtree(item_path) # Use shutil to remove directories
-            except Exception as e:
-                st.warning(f"Could not delete old item {item_path}: {e}")
-    os.makedirs(user_specific_dir, exist_ok=True) # Ensure it exists after clearing
-
-    # 3. Save the new file
-    file_bytes = uploaded_file_obj.getvalue()
     original_filename = uploaded_file_obj.name
-    save_path = os.path.join(user_specific_dir, original_filename)
+    uploaded_file_obj.seek(0)
+    save_path, _ = courseware_store.put(user_id, original_filename, uploaded_file_obj, uploaded_file_obj.type)
+    return save_path, original_filename, uploaded_file_obj.type
 
-    with open(save_path, "wb") as f:
-        f.write(file_bytes)
 
-    return save_path, file_bytes, original_filename, uploaded_file_obj.type
+def courseware_download(teacher_id):
+    """
+    Courseware downloads for a teacher card: the latest version of each of the
+    teacher's files. A file is only opened after the student asks for it.
+    Limitation: st.download_button reads the whole file into the server's
+    memory (Streamlit's media file manager) when it is shown, so the memory
+    cost of a large deck is paid per requested download, not avoided.
+    """
+    files = courseware_store.files(teacher_id)  # In-memory index: no file system access to render the card
+    if not files:
+        st.info("No Courseware For this Teacher")
+        return
+    for entry in files:
+        name = entry["filename"]
+        ready_key = f"courseware_ready_{teacher_id}_{name}"
+        if not st.session_state.get(ready_key):
+            if not st.button(f"Download {name} ({entry['size'] / 1024 / 1024:.1f} MB)",
+                             key=f"prepare_btn_{teacher_id}_{name}"):
+                continue
+            st.session_state[ready_key] = True
+        with open(courseware_store.path(teacher_id, name, entry["version"]), "rb") as fp:
+            if st.download_button(label=f"Save {name}", data=fp, file_name=name,
+                                  mime=entry["mime"], key=f"download_btn_{teacher_id}_{name}"):
+                st.session_state.pop(ready_key, None)  # Downloaded: stop reading the file on every rerun
 
 # --- Teacher Dashboard (Displaying Names from IDs) ---
 def teacher_dashboard():
@@ -583,75 +685,65 @@ def teacher_dashboard():
     st.markdown("---")
     teacher_name = st.session_state.teacher_name
     teacher_id = st.session_state.teacher_id
-    current_teachers_db = load_data(TEACHERS_DB_PATH)
-    teacher_details = current_teachers_db.get(teacher_id)
+    teacher_details = load_teachers().get(teacher_id)
     if not teacher_details: st.error("Teacher data not found."); st.stop()
-    ratt = teacher_details.get("rating", None)
-    if teacher_details.get("rated", None) != None:
-        if teacher_details.get("rated", None) == []:
-            teacherratt = None
-
-        else:
-
-            teachrat = list(chain(*list(teacher_details.get("rated", None).values())))
-            print(teachrat)
-            smup = [m["stars"] for m in teachrat]
+    teacher_ratings = storage_backend.ratings_for_teacher(teacher_id)  # {student_id: {period: entry}}
+    if teacher_ratings:
+        teachrat = list(chain(*[periods.values() for periods in teacher_ratings.values()]))
+        smup = [m["stars"] for m in teachrat]
 
-            teacherratt = sum(smup)
-        teacher_details["rating"] = str(teacherratt)
+        teacherratt = sum(smup)
     else:
         teacherratt = None
-        teacher_details["rating"] = str(teacherratt)
 
-    current_teachers_db[teacher_id] = teacher_details
-    save_data(TEACHERS_DB_PATH, current_teachers_db)
-    teacher_details = load_data(TEACHERS_DB_PATH)[teacher_id]
-    print(current_teachers_db[teacher_id])
-    ratt = teacher_details.get("rating", None)
-    print(ratt)
+    if teacher_details.rating != teacherratt:  # Only write when the aggregate actually changed
+        update_teacher(teacher_id, rating=teacherratt)
+        teacher_details = load_teachers()[teacher_id]
 
-    if (ratt != None and ratt.isdigit() and int(ratt) >= 0):
+    if teacher_details.rating is not None and teacher_details.rating >= 0:
         st_star_rating(label=admin_lang["class_rating"], maxValue=5,
-                       defaultValue=int(teacher_details.get("rating", "0")), key="rating", read_only=True)
+                       defaultValue=teacher_details.rating, key="rating", read_only=True)
     else:
         st.subheader(admin_lang["class_rating"])
         st.info(admin_lang["class_no_rating"])
     # ... (Class Status display and buttons - unchanged) ...
     st.subheader(admin_lang["class_status_header"])
-    is_active = teacher_details.get("is_active", True)
+    is_active = teacher_details.is_active
+    teacher_availability = load_availability().get(teacher_id)
 
     status_text = admin_lang["status_active"] if is_active else admin_lang["status_cancelled"]
     if is_active:
         st.success(f"Class Status: {status_text}")
     else:
         st.warning(f"Class Status: {status_text}")
+    if is_active and teacher_availability and not teacher_availability.visible:
+        st.caption("All classes are currently hidden by the admin.")
 
     btn_label = admin_lang["cancel_class_button"] if is_active else admin_lang["reactivate_class_button"]
     btn_key = "cancel_class_btn" if is_active else "reactivate_class_btn"
     new_status = not is_active
     if st.button(btn_label, key=btn_key):
-        current_teachers_db[teacher_id]["is_active"] = new_status
-        save_data(TEACHERS_DB_PATH, current_teachers_db);
-        teachers_database_global = current_teachers_db
+        update_teacher(teacher_id, is_active=new_status)
+        teachers_database_global = load_data(TEACHERS_DB_PATH)
         st.success("Class status updated.");
         st.rerun()
 
     st.subheader(admin_lang["enrollment_status_header"])
-    allow_enr = teacher_details.get("allow_enroll", True)
+    allow_enr = teacher_details.allow_enroll
     status_text = admin_lang["enrollment_active"] if allow_enr else admin_lang["enrollment_blocked"]
     if allow_enr:
         st.success(f"Enrollment Status: {status_text}")
     else:
         st.warning(f"Enrollment Status: {status_text}")
+    if allow_enr and teacher_availability and not teacher_availability.enrollable:
+        st.caption("Enrollment is currently closed for all classes.")
 
     btn_label1 = admin_lang["block_enroll_button"] if allow_enr else admin_lang["reactivate_enroll_button"]
     btn_key1 = "block_enroll_btn" if allow_enr else "reactivate_enroll_btn"
     new_status1 = not allow_enr
     if st.button(btn_label1, key=btn_key1):
-        current_teachers_db[teacher_id]["allow_enroll"] = new_status1
-        print(current_teachers_db[teacher_id]["allow_enroll"])
-        save_data(TEACHERS_DB_PATH, current_teachers_db);
-        teachers_database_global = current_teachers_db
+        update_teacher(teacher_id, allow_enroll=new_status1)
+        teachers_database_global = load_data(TEACHERS_DB_PATH)
         st.success("Enrollment status updated.");
         st.rerun()
 
@@ -663,49 +755,63 @@ def teacher_dashboard():
         st.write("**Class Details & Limit**");
         col1, col2 = st.columns(2)
         with col1: new_subject_en = st.text_input(admin_lang["subject_en_label"],
-                                                  value=teacher_details.get("subject_en", ""))
-        with col2: new_grade = st.text_input(admin_lang["grade_label"], value=teacher_details.get("grade", ""))
-        current_cap = teacher_details.get("enrollment_cap");
+                                                  value=teacher_details.subject_en)
+        with col2: new_grade = st.text_input(admin_lang["grade_label"], value=teacher_details.grade)
+        current_cap = teacher_details.enrollment_cap;
         cap_value = current_cap if current_cap is not None else 0
         new_cap = st.number_input(admin_lang["max_students_label"], min_value=0, value=cap_value, step=1, format="%d",
                                   key="teacher_edit_cap")
         st.markdown("---");
         st.write(f"**{admin_lang['teacher_description_header']}**")
         new_desc_en = st.text_area(admin_lang["teacher_description_label_en"],
-                                   value=teacher_details.get("description_en", ""), height=150)
+                                   value=teacher_details.description_en, height=150)
         new_desc_zh = st.text_area(admin_lang["teacher_description_label_zh"],
-                                   value=teacher_details.get("description_zh", ""), height=150)
+                                   value=teacher_details.description_zh, height=150)
         print(teacher_id)
         # File uploader widget
-        uploaded_file = st.file_uploader(
-            "Upload your Courseware",
+        uploaded_files = st.file_uploader(
+            "Upload your Courseware (a file with the same name as an existing one becomes its new version)",
             type=SUPPORTED_TYPES,
-            accept_multiple_files=False  # Process one file at a time
+            accept_multiple_files=True
         )
 
-        if uploaded_file is not None:
-            save_file_for_user(teacher_id,uploaded_file)
+        # The uploader keeps returning the same files on every rerun; only save each new upload once
+        saved_upload_ids = st.session_state.setdefault("saved_upload_ids", set())
+        for uploaded_file in uploaded_files or []:
+            if uploaded_file.file_id not in saved_upload_ids:
+                save_file_for_user(teacher_id, uploaded_file)
+                saved_upload_ids.add(uploaded_file.file_id)
         # ... (Save button logic - unchanged) ...
         submitted = st.form_submit_button(admin_lang["save_settings_button"])
         if submitted:
             processed_cap = int(new_cap) if new_cap > 0 else None
-            current_teachers_db[teacher_id].update(
-                {"subject_en": new_subject_en.strip(), "grade": new_grade.strip(), "enrollment_cap": processed_cap,
-                 "description_en": new_desc_en.strip(), "description_zh": new_desc_zh.strip()})
-            save_data(TEACHERS_DB_PATH, current_teachers_db);
-            teachers_database_global = current_teachers_db
+            update_teacher(teacher_id, subject_en=new_subject_en.strip(), grade=new_grade.strip(),
+                           enrollment_cap=processed_cap, description_en=new_desc_en.strip(),
+                           description_zh=new_desc_zh.strip())
+            teachers_database_global = load_data(TEACHERS_DB_PATH)
             st.success(admin_lang["settings_updated_success"]);
             st.rerun()
 
+    my_files = courseware_store.files(teacher_id)
+    if my_files:
+        st.write("**Your Courseware**")
+        for entry in my_files:
+            col_name, col_remove = st.columns([4, 1])
+            col_name.write(f"{entry['filename']} - version {entry['version']} "
+                           f"({entry['versions']} kept, {entry['size'] / 1024 / 1024:.1f} MB)")
+            if col_remove.button("Remove", key=f"remove_courseware_{entry['filename']}"):
+                courseware_store.remove(teacher_id, entry["filename"])
+                st.rerun()
+
     st.markdown("---")
     st.subheader(admin_lang["enrollment_overview_header"])
     # --- Enrollment Overview (Displaying names looked up by ID) ---
     current_enrollments = load_data(ENROLLMENTS_DB_PATH)  # Load fresh enrollments (student IDs)
-    user_db_for_display = load_data(USER_DB_PATH)  # Load fresh user data for name lookup
+    user_db_for_display = load_students()  # For name lookup
 
     enrolled_student_ids = current_enrollments.get(teacher_id, [])
     enrollment_count = len(enrolled_student_ids)
-    display_cap = teacher_details.get("enrollment_cap")  # None or int
+    display_cap = teacher_details.enrollment_cap  # None or int
     cap_text = admin_lang["unlimited"] if display_cap is None else str(display_cap)
     st.metric(admin_lang["current_enrollment_metric"], f"{enrollment_count} / {cap_text}")
 
@@ -715,10 +821,8 @@ def teacher_dashboard():
         enrolled_student_names = []
         for s_id in enrolled_student_ids:
             student_info = user_db_for_display.get(s_id)
-            if isinstance(student_info, dict):
-                enrolled_student_names.append(student_info.get("name", f"Unknown ID: {s_id}"))
-            elif isinstance(student_info, str):  # Handle old format if necessary
-                enrolled_student_names.append(f"{student_info} (ID: {s_id})")
+            if student_info is not None:
+                enrolled_student_names.append(student_info.name or f"Unknown ID: {s_id}")
             else:
                 enrolled_student_names.append(f"Unknown ID: {s_id}")
 
@@ -766,16 +870,7 @@ def admin_route():
 
         if latitude is not None and longitude is not None:
 
-            # Initialize TimezoneFinder
-            # This object can be computationally expensive to create,
-            # so for performance in a real app, you might consider caching it
-            # or creating it once at the start of the script if not using Streamlit's rerun magic.
-            # However, for this simple case, direct initialization is fine.
-            tf = TimezoneFinder()
-
-            # Get the timezone string
-            # Note: timezone_at() expects longitude first, then latitude
-            timezone_str = tf.timezone_at(lng=longitude, lat=latitude)
+            timezone_str = timezone_service.timezone_at(latitude, longitude)
 
             if timezone_str:
                 st.success(f"Estimated Timezone: {timezone_str}")
@@ -794,10 +889,38 @@ def admin_route():
     cookies["admin_psc"] = admin_password
     st.success(admin_lang["admin_access_granted"])
     if st.button(admin_lang["refresh_data_button"]):
+        if isinstance(storage_backend, storage.JsonFileBackend):
+            storage_backend.cache.invalidate()
         user_database_global = load_data(USER_DB_PATH);
         enrollments_global = load_data(ENROLLMENTS_DB_PATH);
         teachers_database_global = load_data(TEACHERS_DB_PATH)
         st.rerun()
+    if isinstance(storage_backend, storage.JsonFileBackend):
+        cache_stats = storage_backend.cache.stats()
+        st.caption(f"Database cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+                   f"({cache_stats['hit_rate']:.0%} hit rate, {cache_stats['entries']} files)")
+    seat_stats = seat_inventory.metrics()
+    st.caption(f"Seat reservations: {seat_stats['granted']} granted, {seat_stats['full']} rejected (full), "
+               f"{seat_stats['cas_conflicts']} CAS retries (max {seat_stats['max_retries_seen']} in one click), "
+               f"{seat_stats['gave_up']} gave up")
+    geo_stats = location_resolver.cache.stats()
+    st.caption(f"Location cache: {geo_stats['hits']} hits / {geo_stats['misses']} misses "
+               f"({geo_stats['hit_rate']:.0%} hit rate, {geo_stats['entries']} cells)")
+    rg_stats = reverse_geocoder.stats()
+    st.caption(f"Reverse geocoding: {rg_stats['lookups']} lookups in {rg_stats['batches']} batches "
+               f"({rg_stats['per_batch']:.1f} per batch), p95 {rg_stats['p95_ms']:.1f} ms; "
+               f"loaded in {rg_stats['warm_ms'] or 0:.0f} ms")
+    tz_stats = timezone_service.stats()
+    st.caption(f"Timezone lookups: {tz_stats['lookups']} ({tz_stats['misses']} not found), "
+               f"p50 {tz_stats['p50_ms']:.2f} ms, p95 {tz_stats['p95_ms']:.2f} ms, max {tz_stats['max_ms']:.2f} ms; "
+               f"loaded in {tz_stats['warm_ms'] or 0:.0f} ms{' (in memory)' if tz_stats['in_memory'] else ''}")
+    if city_timezones.error is not None:
+        st.warning(f"City timezone index unavailable: {city_timezones.error}")
+    cw_stats = courseware_store.stats()
+    st.caption(f"Courseware: {cw_stats['files']} files / {cw_stats['versions']} versions for "
+               f"{cw_stats['teachers']} teachers in {cw_stats['blobs']} blobs "
+               f"({cw_stats['bytes'] / 1024 / 1024:.1f} MB), {cw_stats['deduplicated']} deduplicated uploads, "
+               f"{cw_stats['pruned']} versions pruned (keeping {courseware_store.keep_versions} per file)")
     st.markdown("---")
 
     # --- Manage Teachers (Unchanged) ---
@@ -807,32 +930,16 @@ def admin_route():
     # Data loading and preparation
     teachers_list = [];
     temp_teachers_db_for_edit = load_data(TEACHERS_DB_PATH);
-    needs_saving_defaults = False
-    for name, details in temp_teachers_db_for_edit.items():
-        print(temp_teachers_db_for_edit)
-        # if "id" not in details: details["id"] = generate_teacher_id(); needs_saving_defaults = True
-        if "is_active" not in details: details["is_active"] = True; needs_saving_defaults = True
-        if "enrollment_cap" not in details: details["enrollment_cap"] = None; needs_saving_defaults = True
-        if "description_en" not in details: details["description_en"] = ""; needs_saving_defaults = True
-        if "description_zh" not in details: details["description_zh"] = ""; needs_saving_defaults = True
-        if "rating" not in details: details["rating"] = None; needs_saving_defaults = True
-        if "allow_enroll" not in details: details["allow_enroll"] = True; needs_saving_defaults = True
-        if "rated" not in details: details["rated"] = []; needs_saving_defaults = True
-        if "timezone" not in details: details["timezone"]="";
-        print(details)
+    # Defaults are filled in once by models.migrate(), not on every load
+    for name, details in load_teachers().items():
         teachers_list.append(
-            {"Teacher ID": name, "Teacher Name": details["name"], "Subject (English)": details.get("subject_en", ""),
-             "Description (English)": details.get("description_en", ""),
-             "Description (Chinese)": details.get("description_zh", ""), "Grade": details.get("grade", ""),
-             "Timezone":details.get("timezone",""),
-             "Is Active": details.get("is_active"), "Rating": details.get("rating"),
-             "Allow Enroll": details.get("allow_enroll"),
-             "Enrollment Cap": details.get("enrollment_cap") if details.get("enrollment_cap") is not None else 0})
-
-    if needs_saving_defaults:
-        save_data(TEACHERS_DB_PATH, temp_teachers_db_for_edit);
-        teachers_database_global = temp_teachers_db_for_edit;
-        st.info("Applied defaults to teachers. Data saved.")
+            {"Teacher ID": name, "Teacher Name": details.name, "Subject (English)": details.subject_en,
+             "Description (English)": details.description_en,
+             "Description (Chinese)": details.description_zh, "Grade": details.grade,
+             "Timezone": details.timezone,
+             "Is Active": details.is_active, "Rating": "" if details.rating is None else str(details.rating),
+             "Allow Enroll": details.allow_enroll,
+             "Enrollment Cap": details.enrollment_cap if details.enrollment_cap is not None else 0})
     columns_teacher = ["Teacher ID", "Teacher Name", "Enrollment Cap", "Subject (English)", "Grade",
                        "Description (English)", "Description (Chinese)", "Rating",
                        "Timezone",
@@ -889,7 +996,7 @@ def admin_route():
                     cap_int = int(enrollment_cap_input); processed_cap = cap_int if cap_int > 0 else None
                 except (ValueError, TypeError):
                     st.error(f"Row {index + 1}: Invalid Cap."); error_occurred = True; continue
-            original_details = next((d for _, d in original_teachers_data.items() if d.get("id") == teacher_id), None);
+            original_details = original_teachers_data.get(teacher_id);
             current_is_active = original_details.get("is_active", True) if original_details else True
 
             desc_en = str(row["Description (English)"]).strip() if pd.notna(row["Description (English)"]) else "";
@@ -899,34 +1006,31 @@ def admin_route():
                 allow_enroll = True
             else:
                 allow_enroll = row["Allow Enroll"]
-            rtd = original_teachers_data.get("name", False)
-            if rtd:
-                rtd = original_teachers_data["name"]["rated"]
-            else:
-                rtd = ({})
             new_teachers_database[teacher_id] = {"name": name, "subject_en": str(row["Subject (English)"]) if pd.notna(
                 row["Subject (English)"]) else "", "grade": str(row["Grade"]) if pd.notna(row["Grade"]) else "",
                                                  "description_en": desc_en, "description_zh": desc_zh,
                                                  "is_active": current_is_active, "allow_enroll": allow_enroll,
-                                                 "enrollment_cap": processed_cap, "rated": rtd}
-        deleted_teacher_names = [n for n, d in original_teachers_data.items() if d.get("id") not in processed_ids]
+                                                 "enrollment_cap": processed_cap}
+        deleted_teacher_names = models.removed_teachers(original_teachers_data, processed_ids)
         if not error_occurred:
 
             save_data(TEACHERS_DB_PATH, new_teachers_database);
             teachers_database_global = new_teachers_database;
             st.success("Teacher data updated!")
             if deleted_teacher_names:
-                enrollments_updated = False;
                 current_enrollments = load_data(ENROLLMENTS_DB_PATH);
-                new_enrollments_after_delete = current_enrollments.copy()
+                removed_pairs = []
                 for removed_name in deleted_teacher_names:
-                    if removed_name in new_enrollments_after_delete:
-                        del new_enrollments_after_delete[removed_name]
-                        enrollments_updated = True
+                    if removed_name in current_enrollments:
+                        removed_pairs.extend((removed_name, s_id) for s_id in current_enrollments[removed_name])
                         st.warning(f"Removed enrollments: {removed_name}")
-                if enrollments_updated:
-                    save_data(ENROLLMENTS_DB_PATH,new_enrollments_after_delete)
-                    enrollments_global = new_enrollments_after_delete
+                    try:
+                        courseware_store.remove(removed_name)  # Blobs other teachers still link are kept
+                    except (OSError, ValueError) as e:
+                        st.warning(f"Could not remove courseware for {removed_name}: {e}")
+                if removed_pairs:
+                    cancel_many(removed_pairs)
+                    enrollments_global = load_data(ENROLLMENTS_DB_PATH)
             st.rerun()
 
         else:
@@ -938,18 +1042,13 @@ def admin_route():
     st.subheader(admin_lang["manage_students_header"])
     # ... (Student list preparation and editor display - unchanged) ...
     students_list = [];
-    temp_user_db_for_edit = load_data(USER_DB_PATH)
+    temp_user_db_for_edit = load_students()
     for user_id, user_info in temp_user_db_for_edit.items():
-        if isinstance(user_info, dict):
-            students_list.append(
-                {"Encrypted ID": user_id, "Name": user_info.get("name", ""), "Grade": user_info.get("grade", ""),
-                 "RAZ Level": user_info.get("raz_level", ""), "Country": user_info.get("country", ""),
-                 "State/Province": user_info.get("state", ""), "City": user_info.get("city", ""),
-                 "Time Zone": user_info.get("timezone", "")})
-        elif isinstance(user_info, str):
-            students_list.append(
-                {"Encrypted ID": user_id, "Name": user_info, "Grade": "", "RAZ Level": "", "Country": "",
-                 "State/Province": "", "City": "", "Time Zone": ""})
+        students_list.append(
+            {"Encrypted ID": user_id, "Name": user_info.name, "Grade": user_info.grade,
+             "RAZ Level": user_info.raz_level, "Country": user_info.country,
+             "State/Province": user_info.state, "City": user_info.city,
+             "Time Zone": user_info.timezone})
     students_df = pd.DataFrame(students_list) if students_list else pd.DataFrame(
         columns=["Encrypted ID", "Name", "Grade", "RAZ Level", "Country", "State/Province", "City"])
     edited_students_df = st.data_editor(students_df, num_rows="dynamic", key="student_editor", use_container_width=True,
@@ -965,6 +1064,24 @@ def admin_route():
                                                       "State/Province", "City", "Time Zone"])
     with st.expander("Time Zones:"):
         st.dataframe({"Time Zones": avtimezones})
+    with st.expander("Backfill Student Time Zones"):
+        st.caption("Fills in missing or unsupported time zones from each student's country/state/city "
+                   "and reports students whose location and time zone disagree.")
+        backfill_dry_run = st.checkbox("Dry run (report only)", value=True, key="backfill_dry_run")
+        if st.button("Run Backfill", key="run_backfill"):
+            try:
+                st.session_state.backfill_report = geo.backfill_locations(storage_backend, city_timezones,
+                                                                           avtimezones, dry_run=backfill_dry_run)
+                if st.session_state.backfill_report["written"]:
+                    st.rerun()  # Show the new time zones in the table above
+            except (ImportError, IOError, sqlite3.Error) as e:
+                st.error(f"Backfill failed: {e}")
+        report = st.session_state.get("backfill_report")
+        if report:
+            st.write(", ".join(f"{status}: {count}" for status, count in sorted(report["counts"].items())) +
+                     f" - wrote {report['written']} in {report['seconds']:.2f} s")
+            if report["issues"]:
+                st.dataframe(pd.DataFrame(report["issues"]), hide_index=True, use_container_width=True)
     # Handle saving changes for students
     if st.button(admin_lang["save_students_button"]):
         original_ids = set(students_df["Encrypted ID"])
@@ -972,8 +1089,7 @@ def admin_route():
         deleted_ids = original_ids - edited_ids  # These are the IDs to remove from enrollments
 
         user_db_before_del = temp_user_db_for_edit  # Get names for info message
-        deleted_student_names = {info.get("name", "") if isinstance(info, dict) else info for uid, info in
-                                 user_db_before_del.items() if uid in deleted_ids and info}
+        deleted_student_names = {user_db_before_del[uid].name for uid in deleted_ids if uid in user_db_before_del}
 
         new_user_database = {};
         error_occurred = False
@@ -1007,26 +1123,13 @@ def admin_route():
 
                 # --- Update enrollments: Remove deleted IDs ---
                 if deleted_ids:  # Only run if students were actually deleted
-                    enrollments_updated = False
-                    current_enrollments = load_data(ENROLLMENTS_DB_PATH)  # Load fresh
-                    new_enrollments = current_enrollments.copy()
-
-                    for teacher, student_id_list in current_enrollments.items():
-                        original_length = len(student_id_list)
-                        # Keep only IDs NOT in the deleted_ids set
-                        cleaned_id_list = [s_id for s_id in student_id_list if s_id not in deleted_ids]
-
-                        if len(cleaned_id_list) != original_length:
-                            enrollments_updated = True
-                            if cleaned_id_list:
-                                new_enrollments[teacher] = cleaned_id_list
-                            # Remove teacher key if list becomes empty
-                            elif teacher in new_enrollments:
-                                del new_enrollments[teacher]
-
-                    if enrollments_updated:
-                        save_data(ENROLLMENTS_DB_PATH, new_enrollments)
-                        enrollments_global = new_enrollments  # Update global state
+                    # Reverse index: only the rosters that actually hold a deleted ID are touched
+                    removed_pairs = [(teacher, s_id) for s_id in deleted_ids
+                                     for teacher in storage_backend.teachers_for_student(s_id)]
+
+                    if removed_pairs:
+                        cancel_many(removed_pairs)
+                        enrollments_global = load_data(ENROLLMENTS_DB_PATH)  # Update global state
                         st.info("Updated enrollments for deleted students.")
                         # Name change logic is removed as it's no longer needed
 
@@ -1043,7 +1146,7 @@ def admin_route():
 
     assignments_list_enriched = []
     current_enrollments = load_data(ENROLLMENTS_DB_PATH)  # Load fresh (contains IDs)
-    user_db_for_assignments = load_data(USER_DB_PATH)  # Load fresh user data
+    user_db_for_assignments = load_students()
 
     # Build the enriched list for the DataFrame
     for teacher, student_id_list in current_enrollments.items():
@@ -1052,17 +1155,15 @@ def admin_route():
 
             details = user_db_for_assignments.get(student_id)  # Lookup by ID
 
-            if isinstance(details, dict):  # Found details
-                student_name = details.get("name", f"Unknown ID: {student_id}")
-                location_str = f"{details.get('city', '')}, {details.get('state', '')}, {details.get('country', '')}".strip(
-                    ", ")
+            if details is not None:  # Found details
+                student_name = details.name or f"Unknown ID: {student_id}"
                 print(teacher)
                 assignments_list_enriched.append({
                     "Teacher": teachers_database_global[teacher]["name"],
                     "Student": student_name,  # Display name
-                    "Grade": details.get("grade", ""),
-                    admin_lang["raz_level_column"]: details.get("raz_level", ""),
-                    admin_lang["location_column"]: location_str if location_str != "," else "",
+                    "Grade": details.grade,
+                    admin_lang["raz_level_column"]: details.raz_level,
+                    admin_lang["location_column"]: details.location,
                     "_Student ID": student_id,
                     "_Teacher ID": teacher
                 })
@@ -1120,7 +1221,7 @@ def admin_route():
             print(selected_tid)
             enrolled_students = current_enrollments.get(selected_tid)
             if enrolled_students != None:
-                students1_df = students_df[~students_df["Encrypted ID"].isin(enrolled_students)]
+                students1_df = students_df[~students_df["Encrypted ID"].isin(list(enrolled_students))]
             else:
                 students1_df = students_df
         else:
@@ -1149,15 +1250,8 @@ def admin_route():
             else:
                 teacherr = teachers_df.loc[tevent.selection.rows[0], "Teacher ID"]
                 studentss = students_df.iloc[event.selection.rows]
-                enrmts = load_data(ENROLLMENTS_DB_PATH)
-
-                if enrmts.get(teacherr) == None:
-                    enrmts[teacherr] = tuple(studentss["Encrypted ID"][:])
-                else:
-                    enrmts[teacherr] += tuple(studentss["Encrypted ID"][:])
-                save_data(ENROLLMENTS_DB_PATH, enrmts)
+                enroll_many((teacherr, s_id) for s_id in studentss["Encrypted ID"])  # Already-enrolled IDs are skipped
                 st.rerun()
-                # enrmts[teacherr]=studentss["Encrypted ID"]
 
     with dele:
         st.write("1. Select Students to Un-enroll")
@@ -1180,14 +1274,12 @@ def admin_route():
 
             stid = list(assignments_df.loc[event.selection.rows, "_Student ID"])
             tcid = list(assignments_df.loc[event.selection.rows, "_Teacher ID"])
-            for teach, stud in zip(tcid, stid):
-                del current_enrollments[teach][[i for i, x in enumerate(current_enrollments[teach]) if x == stud][0]]
-            save_data(ENROLLMENTS_DB_PATH, current_enrollments)
+            cancel_many(zip(tcid, stid))
             st.rerun()
     st.markdown("---")
     st.subheader("Automated Batch Actions (Proceed with Caution)")
 
-    SWITCH = load_data(SWITCH_DB_PATH)
+    SWITCH = dict(load_data(SWITCH_DB_PATH))  # Our copy to edit: the loaded dict is shared by every session
 
     infos = ""
     dtf = []
@@ -1374,7 +1466,50 @@ def admin_route():
             SWITCH["Open Enrollment Delay"]=str(time_delta)
             print(SWITCH)
             save_data(SWITCH_DB_PATH, SWITCH)
+            schedule_executor.wake()  # Sync flags to the new schedule right away
             st.rerun()
+
+    # Upcoming cycles: the saved schedule repeated every (ratings close + interval - enrollment opens)
+    recurrence = enroll_schedule.Recurrence(SWITCH)
+    upcoming_cycles = recurrence.upcoming(datetime.datetime.now(datetime.timezone.utc))
+    if upcoming_cycles:
+        st.write("Upcoming Cycles:")
+        st.dataframe(pd.DataFrame([{
+            "Cycle": c.key,
+            **{key: c.instants[i].astimezone(st.session_state.timezone_admin).strftime("%Y-%m-%d %H:%M")
+               for i, key in enumerate(enroll_schedule.DATE_KEYS)},
+            "Status": "Skipped" if c.skipped else "Overridden" if c.overridden else "Scheduled",
+        } for c in upcoming_cycles]), hide_index=True, use_container_width=True)
+
+        with st.expander("Override One Cycle"):
+            cycle_keys = [c.key for c in upcoming_cycles]
+            override_key = st.selectbox("Cycle (scheduled opening, UTC)", cycle_keys, key="override_cycle")
+            chosen = upcoming_cycles[cycle_keys.index(override_key)]
+            override_values = [st.text_input(f"{key} (UTC, YYYY-MM-DD HH:MM)", value=enroll_schedule.format_instant(instant),
+                                             key=f"override_{key}_{override_key}")
+                               for key, instant in zip(enroll_schedule.DATE_KEYS, chosen.instants)]
+            ocol1, ocol2, ocol3 = st.columns(3)
+            try:
+                if ocol1.button("Save Override", key="save_override"):
+                    instants = [enroll_schedule.parse_instant(value.strip()) for value in override_values]
+                    if None in instants:
+                        raise ValueError("Enter every date as YYYY-MM-DD HH:MM")
+                    save_data(SWITCH_DB_PATH, enroll_schedule.with_override(SWITCH, override_key, instants))
+                elif ocol2.button("Skip This Cycle", key="skip_cycle"):
+                    save_data(SWITCH_DB_PATH, enroll_schedule.with_override(SWITCH, override_key, skip=True))
+                elif ocol3.button("Restore Schedule", key="clear_override", disabled=not chosen.overridden):
+                    save_data(SWITCH_DB_PATH, enroll_schedule.with_override(SWITCH, override_key))
+                else:
+                    override_key = None
+                if override_key:
+                    schedule_executor.wake()
+                    st.rerun()
+            except ValueError as e:
+                st.error(str(e))
+    if schedule_executor.history:
+        with st.expander("Schedule Log"):
+            st.dataframe(pd.DataFrame(list(schedule_executor.history)[::-1]), hide_index=True,
+                         use_container_width=True)
     st.markdown("---")
 
     st.subheader("Manual Batch Actions (Proceed with Caution)")
@@ -1382,7 +1517,6 @@ def admin_route():
     all_rate = SWITCH["rating"]
     all_hidden = SWITCH["all_hidden"]
     all_closed = SWITCH["all_closed"]
-    teaches = load_data(TEACHERS_DB_PATH)
     if all_hidden:
         st.info("All Classes set to Hidden")
         hide_all_classes = st.button("Show All Classes", key="hide_all")
@@ -1402,30 +1536,15 @@ def admin_route():
         st.info("Ratings Closed for All")
         rate_all = st.button("Enable Rating for All Student", key="rate_all")
 
+    # Global switches are layered over each teacher's own flags at read time (see load_availability)
     if hide_all_classes:
-        if all_hidden:
-            SWITCH["all_hidden"] = False
-            for info in teaches:
-                teaches[info]["is_active"] = True
-        else:
-            SWITCH["all_hidden"] = True
-            for info in teaches:
-                teaches[info]["is_active"] = False
-        save_data(TEACHERS_DB_PATH, teaches)
+        SWITCH["all_hidden"] = not all_hidden
         save_data(SWITCH_DB_PATH, SWITCH)
         st.rerun()
 
     if close_all_enroll:
 
-        if all_closed:
-            SWITCH["all_closed"] = False
-            for info in teaches:
-                teaches[info]["allow_enroll"] = True
-        else:
-            SWITCH["all_closed"] = True
-            for info in teaches:
-                teaches[info]["allow_enroll"] = False
-        save_data(TEACHERS_DB_PATH, teaches)
+        SWITCH["all_closed"] = not all_closed
         save_data(SWITCH_DB_PATH, SWITCH)
         print(SWITCH)
         st.rerun()
@@ -1439,6 +1558,9 @@ def admin_route():
 
         else:
             SWITCH["rating"] = True
+            # Ratings given outside a scheduled window are kept under this opening
+            SWITCH[enroll_schedule.MANUAL_RATINGS_KEY] = enroll_schedule.format_instant(
+                datetime.datetime.now(datetime.timezone.utc))
         save_data(SWITCH_DB_PATH, SWITCH)
         st.rerun()
 
@@ -1475,44 +1597,6 @@ def teacher_login_page():
                 st.rerun()
             else:
                 st.error("Invalid Teacher ID.")
-def sanitize_user_id_for_folder(user_id):
-    """Sanitizes the user ID to create a safe folder name."""
-    if not user_id:
-        return ""
-    # This sanitization MUST be identical to the one in your uploader app
-    safe_name = "".join(c for c in user_id if c.isalnum() or c in ('_', '-')).rstrip()
-    return safe_name
-def find_user_file(user_id):
-    """
-    Finds the uploaded file for a given user_id.
-    Returns (file_path, filename, error_message).
-    """
-    if not user_id:
-        return None, None, "User ID cannot be empty."
-
-    safe_user_folder_name = sanitize_user_id_for_folder(user_id)
-    if not safe_user_folder_name:
-        return None, None, "User ID resulted in an invalid folder name."
-
-    user_specific_dir = os.path.join(BASE_UPLOAD_DIRECTORY, safe_user_folder_name)
-
-    if not os.path.exists(user_specific_dir) or not os.path.isdir(user_specific_dir):
-        return None, None, f"No uploads found for User ID '{user_id}'. Directory does not exist."
-
-    # List files in the user's directory
-    try:
-        files_in_dir = [f for f in os.listdir(user_specific_dir) if os.path.isfile(os.path.join(user_specific_dir, f))]
-    except Exception as e:
-        return None, None, f"Error accessing directory for User ID '{user_id}': {e}"
-
-    if not files_in_dir:
-        return None, None, f"No file found in the directory for User ID '{user_id}'."
-
-    # Assuming only one file per user as per previous uploader logic
-    filename = files_in_dir[0]
-    file_path = os.path.join(user_specific_dir, filename)
-
-    return file_path, filename, None
 def teacher_register():
     lang=texts["English"]
     registration_successful = st.session_state.get("teacher_registration_done", False)  # Flag
@@ -1533,16 +1617,7 @@ def teacher_register():
 
             if latitude is not None and longitude is not None:
 
-                # Initialize TimezoneFinder
-                # This object can be computationally expensive to create,
-                # so for performance in a real app, you might consider caching it
-                # or creating it once at the start of the script if not using Streamlit's rerun magic.
-                # However, for this simple case, direct initialization is fine.
-                tf = TimezoneFinder()
-
-                # Get the timezone string
-                # Note: timezone_at() expects longitude first, then latitude
-                timezone_str = tf.timezone_at(lng=longitude, lat=latitude)
+                timezone_str = timezone_service.timezone_at(latitude, longitude)
 
                 if timezone_str:
                     if "timezone_teach" not in st.session_state:
@@ -1558,7 +1633,6 @@ def teacher_register():
         #st.write(f"Using `st.query_params`: Current `eid` = `{current_eid_from_new_api}`")
         #st.write(f"All params (new API): `{params.to_dict()}`")
         if st.button(lang["register_button"], key="register_btnt"):
-            teach_datab=load_data(TEACHERS_DB_PATH)
             if new_teach_name.strip() and new_teach_grade and new_teach_course:
                 teach_data_to_save = {"name": new_teach_name,
                                         "subject_en": new_teach_course,
@@ -1568,12 +1642,10 @@ def teacher_register():
                                         "is_active": True,
                                         "allow_enroll": True,
                                         "enrollment_cap": None,
-                                        "rated": {},
                                         "rating": None,
                                         "timezone": selected_zone}
                 ntid=generate_teacher_id()
-                teach_datab[ntid] = teach_data_to_save
-                save_data(TEACHERS_DB_PATH, teach_datab)
+                update_teacher(ntid, **teach_data_to_save)
                 st.session_state.teacher_registration_done = True
                 st.session_state.new_teacher_id = ntid  # Store ntid if needed later
                 cookies["teach_code"]=ntid
@@ -1630,8 +1702,9 @@ else:
 
 
     # Load necessary data
-    user_database = load_data(USER_DB_PATH)
-    teachers_database = load_data(TEACHERS_DB_PATH)
+    user_database = load_students()  # {student_id: models.Student}
+    teachers_database = load_teachers()  # {teacher_id: models.Teacher}
+    availability = load_availability()  # {teacher_id: models.Availability}
     enrollments = load_data(ENROLLMENTS_DB_PATH)  # Contains {teacher: [student_id,...]}
 
     # --- REGISTRATION Section (Unchanged) ---
@@ -1651,9 +1724,13 @@ else:
 
             if latitude is not None and longitude is not None:
 
-                # --- Timezone ---
-                tf = TimezoneFinder()
-                timezone_str = tf.timezone_at(lng=longitude, lat=latitude)
+                # --- Timezone and place (cached for nearby coordinates) ---
+                try:
+                    location = location_resolver.resolve(latitude, longitude)
+                except Exception as e:
+                    location = None
+                    st.error(f"Error during reverse geocoding with reverse_geocoder: {e}")
+                timezone_str = location.timezone if location else None
                 if timezone_str:
                     try:
                         user_timezone = pytz.timezone(timezone_str)
@@ -1664,42 +1741,10 @@ else:
                     st.warning("Could not determine the timezone for the given coordinates.")
 
                 try:
-                    results = rg.search((latitude, longitude))  # Returns a list of ordered dicts
-                    if results:
-
-                        location_info = results[0]
-                        city = location_info.get('name')
-                        country_code = location_info.get('cc')
-                        state_province = location_info.get('admin1')  # e.g., State in US, Province in Canada
-
-                        country_name = "Unknown"
-                        if country_code:
-                            try:
-                                country_obj = pycountry.countries.get(alpha_2=country_code)
-                                if country_obj:
-                                    country_name = country_obj.name
-                            except Exception as e:
-                                st.warning(f"Could not convert country code '{country_code}' to name: {e}")
-
-                        country_options = [lang["select_country"],country_name] + sorted(location_data.keys());
-                        selected_country = st.selectbox(lang["register_country_label"], options=country_options,
-                                                        key="reg_country",
-                                                        index=1)
-                        state_options = [lang["select_state"],state_province];
-                        if selected_country != lang[
-                            "select_country"] and selected_country in location_data: state_options.extend(
-                            sorted(location_data[selected_country].keys()))
-                        selected_state = st.selectbox(lang["register_state_label"], options=state_options,
-                                                      key="reg_state", index=1,
-                                                      disabled=(selected_country == lang["select_country"]), )
-                        city_options = [lang["select_city"], city];
-                        if selected_state != lang[
-                            "select_state"] and selected_country in location_data and selected_state in \
-                                location_data[selected_country]: city_options.extend(
-                            sorted(location_data[selected_country][selected_state]))
-                        selected_city = st.selectbox(lang["register_city_label"], options=city_options, key="reg_city",
-                                                     index=1,
-                                                     disabled=(selected_state == lang["select_state"]))
+                    if location:
+                        # Country, state (admin1, e.g. State in US, Province in Canada) and city preselected
+                        selected_country, selected_state, selected_city = location_selectboxes(
+                            lang, selected_language, detected=location)
                         print(timezone_str)
                         timzs=[None,timezone_str] + avtimezones
                         print(timzs)
@@ -1713,21 +1758,15 @@ else:
 
             else:
 
-                country_options = [lang["select_country"]] + sorted(location_data.keys());
-                selected_country = st.selectbox(lang["register_country_label"], options=country_options, key="reg_country",
-                                                index=0)
-                state_options = [lang["select_state"]];
-                if selected_country != lang["select_country"] and selected_country in location_data: state_options.extend(
-                    sorted(location_data[selected_country].keys()))
-                selected_state = st.selectbox(lang["register_state_label"], options=state_options, key="reg_state", index=0,
-                                              disabled=(selected_country == lang["select_country"]),)
-                city_options = [lang["select_city"]];
-                if selected_state != lang["select_state"] and selected_country in location_data and selected_state in \
-                        location_data[selected_country]: city_options.extend(
-                    sorted(location_data[selected_country][selected_state]))
-                selected_city = st.selectbox(lang["register_city_label"], options=city_options, key="reg_city", index=0,
-                                             disabled=(selected_state == lang["select_state"]))
-                selected_zone = st.selectbox(lang["selectzone"], options=[None] + avtimezones, key="timezone")
+                selected_country, selected_state, selected_city = location_selectboxes(lang, selected_language)
+                guessed_zone = None
+                if selected_city != lang["select_city"]:
+                    guessed_zone = get_timezone_from_location_name(selected_country, selected_city, selected_state)
+                if guessed_zone in avtimezones:
+                    selected_zone = st.selectbox(lang["selectzone"], options=[None, guessed_zone] + avtimezones,
+                                                 key="timezone", index=1)
+                else:
+                    selected_zone = st.selectbox(lang["selectzone"], options=[None] + avtimezones, key="timezone")
         st.markdown("---")
         if st.button(lang["register_button"], key="register_btn"):
             print(selected_zone, selected_country, selected_state, selected_city)
@@ -1737,9 +1776,8 @@ else:
                 user_data_to_save = {"name": new_user_name.strip(), "grade": new_user_grade.strip(),
                                      "raz_level": new_user_raz.strip(), "country": selected_country,
                                      "state": selected_state, "city": selected_city, "timezone": selected_zone}
-                user_database[secure_id] = user_data_to_save
-                save_data(USER_DB_PATH, user_database);
-                user_database_global = user_database
+                update_student(secure_id, **user_data_to_save);
+                user_database_global = load_data(USER_DB_PATH)
                 cookies["stud_code"]=secure_id
                 st.success(lang["registered_success"].format(name=new_user_name.strip()));
                 st.balloons();
@@ -1749,100 +1787,35 @@ else:
                 st.error(lang["fill_all_fields"])
         st.stop()
 
-    enrinfo = broadcasted_info.get("Open Enrollment", False)
-    enrinfo1 = broadcasted_info.get("Close Enrollment", False)
-    ratinfo = broadcasted_info.get("Open Ratings", False)
-    ratinfo1 = broadcasted_info.get("Close Ratings", False)
     if user_database.get(secure_id):
-        usrcnt = user_database[secure_id]["timezone"]
+        usrcnt = user_database[secure_id].timezone or "UTC"
     else:
         usrcnt= "UTC"
-    enrange = broadcasted_info.get("Open Enrollment Date")
-    enrange1 = broadcasted_info.get("Close Enrollment Date")
-    ratrange = broadcasted_info.get("Open Ratings Date")
-    ratrange1 = broadcasted_info.get("Close Ratings Date")
-    dely = broadcasted_info.get("Open Enrollment Delay")
-    if enrange and enrange1:
-        source_dt = datetime.datetime.now().replace(tzinfo=ZoneInfo("UTC"))
-        converted_dt = source_dt.astimezone(ZoneInfo(usrcnt))
-        enrange = datetime.datetime.strptime(enrange, "%Y-%m-%d %H:%M").replace(tzinfo=ZoneInfo("UTC")).astimezone(ZoneInfo(usrcnt))
-        enrange1 = datetime.datetime.strptime(enrange1, "%Y-%m-%d %H:%M").replace(tzinfo=ZoneInfo("UTC")).astimezone(ZoneInfo(usrcnt))
-        intime = enrange <= converted_dt <= enrange1
-
-        if broadcasted_info["all_closed"] and intime:
-            print("wh")
-            broadcasted_info["all_closed"] = False
-            for info in teachers_database_global:
-                teachers_database_global[info]["allow_enroll"] = True
-            save_data(SWITCH_DB_PATH, broadcasted_info)
-            save_data(TEACHERS_DB_PATH, teachers_database_global)
-
-            st.rerun()
-
-        elif (not broadcasted_info["all_closed"]) and (not intime):
-            broadcasted_info["all_closed"] = True
-            print("wh1")
-            for info in teachers_database_global:
-                teachers_database_global[info]["allow_enroll"] = False
-            save_data(SWITCH_DB_PATH, broadcasted_info)
-            save_data(TEACHERS_DB_PATH, teachers_database_global)
-            st.rerun()
-    if ratrange and ratrange1:
-        source_dt = datetime.datetime.now().replace(tzinfo=ZoneInfo("UTC"))
-        converted_dt = source_dt.astimezone(ZoneInfo(usrcnt))
-        ratrange = datetime.datetime.strptime(ratrange, "%Y-%m-%d %H:%M").replace(tzinfo=ZoneInfo("UTC")).astimezone(ZoneInfo(usrcnt))
-        ratrange1 = datetime.datetime.strptime(ratrange1, "%Y-%m-%d %H:%M").replace(tzinfo=ZoneInfo("UTC")).astimezone(ZoneInfo(usrcnt))
-        intime = ratrange <= converted_dt <= ratrange1
-        print(ratrange,ratrange1)
-        if (not broadcasted_info["rating"]) and intime:
-            print("wh")
-            broadcasted_info["rating"] = True
-            save_data(SWITCH_DB_PATH, broadcasted_info)
-            st.rerun()
-
-        elif (broadcasted_info["rating"]) and not intime:
-            print("w1h")
-            broadcasted_info["rating"] = False
-            save_data(SWITCH_DB_PATH, broadcasted_info)
-            st.rerun()
-    if enrange and ratrange1 and dely:
-        source_dt = datetime.datetime.now().replace(tzinfo=ZoneInfo("UTC"))
-        converted_dt = source_dt.astimezone(ZoneInfo(usrcnt))
-        inwtime = enrange <= converted_dt <= ratrange1
-        outwtime = converted_dt >= ratrange1+string_to_delta(dely)
-        if not inwtime and outwtime:
-            ste = converted_dt
-            ende = ste+(enrange1-enrange)
-            ord1 = ende+(ratrange-enrange1)
-            cr = ord1+(ratrange1-ratrange)
-            broadcasted_info["Open Enrollment Date"]=ste.astimezone(ZoneInfo("UTC")).strftime("%Y-%m-%d %H:%M")
-            broadcasted_info["Close Enrollment Date"] = ende.astimezone(ZoneInfo("UTC")).strftime("%Y-%m-%d %H:%M")
-            broadcasted_info["Open Ratings Date"] = ord1.astimezone(ZoneInfo("UTC")).strftime("%Y-%m-%d %H:%M")
-            broadcasted_info["Close Ratings Date"] = cr.astimezone(ZoneInfo("UTC")).strftime("%Y-%m-%d %H:%M")
-            save_data(SWITCH_DB_PATH, broadcasted_info)
-            st.rerun()
-
+    # Schedule transitions are applied by schedule_executor in the background; renders only read them
+    upcoming = enroll_schedule.get_timeline(storage_backend).next_transition(datetime.datetime.now(datetime.timezone.utc))
+    if upcoming and f"schedule_{upcoming[1]}" in lang:
+        st.sidebar.caption(lang[f"schedule_{upcoming[1]}"].format(
+            time=upcoming[0].astimezone(ZoneInfo(usrcnt)).strftime("%Y-%m-%d %H:%M")))
 
     # --- MAIN ENROLLMENT Section ---
     user_info = user_database.get(secure_id)  # Get current user's details
-    if isinstance(user_info, dict):
-        user_name = user_info.get("name", f"Unknown ({secure_id})")  # Display name but use ID internally
-    # Handle old format if necessary, though less likely now
-    elif isinstance(user_info, str):
-        user_name = f"{user_info} ({secure_id})"
+    if user_info is not None:
+        user_name = user_info.name or f"Unknown ({secure_id})"  # Display name but use ID internally
     else:
         user_name = f"Unknown ({secure_id})"; st.sidebar.error("User data error.")
 
     # ... (Sidebar display - unchanged) ...
     st.sidebar.write(lang["logged_in"].format(name=user_name))  # Display name
-    if isinstance(user_info, dict):
-        c, s, ci, gr, rz = user_info.get("country"), user_info.get("state"), user_info.get("city"), user_info.get(
-            "grade"), user_info.get("raz_level")
+    if user_info is not None:
+        c, s, ci, gr, rz = user_info.country, user_info.state, user_info.city, user_info.grade, user_info.raz_level
         loc_str = f"{ci}, {s}, {c}" if c and s and ci else "";
         details_str = f"Grade: {gr}" if gr else "";
         if rz: details_str += f" | RAZ: {rz}"
         if loc_str: st.sidebar.caption(loc_str);
         if details_str: st.sidebar.caption(details_str)
+    my_teacher_ids = storage_backend.teachers_for_student(secure_id)  # Reverse index: O(my classes)
+    my_class_names = sorted(teachers_database[t].name or t for t in my_teacher_ids if t in teachers_database)
+    if my_class_names: st.sidebar.caption(lang["my_classes"].format(names=", ".join(my_class_names)))
     SWITCH = load_data(SWITCH_DB_PATH)
     all_rate = SWITCH["rating"]
     if not all_rate:
@@ -1859,10 +1832,9 @@ else:
 
         active_teachers = {}
         for n, i in teachers_database.items():
-            if i.get("is_active", True):
+            if n in availability and availability[n].visible:
                 active_teachers[n] = i
-        unique_grades = sorted(list(
-            {str(i.get("grade", "")).strip() for i in active_teachers.values() if str(i.get("grade", "")).strip()}))
+        unique_grades = sorted({i.grade for i in active_teachers.values() if i.grade})
 
         grade_options = [lang["all_grades"]] + unique_grades
         with col_grade_filter:
@@ -1875,11 +1847,13 @@ else:
 
                 name_match = (not term) or (term in n.lower())
 
-                grade_match = (selected_grade_filter == lang["all_grades"]) or (
-                            str(i.get("grade", "")).strip() == selected_grade_filter)
+                grade_match = (selected_grade_filter == lang["all_grades"]) or (i.grade == selected_grade_filter)
 
                 if name_match and grade_match:
                     filtered_teachers[n] = i
+        # Rerun when enrollment opens/closes or a teacher in this grade is shown, hidden, opened or closed
+        live_subscribe(n for n, i in teachers_database.items()
+                       if selected_grade_filter == lang["all_grades"] or i.grade == selected_grade_filter)
 
         st.markdown("---")
 
@@ -1892,28 +1866,27 @@ else:
 
             for teacher_name, teacher_info in filtered_teachers.items():
 
-                st.subheader(teachers_database[teacher_name]["name"])
+                st.subheader(teacher_info.name)
 
                 # ... (Class Status display and buttons - unch
                 # ... (Display Subject/Grade/Description - unchanged) ...
-                subject_en = teacher_info.get("subject_en", "N/A");
+                subject_en = teacher_info.subject_en or "N/A";
                 display_subject = subject_en
-                grade = teacher_info.get("grade", "N/A");
+                grade = teacher_info.grade or "N/A";
                 desc_parts = [];
                 if display_subject != "N/A": desc_parts.append(f"**{display_subject}**")
                 if grade != "N/A": desc_parts.append(f"({lang['to_grade']} **{grade}**)")
                 st.write(f"{lang['teaches']} {' '.join(desc_parts)}" if desc_parts else f"({lang['teaches']} N/A)")
-                desc_en = teacher_info.get("description_en", "");
-                desc_zh = teacher_info.get("description_zh", "");
+                desc_en = teacher_info.description_en;
+                desc_zh = teacher_info.description_zh;
                 display_desc = desc_zh if selected_language == "中文" and desc_zh else desc_en
                 if display_desc:
                     st.markdown(f"> _{display_desc}_")
                 else:
                     st.caption(f"_{lang['no_description_available']}_")
-                ratt = teacher_info.get("rating", None)
-                if (ratt != None and ratt.isdigit() and int(ratt) >= 0):
-                    st_star_rating(label=lang["class_rating"], maxValue=5,
-                                   defaultValue=int(teacher_info.get("rating", "0")), read_only=True)
+                ratt = teacher_info.rating
+                if ratt is not None and ratt >= 0:
+                    st_star_rating(label=lang["class_rating"], maxValue=5, defaultValue=ratt, read_only=True)
                 else:
                     st.subheader(lang["class_rating"])
                     st.info(lang["class_no_rating"])
@@ -1921,14 +1894,14 @@ else:
 
                 current_teacher_enrollment_ids = enrollments.get(teacher_name, [])  # Get list of IDs
                 count = len(current_teacher_enrollment_ids)
-                cap = teacher_info.get("enrollment_cap");
+                cap = teacher_info.enrollment_cap;
                 cap_text = lang["unlimited"] if cap is None else str(cap)
                 is_full = False if cap is None else count >= cap
 
                 # Check enrollment based on the current user's secure_id
 
                 is_enrolled = secure_id in current_teacher_enrollment_ids
-                all_enr = teacher_info.get("allow_enroll")
+                all_enr = availability[teacher_name].enrollable
                 st.caption(lang["user_enrollment_caption"].format(count=count, cap=cap_text))
                 col1, col2 = st.columns(2)
                 if not all_enr:
@@ -1940,7 +1913,7 @@ else:
                     elif is_enrolled:
                         enroll_label = lang["enroll_button"]
 
-                    enroll_disabled = is_enrolled or is_full or SWITCH["all_closed"]
+                    enroll_disabled = is_enrolled or is_full or not all_enr
                     enroll_clicked = st.button(enroll_label, key=f"enroll_{teacher_name}_{secure_id}",
                                                disabled=enroll_disabled, use_container_width=True)  # Key uses secure_id
                 with col2:
@@ -1954,27 +1927,26 @@ else:
                 all_r = SWITCH["rating"]
                 # --- Button Actions (Using secure_id) ---
                 if enroll_clicked:
-                    if all_c or all_h or all_r:
+                    now_available = load_availability().get(teacher_name)
+                    if all_c or all_h or all_r or not (now_available and now_available.enrollable):
                         print("wh")
                         st.rerun()
-                    # Re-check conditions on click, use secure_id
-                    enrollments_now = load_data(ENROLLMENTS_DB_PATH)  # Load fresh
-                    print(f"huh:{teacher_name}")
-                    teacher_id_list_now = enrollments_now.get(teacher_name, [])
-                    teacher_info_now = load_data(TEACHERS_DB_PATH).get(teacher_name, {})
-                    cap_now = teacher_info_now.get("enrollment_cap")
-                    is_full_now = False if cap_now is None else len(teacher_id_list_now) >= cap_now
-
-                    if secure_id not in teacher_id_list_now and not is_full_now:
-                        teacher_id_list_now.append(secure_id)  # <-- Add secure_id
-                        enrollments_now[teacher_name] = teacher_id_list_now
-                        save_data(ENROLLMENTS_DB_PATH, enrollments_now)
-
-                        enrollments_global = enrollments_now  # Update global state if needed
+                    # Re-check conditions on click: the seat inventory enforces the cap atomically
+                    teacher_info_now = load_teachers().get(teacher_name, teacher_info)
+                    cap_now = teacher_info_now.enrollment_cap
+                    outcome = enroll_student(teacher_name, secure_id, cap_now)  # <-- Add secure_id
+
+                    if outcome == seats.GRANTED:
+                        enrollments_global = load_data(ENROLLMENTS_DB_PATH)  # Update global state if needed
                         st.success(lang["enroll_success"].format(name=user_name,
-                                                                 teacher=teachers_database[teacher_name]["name"]))
+                                                                 teacher=teacher_info.name))
                         st.rerun()
-                    # No explicit else needed for already enrolled/full, button is disabled
+                    elif outcome == seats.FULL:
+                        st.warning(lang["enrollment_full"])
+                    elif outcome == seats.ALREADY_ENROLLED:
+                        st.warning(lang["already_enrolled_warning"])
+                    elif outcome == seats.CONFLICT:
+                        st.rerun()  # Lost every race during a rush; show the fresh counts
 
                 if cancel_clicked:
 
@@ -1983,15 +1955,8 @@ else:
                         st.rerun()
 
                     # Use secure_id for removal
-                    enrollments_now = load_data(ENROLLMENTS_DB_PATH)  # Load fresh
-
-                    if teacher_name in enrollments_now and secure_id in enrollments_now[teacher_name]:
-
-                        enrollments_now[teacher_name].remove(secure_id)  # <-- Remove secure_id
-                        if not enrollments_now[teacher_name]:  # Remove teacher key if list empty
-                            del enrollments_now[teacher_name]
-                        save_data(ENROLLMENTS_DB_PATH, enrollments_now)
-                        enrollments_global = enrollments_now  # Update global state if needed
+                    if cancel_enrollment(teacher_name, secure_id):  # <-- Remove secure_id (drops empty rosters)
+                        enrollments_global = load_data(ENROLLMENTS_DB_PATH)  # Update global state if needed
                         st.info(lang["enrollment_cancelled"])
                         st.rerun()
                     # No explicit else needed, button disabled if not enrolled
@@ -2004,10 +1969,8 @@ else:
                         for s_id in current_teacher_enrollment_ids:
                             s_info = user_database.get(s_id)  # Use already loaded user_database
                             s_name_display = f"Unknown ID ({s_id})"  # Default
-                            if isinstance(s_info, dict):
-                                s_name_display = s_info.get("name", s_name_display)
-                            elif isinstance(s_info, str):  # Old format
-                                s_name_display = f"{s_info} ({s_id})"
+                            if s_info is not None and s_info.name:
+                                s_name_display = s_info.name
 
                             # Highlight the current user
                             if s_id == secure_id:
@@ -2019,28 +1982,12 @@ else:
                             st.markdown(f"{i}. {name_to_show}")
                     else:
                         st.write(lang["no_enrollments"])
-                file_path, filename, error = find_user_file(teacher_name)
-                if error:
-                    st.info("No Courseware For this Teacher")
-                elif file_path and filename:
-                    with open(file_path, "rb") as fp:
-                        file_bytes = fp.read()
-
-                    # Guess MIME type
-                    mime_type, _ = mimetypes.guess_type(file_path)
-                    if mime_type is None:
-                        mime_type = "application/octet-stream"  # Default if unknown
-                    st.download_button(
-                        label=f"Download Courseware",
-                        data=file_bytes,
-                        file_name=filename,
-                        mime=mime_type,
-                        key=f"download_btn_{filename}"
-                    )
+                courseware_download(teacher_name)
                 st.markdown("---")  # Separator between teachers
     else:
         st.title(lang["page_title_rate"])
         if st.sidebar.button(lang["refresh"]): st.rerun()
+        live_subscribe()  # Rerun when ratings close
         # --- Teacher Search and Filter (Unchanged) ---
         # ... (Search/Filter logic remains the same) ...
         st.subheader(lang["teacher_search_label"]);
@@ -2048,14 +1995,11 @@ else:
         with col_search:
             teacher_filter = st.text_input(lang["teacher_search_label"], key="teacher_filter",
                                            label_visibility="collapsed")
-        active_teachers1 = {n: i for n, i in teachers_database.items() if i.get("is_active", True)}
         active_teachers = {}
-        for n in active_teachers1:
-            print(n)
-            if enrollments.get(n, False) and (secure_id in enrollments[n]):
-                active_teachers[n] = active_teachers1[n]
-        unique_grades = sorted(list(
-            {str(i.get("grade", "")).strip() for i in active_teachers.values() if str(i.get("grade", "")).strip()}))
+        for n in sorted(my_teacher_ids, key=lambda t: teachers_database[t].name if t in teachers_database else ""):
+            if n in teachers_database and n in availability and availability[n].visible:
+                active_teachers[n] = teachers_database[n]
+        unique_grades = sorted({i.grade for i in active_teachers.values() if i.grade})
         grade_options = [lang["all_grades"]] + unique_grades
         with col_grade_filter:
             selected_grade_filter = st.selectbox(lang["grade_select_label"], options=grade_options, key="grade_select")
@@ -2064,13 +2008,14 @@ else:
             term = teacher_filter.strip().lower()
             for n, i in active_teachers.items():
                 name_match = (not term) or (term in n.lower())
-                grade_match = (selected_grade_filter == lang["all_grades"]) or (
-                            str(i.get("grade", "")).strip() == selected_grade_filter);
+                grade_match = (selected_grade_filter == lang["all_grades"]) or (i.grade == selected_grade_filter)
 
                 if name_match and grade_match:
                     filtered_teachers[n] = i
         st.markdown("---")
 
+        my_ratings = storage_backend.ratings_for_student(secure_id)  # {teacher_id: {period: entry}}
+
         # --- Display Teachers (Using secure_id for checks/actions) ---
         if not active_teachers:
             st.warning(lang["no_teachers_rating_available"])
@@ -2080,26 +2025,25 @@ else:
 
             for teacher_name, teacher_info in filtered_teachers.items():
 
-                st.subheader(teachers_database[teacher_name]["name"])
+                st.subheader(teacher_info.name)
 
                 # ... (Class Status display and buttons - unch
                 # ... (Display Subject/Grade/Description - unchanged) ...
-                subject_en = teacher_info.get("subject_en", "N/A");
+                subject_en = teacher_info.subject_en or "N/A";
                 display_subject = subject_en
 
-                grade = teacher_info.get("grade", "N/A");
+                grade = teacher_info.grade or "N/A";
                 desc_parts = [];
                 if display_subject != "N/A": desc_parts.append(f"**{display_subject}**")
                 if grade != "N/A": desc_parts.append(f"({lang['to_grade']} **{grade}**)")
                 st.write(f"{lang['teaches']} {' '.join(desc_parts)}" if desc_parts else f"({lang['teaches']} N/A)")
-                desc_en = teacher_info.get("description_en", "");
-                desc_zh = teacher_info.get("description_zh", "");
+                desc_en = teacher_info.description_en;
+                desc_zh = teacher_info.description_zh;
                 display_desc = desc_zh if selected_language == "中文" and desc_zh else desc_en
                 if display_desc:
                     st.markdown(f"> _{display_desc}_")
                 else:
                     st.caption(f"_{lang['no_description_available']}_")
-                ratt = teacher_info.get("rating", None)
                 with st.form(teacher_name):
                     SWITCH = load_data(SWITCH_DB_PATH)
                     all_c = SWITCH["all_closed"]
@@ -2111,18 +2055,19 @@ else:
                     # Convert to the target time zone
                     converted_dt = source_dt.astimezone(ZoneInfo(usrcnt))  # Example: Asia/Shanghai
                     datet = converted_dt.strftime('%Y-%m-%d %H:%M:%S')
-                    if (secure_id in teachers_database[teacher_name]["rated"].keys()):
+                    if (teacher_name in my_ratings):
                         st.success(lang["RATED"].format(time=datet))
-                        dfv = teachers_database[teacher_name]["rated"][secure_id][-1]["stars"]
-                        dfv_txt = teachers_database[teacher_name]["rated"][secure_id][-1]["feedback"]
+                        latest = models.RatingEntry.from_dict(list(my_ratings[teacher_name].values())[-1])
+                        dfv = latest.stars
+                        dfv_txt = latest.feedback
                     else:
                         dfv_txt = ""
                         dfv = 0
                     rating = st_star_rating(
-                        label=lang["rate_class"].format(name=teachers_database[teacher_name]["name"]), maxValue=5,
+                        label=lang["rate_class"].format(name=teacher_info.name), maxValue=5,
                         defaultValue=dfv, read_only=False)
 
-                    txt = st.text_area(lang["explanation"].format(name=teachers_database[teacher_name]["name"]),
+                    txt = st.text_area(lang["explanation"].format(name=teacher_info.name),
                                        dfv_txt)
                     btn_form = st.form_submit_button()
 
@@ -2134,39 +2079,7 @@ else:
                         if rating == 0:
                             st.error(lang["ERR_NO_RATE"])
                         else:
-                            print("ww")
-                            rate_stu = teachers_database[teacher_name]["rated"]
-
-                            if (not rate_stu.get(secure_id, False)):
-                                rate_stu[secure_id] = []
-                            print(rate_stu)
-                            dates = [sub['date'] for sub in rate_stu[secure_id]]
-                            print(dates)
-                            try:
-                                idxd = dates.index(f"{ratrange}-{ratrange1}")
-                                rate_stu[secure_id][idxd] = {"date": f"{ratrange}-{ratrange1}", "stars": rating, "feedback": txt}
-                            except ValueError:
-                                rate_stu[secure_id].append({"date": f"{ratrange}-{ratrange1}", "stars": rating, "feedback": txt})
-
-                            save_data(TEACHERS_DB_PATH, teachers_database)
-
-                            st.rerun()
-                file_path, filename, error = find_user_file(teacher_name)
-                if error:
-                    st.info("No Courseware For this Teacher")
-                elif file_path and filename:
-                    with open(file_path, "rb") as fp:
-                        file_bytes = fp.read()
-
-                    # Guess MIME type
-                    mime_type, _ = mimetypes.guess_type(file_path)
-                    if mime_type is None:
-                        mime_type = "application/octet-stream" # Default if unknown
-                    st.download_button(
-                        label=f"Download Courseware",
-                        data=file_bytes,
-                        file_name=filename,
-                        mime=mime_type,
-                        key=f"download_btn_{filename}"
-                    )
+                            if append_rating(teacher_name, secure_id, rating, txt):
+                                st.rerun()
+                courseware_download(teacher_name)
                 st.markdown("---")  # Separator between teachers
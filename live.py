@@ -0,0 +1,124 @@
+"""
+Pushes switch.json and teacher-availability changes to live sessions.
+
+Every session in the server process shares one Hub. A single watcher thread
+compares the backend versions of switch.json and teachers.json every
+poll_interval seconds (a stat for the JSON backend) and, when they change,
+publishes only the topics whose content actually changed:
+
+    SWITCH_TOPIC        any edit to switch.json (global flags, schedule)
+    teacher:<id>        that teacher's models.Availability changed
+
+Publishing bumps each topic's counter. A page takes token(topics) for the
+topics it depends on when it renders, and a small st.fragment(run_every=...)
+polls the same token - a dict lookup, no I/O - and reruns the page once it
+differs, so only the sessions showing something that changed rerun, and nobody
+has to press Refresh to see enrollment open. Writers in this process can call
+wake() to publish immediately instead of at the next poll; edits from other
+processes are picked up by the poll.
+"""
+import copy
+import logging
+import os
+import threading
+
+import models
+import storage
+
+log = logging.getLogger(__name__)
+
+SWITCH_TOPIC = "switch"
+
+
+def teacher_topic(teacher_id):
+    return f"teacher:{teacher_id}"
+
+
+class Hub:
+    """Per-topic change counters, plus the thread that watches the databases."""
+
+    def __init__(self, backend, poll_interval=1.0):
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.published = 0  # Topics published since start
+        self._versions = {}  # topic -> times published
+        self._lock = threading.Lock()
+        self._switch = None  # Last state seen by check(); None until the first pass
+        self._availability = None
+        self._key = None  # Backend versions at the last check()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Topics
+    def token(self, topics):
+        """A number that grows whenever any of topics is published."""
+        return sum(self._versions.get(topic, 0) for topic in topics)
+
+    def publish(self, topics):
+        """Marks topics as changed."""
+        with self._lock:
+            for topic in topics:
+                self._versions[topic] = self._versions.get(topic, 0) + 1
+            self.published += len(topics)
+
+    # Watching
+    def check(self):
+        """Publishes whatever changed since the previous call. Returns the topics published."""
+        key = (self.backend.version(self.backend.paths[storage.SWITCH]),
+               self.backend.version(self.backend.paths[storage.TEACHERS]))
+        if None not in key and key == self._key:
+            return set()  # Nothing was written (None: the backend cannot tell, so compare contents)
+        self._key = key
+        switch = self.backend.load(self.backend.paths[storage.SWITCH])  # Cached until switch.json changes
+        availability = models.get_availability(self.backend)
+        topics = set()
+        if self._switch is not None:
+            if switch != self._switch:
+                topics.add(SWITCH_TOPIC)
+            old = self._availability
+            topics.update(teacher_topic(tid) for tid in old.keys() | availability.keys()
+                          if old.get(tid) != availability.get(tid))
+        self._switch, self._availability = copy.deepcopy(switch), availability  # The cached dict may be edited in place
+        if topics:
+            self.publish(topics)
+        return topics
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="live-hub", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        """Checks for changes now instead of at the next poll."""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception:  # Keep the thread alive; the next pass retries
+                log.exception("Live update check failed")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+_hub = None
+_hub_lock = threading.Lock()
+
+
+def get_hub(backend):
+    """Returns the process-wide Hub, starting its watcher thread on first use."""
+    global _hub
+    with _hub_lock:
+        if _hub is None:
+            _hub = Hub(backend, float(os.environ.get("ENROLL_LIVE_POLL", "1")))
+            _hub.start()
+        return _hub
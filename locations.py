@@ -0,0 +1,223 @@
+"""
+Country / state / city catalog for the registration pickers.
+
+Built offline from pycountry (every country and ISO 3166-2 subdivision, with
+Chinese names from pycountry's translations) and geonamescache (cities) into
+ENROLL_LOCATION_CATALOG (default location_catalog/):
+
+    countries.json   [[code, English name, Chinese name], ...]
+    <CC>.json        {"subdivisions": [[code, English name, Chinese name], ...],
+                      "cities": {subdivision code or "": [city, ...] sorted by normalized name}}
+
+Only countries.json is read at startup; a country's file is read the first time
+someone picks that country. Option lists are sorted once per language and
+cached, and city prefix search is a bisect over the pre-sorted names, so a
+render costs a dict lookup even for countries with thousands of cities.
+Stored values are always the English names; labels are only for display.
+
+    python locations.py build [--dir location_catalog]
+"""
+import argparse
+import bisect
+import functools
+import gettext
+import json
+import logging
+import os
+import threading
+import time
+
+import geo
+import storage
+
+log = logging.getLogger(__name__)
+
+LANGUAGES = ("English", "中文")  # Column 1 and 2 of every [code, English, Chinese] row
+
+
+def _translator(domain):
+    """gettext for pycountry's zh_CN catalog of domain, or identity if it is missing."""
+    import pycountry
+
+    try:
+        return gettext.translation(domain, pycountry.LOCALES_DIR, languages=["zh_CN"]).gettext
+    except OSError:
+        return lambda text: text
+
+
+def build_catalog(directory):
+    """Writes countries.json and one <CC>.json per country. Returns (countries, subdivisions, cities) written."""
+    import geonamescache
+    import pycountry
+
+    os.makedirs(directory, exist_ok=True)
+    country_zh, subdivision_zh = _translator("iso3166-1"), _translator("iso3166-2")
+    cities_by_country = {}
+    for city in geonamescache.GeonamesCache().get_cities().values():
+        cities_by_country.setdefault(city.get("countrycode"), []).append(city)
+
+    countries, totals = [], [0, 0, 0]
+    for country in pycountry.countries:
+        countries.append([country.alpha_2, country.name, country_zh(country.name)])
+        subdivisions = sorted(pycountry.subdivisions.get(country_code=country.alpha_2) or [], key=lambda s: s.name)
+        codes = {s.code for s in subdivisions}
+        cities = {}
+        ranked = sorted(cities_by_country.get(country.alpha_2, []), key=lambda c: -(c.get("population") or 0))
+        for city in ranked:
+            code = f"{country.alpha_2}-{city.get('admin1code')}"
+            bucket = cities.setdefault(code if code in codes else "", [])  # "": admin1 code is not ISO 3166-2
+            if city["name"] not in bucket:
+                bucket.append(city["name"])
+        payload = {"subdivisions": [[s.code, s.name, subdivision_zh(s.name)] for s in subdivisions],
+                   "cities": {code: sorted(names, key=geo.normalize_name) for code, names in cities.items()}}
+        storage.atomic_write(os.path.join(directory, f"{country.alpha_2}.json"),
+                             json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        totals[1] += len(subdivisions)
+        totals[2] += sum(len(names) for names in cities.values())
+    storage.atomic_write(os.path.join(directory, "countries.json"),
+                         json.dumps(countries, ensure_ascii=False).encode("utf-8"))
+    totals[0] = len(countries)
+    return tuple(totals)
+
+
+class CountryEntry:
+    """One country's file, loaded on first use."""
+
+    __slots__ = ("subdivisions", "cities", "keys")
+
+    def __init__(self, payload):
+        self.subdivisions = {row[1]: row for row in payload["subdivisions"]}  # English name -> [code, en, zh]
+        self.cities = payload["cities"]  # Subdivision code or "" -> names sorted by normalized name
+        self.keys = {code: [geo.normalize_name(name) for name in names] for code, names in self.cities.items()}
+
+
+class LocationCatalog:
+    """Lazy reader for the files written by build_catalog()."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.loaded = 0  # Country files read so far
+        self._countries = None  # English name -> [code, en, zh]
+        self._entries = {}  # Country code -> CountryEntry
+        self._lock = threading.Lock()
+
+    def _country_rows(self):
+        with self._lock:
+            if self._countries is None:
+                path = os.path.join(self.directory, "countries.json")
+                if not os.path.exists(path):
+                    log.info("Building %s: %s (countries, subdivisions, cities)", self.directory,
+                             build_catalog(self.directory))
+                with open(path, "rb") as f:
+                    self._countries = {row[1]: row for row in json.loads(f.read())}
+            return self._countries
+
+    def _entry(self, country):
+        row = self._country_rows().get(country)
+        if row is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(row[0])
+            if entry is None:
+                with open(os.path.join(self.directory, f"{row[0]}.json"), "rb") as f:
+                    entry = self._entries[row[0]] = CountryEntry(json.loads(f.read()))
+                self.loaded += 1
+            return entry
+
+    def warm(self):
+        self._country_rows()
+        return self
+
+    # Labels
+    def label(self, name, language="English", country=None):
+        """Display name of a country (or, with country=..., one of its subdivisions); name itself if unknown."""
+        if language not in LANGUAGES:
+            return name
+        rows = self._country_rows() if country is None else getattr(self._entry(country), "subdivisions", {})
+        row = rows.get(name)
+        return row[1 + LANGUAGES.index(language)] if row else name
+
+    def country_code(self, country):
+        row = self._country_rows().get(country)
+        return row[0] if row else None
+
+    # Option lists (English names, sorted by their label in `language`)
+    @functools.lru_cache(maxsize=None)
+    def countries(self, language="English"):
+        column = 1 + LANGUAGES.index(language) if language in LANGUAGES else 1
+        return tuple(row[1] for row in sorted(self._country_rows().values(), key=lambda row: row[column]))
+
+    @functools.lru_cache(maxsize=1024)
+    def subdivisions(self, country, language="English"):
+        entry = self._entry(country)
+        if entry is None:
+            return ()
+        column = 1 + LANGUAGES.index(language) if language in LANGUAGES else 1
+        return tuple(row[1] for row in sorted(entry.subdivisions.values(), key=lambda row: row[column]))
+
+    def _names_and_keys(self, country, subdivision):
+        """(names, normalized names) of the subdivision's cities, or of the whole country if it has none listed."""
+        entry = self._entry(country)
+        if entry is None:
+            return [], []
+        row = entry.subdivisions.get(subdivision)
+        if row is not None and row[0] in entry.cities:
+            return entry.cities[row[0]], entry.keys[row[0]]
+        return self._all_cities(country)
+
+    @functools.lru_cache(maxsize=256)
+    def _all_cities(self, country):
+        entry = self._entry(country)
+        names = sorted({name for names in entry.cities.values() for name in names}, key=geo.normalize_name)
+        return names, [geo.normalize_name(name) for name in names]
+
+    def cities(self, country, subdivision=None):
+        """Cities of the subdivision, or of the whole country when the subdivision has none listed."""
+        return self._names_and_keys(country, subdivision)[0]
+
+    def search_cities(self, country, prefix, subdivision=None, limit=50):
+        """Up to `limit` of those cities whose normalized name starts with `prefix`, in name order."""
+        names, keys = self._names_and_keys(country, subdivision)
+        prefix = geo.normalize_name(prefix)
+        start = bisect.bisect_left(keys, prefix)
+        matches = []
+        for key, name in zip(keys[start:start + limit], names[start:start + limit]):
+            if not key.startswith(prefix):
+                break
+            matches.append(name)
+        return matches
+
+    def stats(self):
+        return {"countries": len(self._countries or ()), "loaded": self.loaded}
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """Returns the process-wide LocationCatalog, reading (or first building) its country list in the background."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = LocationCatalog(os.environ.get("ENROLL_LOCATION_CATALOG", "location_catalog"))
+            threading.Thread(target=_catalog.warm, name="location-catalog-warmup", daemon=True).start()
+        return _catalog
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Location catalog for the registration pickers")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="(Re)build the catalog from pycountry and geonamescache")
+    build.add_argument("--dir", default=os.environ.get("ENROLL_LOCATION_CATALOG", "location_catalog"))
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        start = time.perf_counter()
+        countries, subdivisions, cities = build_catalog(args.dir)
+        print(f"Wrote {countries} countries, {subdivisions} subdivisions and {cities} cities to {args.dir} "
+              f"in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
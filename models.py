@@ -0,0 +1,354 @@
+"""
+Typed records for the enrollment databases.
+
+The JSON files grew several shapes over time: students saved as a bare name
+string, teachers without is_active / enrollment_cap / timezone, ratings kept as
+strings such as "4" or "None". migrate() rewrites every database into the
+current shape once (SCHEMA_VERSION is recorded in switch.json), so the app can
+read records as compact, slotted dataclasses instead of re-checking each dict.
+
+Records are frozen: they are shared between sessions through TypedView. To
+change one, write the fields back through the backend (update_records) and the
+view picks the new version up on its next get().
+
+A teacher's is_active / allow_enroll are the teacher's own choice. The admin's
+global "Hide All Classes" / "Close Enrollment" switches (and the schedule) are
+layered on top at read time by AvailabilityView instead of being copied into
+every teacher record.
+"""
+import threading
+from dataclasses import dataclass, field, fields, replace
+
+import enroll_schedule
+import storage
+
+SCHEMA_VERSION = 2
+
+
+def _as_int(value):
+    """4, 4.0, "4" -> 4; None, "", "None", junk -> None."""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip()
+    return int(text) if text.lstrip("-").isdigit() else None
+
+
+def _as_str(value):
+    return "" if value is None else str(value)
+
+
+def _split(data, names):
+    """Splits a stored dict into (known fields, everything else)."""
+    known = {k: v for k, v in data.items() if k in names}
+    extra = {k: v for k, v in data.items() if k not in names}
+    return known, extra
+
+
+@dataclass(frozen=True, slots=True)
+class Teacher:
+    name: str = ""
+    subject_en: str = ""
+    grade: str = ""
+    description_en: str = ""
+    description_zh: str = ""
+    is_active: bool = True
+    allow_enroll: bool = True
+    enrollment_cap: int = None  # None means unlimited
+    rating: int = None  # Sum of the stars the class received; None until it is rated
+    timezone: str = ""
+    extra: dict = field(default_factory=dict)  # Fields this version does not know about, kept as-is
+
+    @classmethod
+    def from_dict(cls, data):
+        known, extra = _split(data if isinstance(data, dict) else {"name": _as_str(data)}, _TEACHER_FIELDS)
+        cap = _as_int(known.get("enrollment_cap"))
+        return cls(name=_as_str(known.get("name")), subject_en=_as_str(known.get("subject_en")),
+                   grade=_as_str(known.get("grade")).strip(), description_en=_as_str(known.get("description_en")),
+                   description_zh=_as_str(known.get("description_zh")),
+                   is_active=bool(known.get("is_active", True)), allow_enroll=bool(known.get("allow_enroll", True)),
+                   enrollment_cap=cap if cap and cap > 0 else None, rating=_as_int(known.get("rating")),
+                   timezone=_as_str(known.get("timezone")), extra=extra)
+
+    def to_dict(self):
+        return {**self.extra, **{name: getattr(self, name) for name in _TEACHER_FIELDS}}
+
+
+@dataclass(frozen=True, slots=True)
+class Student:
+    name: str = ""
+    grade: str = ""
+    raz_level: str = ""
+    country: str = ""
+    state: str = ""
+    city: str = ""
+    timezone: str = ""
+    extra: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data):
+        known, extra = _split(storage.as_record(data), _STUDENT_FIELDS)  # Legacy records are a bare name
+        return cls(**{name: _as_str(known.get(name)) for name in _STUDENT_FIELDS}, extra=extra)
+
+    def to_dict(self):
+        return {**self.extra, **{name: getattr(self, name) for name in _STUDENT_FIELDS}}
+
+    @property
+    def location(self):
+        return ", ".join(part for part in (self.city, self.state, self.country) if part)
+
+
+@dataclass(frozen=True, slots=True)
+class RatingEntry:
+    stars: int = 0
+    feedback: str = ""
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(stars=_as_int(data.get("stars")) or 0, feedback=_as_str(data.get("feedback")))
+
+    def to_dict(self):
+        return {"stars": self.stars, "feedback": self.feedback}
+
+
+# SwitchState field -> key in switch.json
+_SWITCH_KEYS = {
+    "rating": "rating",
+    "all_hidden": "all_hidden",
+    "all_closed": "all_closed",
+    "open_enrollment_date": "Open Enrollment Date",
+    "close_enrollment_date": "Close Enrollment Date",
+    "open_ratings_date": "Open Ratings Date",
+    "close_ratings_date": "Close Ratings Date",
+    "open_enrollment_delay": "Open Enrollment Delay",
+    "schema_version": "schema_version",
+}
+
+
+@dataclass(frozen=True, slots=True)
+class SwitchState:
+    rating: bool = False
+    all_hidden: bool = False
+    all_closed: bool = False
+    open_enrollment_date: str = None  # "%Y-%m-%d %H:%M", UTC
+    close_enrollment_date: str = None
+    open_ratings_date: str = None
+    close_ratings_date: str = None
+    open_enrollment_delay: str = None  # str(timedelta) between the end of ratings and the next enrollment
+    schema_version: int = 0
+    extra: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data):
+        known, extra = _split(data, set(_SWITCH_KEYS.values()))
+        values = {name: known[key] for name, key in _SWITCH_KEYS.items() if key in known}
+        for flag in ("rating", "all_hidden", "all_closed"):
+            values[flag] = bool(values.get(flag, False))
+        values["schema_version"] = _as_int(values.get("schema_version")) or 0
+        return cls(**values, extra=extra)
+
+    def to_dict(self):
+        data = dict(self.extra)
+        for name, key in _SWITCH_KEYS.items():
+            value = getattr(self, name)
+            if value is not None:
+                data[key] = value
+        return data
+
+
+_TEACHER_FIELDS = tuple(f.name for f in fields(Teacher) if f.name != "extra")
+_STUDENT_FIELDS = tuple(f.name for f in fields(Student) if f.name != "extra")
+
+
+# --- Typed views ---
+class TypedView:
+    """
+    {record_id: record} for one database, converted with record_type.from_dict.
+
+    The converted dict is cached against backend.version(path) and only rebuilt
+    after the database changes, so a rerun that finds nothing new reuses it.
+    """
+
+    def __init__(self, backend, path, record_type):
+        self.backend = backend
+        self.path = path
+        self.record_type = record_type
+        self._version = None
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            version = self.backend.version(self.path)
+            if version is None or version != self._version:
+                convert = self.record_type.from_dict
+                self._records = {key: convert(value) for key, value in self.backend.load(self.path).items()}
+                self._version = version
+            return self._records
+
+
+_views = {}
+_views_lock = threading.Lock()
+
+
+def get_view(backend, path, record_type):
+    """Returns the process-wide TypedView for path."""
+    key = (id(backend), path)
+    with _views_lock:
+        view = _views.get(key)
+        if view is None:
+            view = _views[key] = TypedView(backend, path, record_type)
+        return view
+
+
+def load_switch(backend):
+    return SwitchState.from_dict(backend.load(backend.paths[storage.SWITCH]))
+
+
+def removed_teachers(original, kept_ids):
+    """Ids of the teachers in `original` (teachers.json, keyed by teacher id) that are not in kept_ids."""
+    return [teacher_id for teacher_id in original if teacher_id not in kept_ids]
+
+
+def submit_rating(backend, teacher_id, student_id, stars, feedback, now=None):
+    """
+    Stores a student's rating of a teacher for the current rating period
+    (enroll_schedule.rating_period), replacing an earlier one for that period.
+    Returns the period; raises ValueError if ratings are not open.
+    """
+    period = enroll_schedule.rating_period(backend, now)
+    if period is None:
+        raise ValueError("Ratings are not open")
+    entry = RatingEntry.from_dict({"stars": stars, "feedback": feedback})
+    backend.append_rating(teacher_id, student_id, period, entry.to_dict())
+    return period
+
+
+# --- Effective availability ---
+@dataclass(frozen=True, slots=True)
+class Availability:
+    visible: bool  # Shown to students: the teacher's is_active and not all_hidden
+    enrollable: bool  # Accepts enrollments: the teacher's allow_enroll and not all_closed
+
+
+def effective_availability(teacher, switch):
+    return Availability(visible=teacher.is_active and not switch.all_hidden,
+                        enrollable=teacher.allow_enroll and not switch.all_closed)
+
+
+class AvailabilityView:
+    """
+    {teacher_id: Availability}, cached against the versions of teachers.json and
+    switch.json together, so a global toggle is one small write to switch.json
+    and turning it back off restores every teacher's own setting.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.teachers = get_view(backend, backend.paths[storage.TEACHERS], Teacher)
+        self._key = None
+        self._availability = {}
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            key = (self.backend.version(self.backend.paths[storage.TEACHERS]),
+                   self.backend.version(self.backend.paths[storage.SWITCH]))
+            if None in key or key != self._key:
+                switch = load_switch(self.backend)
+                self._availability = {tid: effective_availability(t, switch) for tid, t in self.teachers.get().items()}
+                self._key = key
+            return self._availability
+
+
+_availability_views = {}
+_availability_lock = threading.Lock()
+
+
+def get_availability(backend):
+    """Returns the process-wide AvailabilityView's current {teacher_id: Availability}."""
+    with _availability_lock:
+        view = _availability_views.get(id(backend))
+        if view is None:
+            view = _availability_views[id(backend)] = AvailabilityView(backend)
+    return view.get()
+
+
+# --- Schema migration ---
+def _normalize_records(backend):
+    """v1: one shape per record type (bare-name students, teacher defaults, numeric stars)."""
+    changed = {}
+    for collection, record_type in ((storage.TEACHERS, Teacher), (storage.STUDENTS, Student)):
+        path = backend.paths[collection]
+        data = backend.load(path)
+        normalized = {key: record_type.from_dict(value).to_dict() for key, value in data.items()}
+        changed[collection] = sum(normalized[key] != value for key, value in data.items())
+        if changed[collection]:
+            backend.save(path, normalized)
+
+    ratings_path = backend.paths[storage.RATINGS]
+    ratings = backend.load(ratings_path)
+    normalized = {t: {s: {p: RatingEntry.from_dict(e).to_dict() for p, e in periods.items()}
+                      for s, periods in by_student.items()} for t, by_student in ratings.items()}
+    changed[storage.RATINGS] = sum(n != o for t in ratings for s in ratings[t]
+                                   for n, o in zip(normalized[t][s].values(), ratings[t][s].values()))
+    if changed[storage.RATINGS]:
+        backend.save(ratings_path, normalized)
+    return changed
+
+
+def _unlayer_global_switches(backend):
+    """
+    v2: global switches used to be copied into every teacher, and turning them
+    off again set every teacher back to True. While a switch is on, do that reset
+    now; from here on the switch is only applied at read time.
+    """
+    switch = load_switch(backend)
+    reset = {}
+    if switch.all_hidden:
+        reset["is_active"] = True
+    if switch.all_closed:
+        reset["allow_enroll"] = True
+    if not reset:
+        return {}
+    teachers_path = backend.paths[storage.TEACHERS]
+    changes = {tid: reset for tid, details in backend.load(teachers_path).items()
+               if any(details.get(k) != v for k, v in reset.items())}
+    backend.update_records(teachers_path, changes)
+    return {"teacher flags": len(changes)}
+
+
+MIGRATIONS = ((1, _normalize_records), (2, _unlayer_global_switches))
+
+
+def migrate(backend):
+    """
+    Brings every database up to SCHEMA_VERSION by running the MIGRATIONS newer
+    than the version recorded in switch.json. The version is written last, so an
+    interrupted migration simply runs again (every step is idempotent).
+    Returns {what: records rewritten}, or {} if already up to date.
+    """
+    switch_path = backend.paths[storage.SWITCH]
+    switch = SwitchState.from_dict(backend.load(switch_path))
+    if switch.schema_version >= SCHEMA_VERSION:
+        return {}
+
+    changed = {}
+    for version, step in MIGRATIONS:
+        if switch.schema_version < version:
+            changed.update(step(backend))
+    backend.save(switch_path, replace(switch, schema_version=SCHEMA_VERSION).to_dict())
+    return changed
+
+
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+
+def ensure_schema(backend):
+    """Runs migrate() once per backend per process."""
+    with _migrate_lock:
+        if id(backend) not in _migrated:
+            migrate(backend)
+            _migrated.add(id(backend))
@@ -0,0 +1,167 @@
+"""
+Seat inventory: makes sure a class never goes over its enrollment_cap.
+
+Every Streamlit session runs in its own thread, so two students clicking
+"Enroll" at the same moment used to both pass the `len(roster) >= cap` check.
+Here each teacher has a versioned seat counter. A reservation reads the counter,
+checks the cap, and then compare-and-swaps on the version it read; if another
+reservation got in first the CAS fails and it retries against the new count.
+Exactly `cap` reservations can succeed, however many arrive at once.
+
+A winning CAS persists the seat (backend.enroll / backend.cancel) before it
+commits, under the counter's lock, so a counter never holds a seat the database
+does not. reset() retires the counters under the same locks before re-seeding:
+a reservation still holding a retired counter fails its CAS and retries
+against a fresh one seeded from the database.
+"""
+import threading
+import time
+
+GRANTED = "granted"
+ALREADY_ENROLLED = "already_enrolled"
+FULL = "full"
+CONFLICT = "conflict"  # Gave up after max_retries lost CAS races
+
+
+class SeatCounter:
+    """Holders of one teacher's seats plus a version that changes on every update."""
+
+    def __init__(self, holders):
+        self.holders = set(holders)
+        self.version = 0
+        self.retired = False  # Set by SeatInventory.reset(); every later CAS fails
+        self._lock = threading.Lock()
+
+    def read(self, student_id):
+        """Returns (version, seats taken, whether student_id holds a seat)."""
+        version = self.version
+        return version, len(self.holders), student_id in self.holders
+
+    def compare_and_swap(self, expected_version, add=None, remove=None, persist=None):
+        """
+        Applies the change only if nothing else changed the counter since
+        expected_version and it is not retired. persist() runs first, under the
+        lock; if it raises, nothing is applied.
+        """
+        with self._lock:
+            if self.retired or self.version != expected_version:
+                return False
+            if persist is not None:
+                persist()
+            if add is not None:
+                self.holders.add(add)
+            if remove is not None:
+                self.holders.discard(remove)
+            self.version += 1
+            return True
+
+    def retire(self):
+        """Waits for an in-flight CAS to finish, then makes every later one fail."""
+        with self._lock:
+            self.retired = True
+
+
+class SeatInventory:
+    """
+    Per-teacher seat counters seeded from the enrollments database.
+
+    Granted seats are persisted through backend.enroll / backend.cancel. Rewrite
+    the enrollments wholesale (admin edits) through reset(rewrite) so the
+    counters are re-seeded from the result.
+    """
+
+    def __init__(self, backend, enrollments_path, max_retries=50):
+        self.backend = backend
+        self.enrollments_path = enrollments_path
+        self.max_retries = max_retries
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._metrics = {"attempts": 0, "granted": 0, "full": 0, "already_enrolled": 0, "released": 0,
+                         "cas_conflicts": 0, "gave_up": 0, "max_retries_seen": 0}
+
+    def _counter(self, teacher_id):
+        counter = self._counters.get(teacher_id)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.get(teacher_id)
+                if counter is None:
+                    roster = self.backend.load(self.enrollments_path).get(teacher_id, [])
+                    counter = self._counters[teacher_id] = SeatCounter(roster)
+        return counter
+
+    def _record(self, outcome, retries):
+        with self._metrics_lock:
+            self._metrics["attempts"] += 1
+            self._metrics["cas_conflicts"] += retries
+            self._metrics["max_retries_seen"] = max(self._metrics["max_retries_seen"], retries)
+            key = "gave_up" if outcome == CONFLICT else outcome
+            self._metrics[key] += 1
+
+    def reserve(self, teacher_id, student_id, cap):
+        """
+        Tries to give student_id a seat in teacher_id's class (cap=None means unlimited).
+
+        Returns GRANTED, ALREADY_ENROLLED, FULL or CONFLICT.
+        """
+        for retries in range(self.max_retries):
+            counter = self._counter(teacher_id)  # A fresh one if reset() retired ours
+            version, taken, enrolled = counter.read(student_id)
+            if enrolled:
+                outcome = ALREADY_ENROLLED
+            elif cap is not None and taken >= cap:
+                outcome = FULL
+            elif counter.compare_and_swap(version, add=student_id,
+                                          persist=lambda: self.backend.enroll(teacher_id, student_id)):
+                outcome = GRANTED
+            else:
+                time.sleep(0.0005 * retries)  # Lost the race; back off a little and re-read
+                continue
+            self._record(outcome, retries)
+            return outcome
+        self._record(CONFLICT, self.max_retries)
+        return CONFLICT
+
+    def release(self, teacher_id, student_id):
+        """Gives up student_id's seat. Returns False if they did not hold one."""
+        while True:
+            counter = self._counter(teacher_id)
+            version, _, enrolled = counter.read(student_id)
+            if not enrolled:
+                return False
+            if counter.compare_and_swap(version, remove=student_id,
+                                        persist=lambda: self.backend.cancel(teacher_id, student_id)):
+                break
+        with self._metrics_lock:
+            self._metrics["released"] += 1
+        return True
+
+    def reset(self, rewrite=None):
+        """
+        Re-seeds every counter from the enrollments database. rewrite(), if
+        given, runs after the current counters are retired and before new ones
+        can be seeded, so no seat is granted against the rosters it replaces.
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            for counter in counters.values():
+                counter.retire()
+            if rewrite is not None:
+                rewrite()
+
+    def metrics(self):
+        with self._metrics_lock:
+            return dict(self._metrics)
+
+
+_inventory = None
+_inventory_lock = threading.Lock()
+
+
+def get_inventory(backend, enrollments_path):
+    """Returns the process-wide SeatInventory, shared by every session."""
+    global _inventory
+    with _inventory_lock:
+        if _inventory is None:
+            _inventory = SeatInventory(backend, enrollments_path)
+        return _inventory
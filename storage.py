@@ -0,0 +1,1163 @@
+"""
+Storage backends for the enrollment app's databases.
+
+`load_data` / `save_data` in improved_enroll.py go through whichever backend is
+configured here, so the rest of the app keeps working with plain dicts:
+
+    user_db.json      {student_id: {name, grade, ...}}
+    teachers.json     {teacher_id: {name, subject_en, is_active, ...}}
+    enrollments.json  {teacher_id: [student_id, ...]}   (loaded as {teacher_id: Roster})
+    ratings.json      {teacher_id: {student_id: {period: {stars, feedback}}}}
+    switch.json       {rating, all_hidden, all_closed, ...}
+
+JsonFileBackend keeps the original one-file-per-database layout. Enroll/cancel
+clicks and record-level updates (one teacher, one student, one rating) are
+appended to a per-file Journal instead of rewriting the whole file; the journal
+is folded back into the file in the background.
+SqliteBackend keeps the same data in indexed tables of a single SQLite database
+running in WAL mode, so readers never block the writer.
+
+Each JSON file is read and written by a codec (see CODECS): "pretty" is the
+original indented format, "compact" drops the whitespace and "fast" uses orjson
+or msgspec when installed. Pick one with ENROLL_CODEC, or per file with e.g.
+ENROLL_CODEC_ENROLLMENTS=fast. Any codec reads files written by any other.
+
+Run `python storage.py migrate` to copy the existing JSON files into SQLite.
+Ratings used to live inside each teacher record (`rated`); migrate_ratings()
+moves them into the ratings store and runs automatically on startup.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+try:  # Optional accelerators for the "fast" codec; the stdlib is used when neither is installed
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# --- Collections ---
+STUDENTS = "students"
+TEACHERS = "teachers"
+ENROLLMENTS = "enrollments"
+RATINGS = "ratings"
+SWITCH = "switch"
+
+DEFAULT_PATHS = {
+    STUDENTS: "user_db.json",
+    TEACHERS: "teachers.json",
+    ENROLLMENTS: "enrollments.json",
+    RATINGS: "ratings.json",
+    SWITCH: "switch.json",
+}
+DEFAULT_SQLITE_PATH = "enroll.sqlite3"
+
+
+class StorageBackend:
+    """Base class: maps each database path to a collection and loads/saves it whole."""
+
+    def __init__(self, paths=None):
+        self.paths = dict(DEFAULT_PATHS if paths is None else paths)
+        self._collections = {os.path.normpath(p): c for c, p in self.paths.items()}
+
+    def collection_for(self, path):
+        """Returns the collection name for a database path, or None if unknown."""
+        return self._collections.get(os.path.normpath(path))
+
+    def load(self, path):
+        raise NotImplementedError
+
+    def save(self, path, data):
+        raise NotImplementedError
+
+    def enroll(self, teacher_id, student_id):
+        """Adds one student to a teacher's roster (no-op if already there)."""
+        raise NotImplementedError
+
+    def cancel(self, teacher_id, student_id):
+        """Removes one student from a teacher's roster (no-op if not there)."""
+        raise NotImplementedError
+
+    def enroll_many(self, pairs):
+        """Bulk enroll: pairs is an iterable of (teacher_id, student_id)."""
+        raise NotImplementedError
+
+    def cancel_many(self, pairs):
+        """Bulk cancel: pairs is an iterable of (teacher_id, student_id)."""
+        raise NotImplementedError
+
+    def update_records(self, path, changes):
+        """
+        Merges fields into individual records: changes is {record_id: {field: value}}.
+        Records that do not exist yet are created. Only the changed records are written.
+        """
+        raise NotImplementedError
+
+    def delete_records(self, path, record_ids):
+        raise NotImplementedError
+
+    def append_rating(self, teacher_id, student_id, period, entry):
+        """Stores entry ({stars, feedback}) as student_id's rating of teacher_id for a rating period."""
+        raise NotImplementedError
+
+    def ratings_for_teacher(self, teacher_id):
+        """Returns {student_id: {period: entry}} for one teacher."""
+        raise NotImplementedError
+
+    def ratings_for_student(self, student_id):
+        """Returns {teacher_id: {period: entry}} for one student."""
+        raise NotImplementedError
+
+    def teachers_for_student(self, student_id):
+        """Returns the set of teacher_ids whose roster contains student_id."""
+        raise NotImplementedError
+
+    def version(self, path):
+        """
+        A value that changes whenever path's data changes, for caching views derived
+        from it; None means "unknown, rebuild every time".
+        """
+        return None
+
+    def close(self):
+        pass
+
+
+# --- Parsed-file cache ---
+class JsonFileCache:
+    """
+    Process-wide cache of parsed JSON files, keyed by path.
+
+    An entry is reused as long as the file's (mtime, size, inode) is unchanged, so
+    a rerun that finds nothing new on disk does no parsing at all. The cached
+    object is shared between sessions: treat it as read-only unless you save it
+    back through the backend.
+    """
+
+    def __init__(self):
+        self._entries = {}  # path -> (signature, data)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def signature(path):
+        """Returns (mtime_ns, size, inode) for path, or None if it does not exist."""
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return info.st_mtime_ns, info.st_size, info.st_ino
+
+    def get(self, path, parse):
+        """Returns the cached data for path, calling parse(path) when the file changed."""
+        signature = self.signature(path)
+        if signature is None:
+            self.invalidate(path)
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        data = parse(path)
+        with self._lock:
+            self._entries[path] = (signature, data)
+        return data
+
+    def put(self, path, data):
+        """Records data as the current contents of path (call right after writing it)."""
+        signature = self.signature(path)
+        with self._lock:
+            if signature is None:
+                self._entries.pop(path, None)
+            else:
+                self._entries[path] = (signature, data)
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                    "hit_rate": self.hits / total if total else 0.0}
+
+
+def write_temp(path, payload):
+    """Writes bytes to a fsync'd temp file next to path and returns the temp file's path."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path
+
+
+def atomic_write(path, payload):
+    """Writes bytes to path via a temp file + rename, so a crash never leaves a truncated file."""
+    os.replace(write_temp(path, payload), path)
+
+
+# --- Rosters ---
+class Roster:
+    """
+    One teacher's enrolled student IDs: keeps insertion order like the old lists,
+    but membership, add and remove are O(1) and duplicates cannot occur.
+    Serializes to a plain JSON list.
+    """
+
+    __slots__ = ("_ids",)
+
+    def __init__(self, student_ids=()):
+        self._ids = dict.fromkeys(student_ids)
+
+    def __contains__(self, student_id):
+        return student_id in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __eq__(self, other):
+        if isinstance(other, Roster):
+            return list(self._ids) == list(other._ids)
+        if isinstance(other, (list, tuple)):
+            return list(self._ids) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"Roster({list(self._ids)!r})"
+
+    def add(self, student_id):
+        """Adds student_id at the end; returns False if it was already there."""
+        if student_id in self._ids:
+            return False
+        self._ids[student_id] = None
+        return True
+
+    def discard(self, student_id):
+        """Removes student_id; returns False if it was not there."""
+        return self._ids.pop(student_id, False) is None
+
+    def remove(self, student_id):
+        if not self.discard(student_id):
+            raise ValueError(f"{student_id} is not in the roster")
+
+    def update(self, student_ids):
+        """Bulk add; returns how many were new."""
+        before = len(self._ids)
+        self._ids.update(dict.fromkeys(i for i in student_ids if i not in self._ids))
+        return len(self._ids) - before
+
+    def difference_update(self, student_ids):
+        """Bulk remove in O(len(student_ids)); returns how many were removed."""
+        return sum(self.discard(i) for i in student_ids)
+
+    def copy(self):
+        return Roster(self._ids)
+
+    def to_list(self):
+        return list(self._ids)
+
+
+def decode_enrollments(data):
+    """{teacher_id: [student_id, ...]} -> {teacher_id: Roster}; existing Rosters are kept."""
+    return {t: ids if isinstance(ids, Roster) else Roster(ids) for t, ids in data.items()}
+
+
+def _encode_default(value):
+    if isinstance(value, Roster):
+        return value.to_list()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# --- Codecs ---
+class Codec:
+    """
+    Turns a database (or one journal record) into bytes and back. Documents are
+    what gets written to the JSON file; lines are single-line journal records.
+    decode() accepts bytes and raises json.JSONDecodeError (a ValueError) on bad input.
+    """
+
+    def __init__(self, name, encode, encode_line, decode):
+        self.name = name
+        self.encode = encode
+        self.encode_line = encode_line
+        self.decode = decode
+
+    def __repr__(self):
+        return f"Codec({self.name!r})"
+
+
+def _stdlib_compact(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=_encode_default).encode("utf-8")
+
+
+def _stdlib_pretty(data):
+    return json.dumps(data, ensure_ascii=False, indent=2, default=_encode_default).encode("utf-8")
+
+
+def _fast_codec():
+    if orjson is not None:
+        options = orjson.OPT_NON_STR_KEYS
+
+        def encode(data):
+            return orjson.dumps(data, default=_encode_default, option=options)
+
+        return Codec("fast", encode, encode, orjson.loads)  # orjson.JSONDecodeError subclasses json's
+    if msgspec is not None:
+        encoder = msgspec.json.Encoder(enc_hook=_encode_default)
+        decoder = msgspec.json.Decoder()
+
+        def decode(payload):
+            try:
+                return decoder.decode(payload)
+            except msgspec.DecodeError as e:
+                raise json.JSONDecodeError(str(e), "", 0) from e
+
+        return Codec("fast", encoder.encode, encoder.encode, decode)
+    return Codec("fast", _stdlib_compact, _stdlib_compact, json.loads)
+
+
+CODECS = {
+    "pretty": Codec("pretty", _stdlib_pretty, _stdlib_compact, json.loads),
+    "compact": Codec("compact", _stdlib_compact, _stdlib_compact, json.loads),
+    "fast": _fast_codec(),
+}
+DEFAULT_CODEC = "pretty"
+
+
+def get_codec(name):
+    try:
+        return CODECS[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown codec: {name} (expected one of {', '.join(CODECS)})") from None
+
+
+def codec_from_env(collection):
+    """ENROLL_CODEC_<COLLECTION> if set, else ENROLL_CODEC, else the pretty codec."""
+    default = os.environ.get("ENROLL_CODEC", DEFAULT_CODEC)
+    return get_codec(os.environ.get(f"ENROLL_CODEC_{collection.upper()}", default))
+
+
+# --- Append-only journal ---
+def as_record(value):
+    """Returns a stored record as a dict; legacy students were stored as a bare name string."""
+    if isinstance(value, dict):
+        return value
+    return {"name": value} if isinstance(value, str) else {}
+
+
+def apply_record(state, record):
+    """
+    Applies one journal record to a database dict.
+
+    enroll / cancel   {teacher_id: [student_id, ...]}   (enrollments.json)
+    update / delete   {record_id: {field: value}}      (teachers.json, user_db.json)
+    rating            {teacher_id: {student_id: {period: entry}}}   (ratings.json)
+
+    state and its Rosters are changed in place, so Journal.append() applies
+    records to a copy of the published state and of each Roster they touch; the
+    update and rating ops build new dicts, so records shared with an older state
+    are left as they were.
+    """
+    op = record["op"]
+    if op == "enroll":
+        roster = state.get(record["t"])
+        if roster is None:
+            roster = state[record["t"]] = Roster()
+        roster.add(record["s"])
+    elif op == "cancel":
+        roster = state.get(record["t"])
+        if roster is not None and roster.discard(record["s"]) and not roster:
+            del state[record["t"]]  # Same as the UI: drop the teacher key once the roster is empty
+    elif op == "update":
+        state[record["k"]] = {**as_record(state.get(record["k"])), **record["f"]}
+    elif op == "delete":
+        state.pop(record["k"], None)
+    elif op == "rating":
+        by_student = dict(state.get(record["t"], {}))
+        periods = dict(by_student.get(record["s"], {}))
+        periods.pop(record["p"], None)  # Re-rating a period moves it to the end, as the latest entry
+        periods[record["p"]] = record["e"]
+        by_student[record["s"]] = periods
+        state[record["t"]] = by_student
+    else:
+        raise ValueError(f"Unknown journal op: {op}")
+
+
+def copy_state(state):
+    """Copies a database dict deeply enough that later apply_record calls cannot change it."""
+    return {k: v.copy() if isinstance(v, (list, Roster)) else v for k, v in state.items()}
+
+
+class Journal:
+    """
+    A JSON database file as a snapshot plus an append-only log of small records
+    (see apply_record).
+
+    * append() applies records to a copy of the in-memory state, publishes the
+      copy and writes one JSON line per record; lines are fsync'd in batches
+      (every `fsync_batch` records or `fsync_interval` seconds).
+    * load() returns the published state. It is never changed after it is
+      published (copy-on-write), so sessions can iterate it while others append;
+      callers must not change it either. The files are only replayed on first use
+      or when the snapshot is changed by someone else.
+    * Once the log holds `compact_after` records it is folded into a new snapshot
+      on a background thread.
+    * replace() writes a whole new snapshot (admin edits) and starts a fresh log.
+
+    Before a snapshot is swapped in, a "reset" marker carrying the snapshot's
+    sha256 is appended to the log. On replay, records up to the last marker that
+    matches the snapshot on disk are skipped, so a crash at any point replays
+    neither too little nor too much. Only one process may append to the journal.
+    """
+
+    def __init__(self, snapshot_path, decode=None, codec=None, fsync_batch=32, fsync_interval=0.05,
+                 compact_after=1000):
+        self.snapshot_path = snapshot_path
+        self.codec = codec or CODECS[DEFAULT_CODEC]
+        self.decode = decode or (lambda data: data)  # Turns the parsed snapshot into the in-memory state
+        self.log_path = snapshot_path + ".journal"
+        self.compacting_path = snapshot_path + ".journal.compacting"
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+        self._lock = threading.RLock()
+        self._state = None
+        self._snapshot_signature = None
+        self._log = None
+        self._log_records = 0
+        self._unsynced = 0
+        self._fsync_timer = None
+        self._compactor = None
+        self._epoch = 0  # Bumped by replace(); a compaction started in an older epoch is discarded
+        self.version = 0  # Bumped whenever the in-memory state changes; lets callers cache derived views
+
+    # Replay
+    def _read_records(self, path):
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(self.codec.decode(line))
+                except ValueError:
+                    break  # Torn tail from a crash mid-append; nothing valid follows it
+        return records
+
+    def _replay(self):
+        payload = b""
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                payload = f.read()
+        state = self.decode(self.codec.decode(payload) if payload.strip() else {})
+        digest = hashlib.sha256(payload).hexdigest()
+
+        records = self._read_records(self.compacting_path) + self._read_records(self.log_path)
+        start = 0
+        for i, record in enumerate(records):
+            if record.get("op") == "reset" and record.get("sha256") == digest:
+                start = i + 1
+        for record in records[start:]:
+            if record.get("op") != "reset":
+                apply_record(state, record)
+
+        self._state = state
+        self._snapshot_signature = JsonFileCache.signature(self.snapshot_path)
+        self._log_records = len(records) - start
+        self.version += 1
+        if os.path.exists(self.compacting_path) and (self._compactor is None or not self._compactor.is_alive()):
+            self.replace(state)  # A compaction was interrupted; finish it now
+
+    def load(self):
+        with self._lock:
+            if self._state is None or JsonFileCache.signature(self.snapshot_path) != self._snapshot_signature:
+                self._replay()
+            return self._state
+
+    # Appends
+    def _open_log(self):
+        if self._log is None:
+            self._log = open(self.log_path, "ab")
+        return self._log
+
+    def _write(self, record):
+        log = self._open_log()
+        log.write(self.codec.encode_line(record) + b"\n")
+        log.flush()
+        self._unsynced += 1
+
+    def append(self, *records):
+        with self._lock:
+            state = dict(self.load())  # Copy-on-write: readers keep the state they loaded
+            copied = set()  # Rosters already copied for this batch
+            for record in records:
+                if record["op"] in ("enroll", "cancel") and record["t"] not in copied:
+                    if record["t"] in state:
+                        state[record["t"]] = state[record["t"]].copy()
+                    copied.add(record["t"])
+                apply_record(state, record)
+                self._write(record)
+            self._state = state
+            self._log_records += len(records)
+            self.version += 1
+            if self._unsynced >= self.fsync_batch:
+                self._fsync()
+            elif self._fsync_timer is None:
+                self._fsync_timer = threading.Timer(self.fsync_interval, self.flush)
+                self._fsync_timer.daemon = True
+                self._fsync_timer.start()
+            if self._log_records >= self.compact_after:
+                self._start_compaction()
+
+    def _fsync(self):
+        if self._log is not None and self._unsynced:
+            os.fsync(self._log.fileno())
+        self._unsynced = 0
+
+    def flush(self):
+        """Forces any buffered records to disk."""
+        with self._lock:
+            self._fsync_timer = None
+            self._fsync()
+
+    # Snapshots
+    @staticmethod
+    def _mark_reset(log_path, payload):
+        """Records in log_path that everything before this line is covered by snapshot `payload`."""
+        with open(log_path, "ab") as f:
+            f.write(json.dumps({"op": "reset", "sha256": hashlib.sha256(payload).hexdigest()}).encode("ascii") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _close_log(self):
+        if self._log is not None:
+            self._fsync()
+            self._log.close()
+            self._log = None
+
+    def replace(self, state):
+        """Makes state the new snapshot and discards the log (used for whole-file saves)."""
+        state = copy_state(self.decode(state))  # The caller keeps its dict; ours is never changed
+        with self._lock:
+            self._epoch += 1
+            self._close_log()
+            payload = self.codec.encode(state)
+            self._mark_reset(self.log_path, payload)
+            atomic_write(self.snapshot_path, payload)
+            for path in (self.log_path, self.compacting_path):
+                if os.path.exists(path):
+                    os.unlink(path)
+            self._state = state
+            self._snapshot_signature = JsonFileCache.signature(self.snapshot_path)
+            self._log_records = 0
+            self.version += 1
+
+    def _start_compaction(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, name="journal-compactor", daemon=True)
+        self._compactor.start()
+
+    def compact(self):
+        """Folds the log into a new snapshot. Appends keep going to a fresh log meanwhile."""
+        with self._lock:
+            if os.path.exists(self.compacting_path) or not self._log_records:
+                return
+            state = self.load()
+            self._close_log()
+            if not os.path.exists(self.log_path):
+                return
+            os.replace(self.log_path, self.compacting_path)
+            self._log_records = 0
+            epoch = self._epoch
+
+        # Serializing and writing the snapshot happen outside the lock; clicks keep appending
+        payload = self.codec.encode(state)
+        tmp_path = write_temp(self.snapshot_path, payload)
+        with self._lock:
+            if epoch != self._epoch:
+                os.unlink(tmp_path)
+                return  # replace() wrote a newer snapshot meanwhile
+            self._mark_reset(self.compacting_path, payload)
+            os.replace(tmp_path, self.snapshot_path)
+            os.unlink(self.compacting_path)
+            self._snapshot_signature = JsonFileCache.signature(self.snapshot_path)
+
+    def close(self):
+        with self._lock:
+            if self._fsync_timer is not None:
+                self._fsync_timer.cancel()
+                self._fsync_timer = None
+            self._close_log()
+
+
+# --- Reverse indexes ---
+class ReverseIndex:
+    """
+    student_id -> set of teacher_ids, for stores keyed teacher first
+    (enrollment rosters, ratings). Lookups cost O(the student's teachers).
+    """
+
+    def __init__(self):
+        self.by_student = {}
+        self.version = None  # Journal version the index reflects
+
+    def rebuild(self, data, version):
+        by_student = {}
+        for teacher_id, students in data.items():
+            for student_id in students:
+                by_student.setdefault(student_id, set()).add(teacher_id)
+        self.by_student = by_student
+        self.version = version
+
+    def add(self, teacher_id, student_id):
+        self.by_student.setdefault(student_id, set()).add(teacher_id)
+
+    def discard(self, teacher_id, student_id):
+        teacher_ids = self.by_student.get(student_id)
+        if teacher_ids is not None:
+            teacher_ids.discard(teacher_id)
+            if not teacher_ids:
+                del self.by_student[student_id]
+
+
+# --- JSON files (original layout) ---
+class JsonFileBackend(StorageBackend):
+    """
+    One JSON document per database, rewritten atomically on save. Enrollments,
+    teachers and students go through a Journal so a single click costs one small
+    append; switch.json is tiny and is simply rewritten.
+    """
+
+    JOURNALED = (ENROLLMENTS, TEACHERS, STUDENTS, RATINGS)
+
+    def __init__(self, paths=None, cache=None, codecs=None):
+        super().__init__(paths)
+        self.cache = cache if cache is not None else JsonFileCache()
+        codecs = codecs or {}  # {collection: codec name}; unlisted collections follow the environment
+        self.codecs = {c: get_codec(codecs[c]) if c in codecs else codec_from_env(c) for c in self.paths}
+        self.journals = {c: Journal(self.paths[c], decode_enrollments if c == ENROLLMENTS else None, self.codecs[c])
+                         for c in self.JOURNALED if c in self.paths}
+        self.indexes = {ENROLLMENTS: ReverseIndex(), RATINGS: ReverseIndex()}
+        self._index_lock = threading.Lock()
+
+    def _journal(self, path):
+        return self.journals.get(self.collection_for(path))
+
+    def _is_journaled(self, path):
+        return self._journal(path) is not None
+
+    def _codec(self, path):
+        return self.codecs.get(self.collection_for(path)) or CODECS[DEFAULT_CODEC]
+
+    def _parse(self, path):
+        with open(path, "rb") as f:
+            content = f.read()
+        return self._codec(path).decode(content) if content.strip() else {}
+
+    def load(self, path):
+        if self._is_journaled(path):
+            return self._journal(path).load()
+        data = self.cache.get(path, self._parse)
+        return {} if data is None else data
+
+    def save(self, path, data):
+        if self._is_journaled(path):
+            self._journal(path).replace(data)
+            if self.collection_for(path) in self.indexes:
+                self._indexed(self.collection_for(path))  # Rebuild now rather than on the next read
+            return
+        atomic_write(path, self._codec(path).encode(data))
+        self.cache.put(path, data)
+
+    # Appends that keep a reverse index in step; anything else (replace, replay) bumps
+    # the journal version past the index's, and the index is rebuilt on next use
+    def version(self, path):
+        journal = self._journal(path)
+        if journal is not None:
+            journal.load()  # Picks up an outside change to the snapshot
+            return journal.version
+        return JsonFileCache.signature(path)
+
+    def _indexed_append(self, collection, records, add):
+        journal, index = self.journals[collection], self.indexes[collection]
+        with self._index_lock:
+            version = journal.version
+            journal.append(*records)
+            if index.version == version and journal.version == version + 1:
+                for record in records:
+                    (index.add if add else index.discard)(record["t"], record["s"])
+                index.version = journal.version
+            else:  # The append replayed an outside change (or the index was already behind)
+                index.rebuild(journal.load(), journal.version)
+
+    def _indexed(self, collection, student_id=None):
+        """
+        Returns (teacher_ids of student_id, data) for a collection, rebuilding the
+        index if it fell behind. The set is a copy: appends change the index in place.
+        """
+        journal, index = self.journals[collection], self.indexes[collection]
+        with self._index_lock:
+            data = journal.load()
+            if index.version != journal.version:
+                index.rebuild(data, journal.version)
+            return set(index.by_student.get(student_id, ())), data
+
+    def enroll(self, teacher_id, student_id):
+        self.enroll_many([(teacher_id, student_id)])
+
+    def cancel(self, teacher_id, student_id):
+        self.cancel_many([(teacher_id, student_id)])
+
+    def enroll_many(self, pairs):
+        self._indexed_append(ENROLLMENTS, [{"op": "enroll", "t": t, "s": s} for t, s in pairs], add=True)
+
+    def cancel_many(self, pairs):
+        self._indexed_append(ENROLLMENTS, [{"op": "cancel", "t": t, "s": s} for t, s in pairs], add=False)
+
+    def teachers_for_student(self, student_id):
+        return self._indexed(ENROLLMENTS, student_id)[0]
+
+    def update_records(self, path, changes):
+        self._require_journal(path).append(*({"op": "update", "k": k, "f": f} for k, f in changes.items()))
+
+    def delete_records(self, path, record_ids):
+        self._require_journal(path).append(*({"op": "delete", "k": k} for k in record_ids))
+
+    def append_rating(self, teacher_id, student_id, period, entry):
+        self._indexed_append(RATINGS, [{"op": "rating", "t": teacher_id, "s": student_id, "p": period, "e": entry}],
+                             add=True)
+
+    def ratings_for_teacher(self, teacher_id):
+        return self.journals[RATINGS].load().get(teacher_id, {})
+
+    def ratings_for_student(self, student_id):
+        teacher_ids, ratings = self._indexed(RATINGS, student_id)
+        return {t: ratings[t][student_id] for t in teacher_ids if student_id in ratings.get(t, {})}
+
+    def _require_journal(self, path):
+        journal = self._journal(path)
+        if journal is None:
+            raise IOError(f"Record-level updates are not supported for {path}")
+        return journal
+
+    def close(self):
+        for journal in self.journals.values():
+            journal.close()
+
+
+# --- SQLite (WAL) ---
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS students (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_students_name ON students(name);
+
+CREATE TABLE IF NOT EXISTS teachers (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    is_active INTEGER,
+    allow_enroll INTEGER,
+    enrollment_cap INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_teachers_active ON teachers(is_active);
+
+CREATE TABLE IF NOT EXISTS enrollments (
+    teacher_id TEXT NOT NULL,
+    student_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (teacher_id, student_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_enrollments_student ON enrollments(student_id);
+
+CREATE TABLE IF NOT EXISTS ratings (
+    teacher_id TEXT NOT NULL,
+    student_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    stars INTEGER,
+    feedback TEXT,
+    PRIMARY KEY (teacher_id, student_id, period)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_ratings_student ON ratings(student_id);
+
+CREATE TABLE IF NOT EXISTS switch (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS versions (
+    collection TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=_encode_default)
+
+
+def _flag(value):
+    return None if value is None else int(bool(value))
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Keeps students, teachers, enrollments, ratings and switch state in one SQLite
+    database. Each thread (Streamlit runs one per session) gets its own connection.
+
+    Ratings live in their own table, keyed by (teacher, student, period) and
+    indexed by student as well.
+
+    Every write bumps its collection's row in `versions` in the same
+    transaction, so version() is one primary-key lookup and also sees writes
+    made by other processes.
+    """
+
+    def __init__(self, db_path=DEFAULT_SQLITE_PATH, paths=None):
+        super().__init__(paths)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connect().executescript(SQLITE_SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def load(self, path):
+        collection = self.collection_for(path)
+        if collection is None:
+            raise IOError(f"No SQLite table for {path}")
+        return getattr(self, f"_load_{collection}")(self._connect())
+
+    def save(self, path, data):
+        collection = self.collection_for(path)
+        if collection is None:
+            raise IOError(f"No SQLite table for {path}")
+        conn = self._connect()
+        with conn:
+            getattr(self, f"_save_{collection}")(conn, data)
+            self._bump(conn, collection)
+
+    # Versions
+    @staticmethod
+    def _bump(conn, collection):
+        """Marks collection as changed; call inside the write's transaction."""
+        conn.execute("INSERT INTO versions (collection, version) VALUES (?, 1) "
+                     "ON CONFLICT(collection) DO UPDATE SET version = version + 1", (collection,))
+
+    def version(self, path):
+        collection = self.collection_for(path)
+        if collection is None:
+            return None
+        row = self._connect().execute("SELECT version FROM versions WHERE collection = ?", (collection,)).fetchone()
+        return row[0] if row else 0
+
+    # Students
+    def _load_students(self, conn):
+        return {sid: json.loads(data) for sid, data in conn.execute("SELECT id, data FROM students")}
+
+    def _save_students(self, conn, data):
+        conn.execute("DELETE FROM students")
+        conn.executemany(
+            "INSERT INTO students (id, name, data) VALUES (?, ?, ?)",
+            [(sid, info.get("name") if isinstance(info, dict) else info, _dumps(info))
+             for sid, info in data.items()])
+
+    # Teachers
+    def _load_teachers(self, conn):
+        return {tid: json.loads(data) for tid, data in conn.execute("SELECT id, data FROM teachers")}
+
+    @staticmethod
+    def _teacher_row(tid, record):
+        return (tid, record.get("name"), _flag(record.get("is_active")), _flag(record.get("allow_enroll")),
+                record.get("enrollment_cap"), _dumps(record))
+
+    @staticmethod
+    def _insert_teachers(conn, teacher_rows):
+        conn.executemany(
+            "INSERT OR REPLACE INTO teachers (id, name, is_active, allow_enroll, enrollment_cap, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)", teacher_rows)
+
+    def _save_teachers(self, conn, data):
+        conn.execute("DELETE FROM teachers")
+        self._insert_teachers(conn, [self._teacher_row(tid, details) for tid, details in data.items()])
+
+    def _update_teachers(self, conn, changes):
+        teacher_rows = []
+        for tid, fields in changes.items():
+            row = conn.execute("SELECT data FROM teachers WHERE id = ?", (tid,)).fetchone()
+            teacher_rows.append(self._teacher_row(tid, {**(json.loads(row[0]) if row else {}), **fields}))
+        self._insert_teachers(conn, teacher_rows)
+
+    def _update_students(self, conn, changes):
+        rows = []
+        for sid, fields in changes.items():
+            row = conn.execute("SELECT data FROM students WHERE id = ?", (sid,)).fetchone()
+            record = {**as_record(json.loads(row[0]) if row else None), **fields}
+            rows.append((sid, record.get("name"), _dumps(record)))
+        conn.executemany("INSERT OR REPLACE INTO students (id, name, data) VALUES (?, ?, ?)", rows)
+
+    def update_records(self, path, changes):
+        collection = self.collection_for(path)
+        if collection not in (TEACHERS, STUDENTS):
+            raise IOError(f"Record-level updates are not supported for {path}")
+        conn = self._connect()
+        with conn:
+            getattr(self, f"_update_{collection}")(conn, changes)
+            self._bump(conn, collection)
+
+    def delete_records(self, path, record_ids):
+        collection = self.collection_for(path)
+        if collection not in (TEACHERS, STUDENTS):
+            raise IOError(f"Record-level updates are not supported for {path}")
+        conn = self._connect()
+        with conn:
+            conn.executemany(f"DELETE FROM {collection} WHERE id = ?", [(k,) for k in record_ids])
+            self._bump(conn, collection)
+
+    # Ratings
+    @staticmethod
+    def _nest_ratings(rows):
+        nested = {}
+        for outer, inner, period, stars, feedback in rows:
+            nested.setdefault(outer, {}).setdefault(inner, {})[period] = {"stars": stars, "feedback": feedback}
+        return nested
+
+    def _load_ratings(self, conn):
+        return self._nest_ratings(conn.execute(
+            "SELECT teacher_id, student_id, period, stars, feedback FROM ratings "
+            "ORDER BY teacher_id, student_id, position"))
+
+    def _save_ratings(self, conn, data):
+        conn.execute("DELETE FROM ratings")
+        conn.executemany(
+            "INSERT INTO ratings (teacher_id, student_id, period, position, stars, feedback) VALUES (?, ?, ?, ?, ?, ?)",
+            [(tid, sid, period, position, entry.get("stars"), entry.get("feedback"))
+             for tid, students in data.items() for sid, periods in students.items()
+             for position, (period, entry) in enumerate(periods.items())])
+
+    def append_rating(self, teacher_id, student_id, period, entry):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO ratings (teacher_id, student_id, period, position, stars, feedback) "
+                "SELECT ?, ?, ?, COALESCE(MAX(position) + 1, 0), ?, ? FROM ratings "
+                "WHERE teacher_id = ? AND student_id = ? AND period != ?",
+                (teacher_id, student_id, period, entry.get("stars"), entry.get("feedback"),
+                 teacher_id, student_id, period))
+            self._bump(conn, RATINGS)
+
+    def ratings_for_teacher(self, teacher_id):
+        rows = self._connect().execute(
+            "SELECT student_id, period, stars, feedback FROM ratings WHERE teacher_id = ? "
+            "ORDER BY student_id, position", (teacher_id,))
+        return self._nest_ratings((teacher_id,) + row for row in rows).get(teacher_id, {})
+
+    def ratings_for_student(self, student_id):
+        rows = self._connect().execute(
+            "SELECT teacher_id, period, stars, feedback FROM ratings WHERE student_id = ? "
+            "ORDER BY teacher_id, position", (student_id,))
+        return {tid: periods[student_id] for tid, periods in
+                self._nest_ratings((tid, student_id, p, st, fb) for tid, p, st, fb in rows).items()}
+
+    # Enrollments
+    def _load_enrollments(self, conn):
+        enrollments = {}
+        rows = conn.execute("SELECT teacher_id, student_id FROM enrollments ORDER BY teacher_id, position")
+        for teacher_id, student_id in rows:
+            roster = enrollments.get(teacher_id)
+            if roster is None:
+                roster = enrollments[teacher_id] = Roster()
+            roster.add(student_id)
+        return enrollments
+
+    def enroll(self, teacher_id, student_id):
+        self.enroll_many([(teacher_id, student_id)])
+
+    def cancel(self, teacher_id, student_id):
+        self.cancel_many([(teacher_id, student_id)])
+
+    def enroll_many(self, pairs):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO enrollments (teacher_id, student_id, position) "
+                "SELECT ?, ?, COALESCE(MAX(position) + 1, 0) FROM enrollments WHERE teacher_id = ?",
+                [(t, s, t) for t, s in pairs])
+            self._bump(conn, ENROLLMENTS)
+
+    def cancel_many(self, pairs):
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM enrollments WHERE teacher_id = ? AND student_id = ?", list(pairs))
+            self._bump(conn, ENROLLMENTS)
+
+    def teachers_for_student(self, student_id):
+        rows = self._connect().execute("SELECT teacher_id FROM enrollments WHERE student_id = ?", (student_id,))
+        return {teacher_id for (teacher_id,) in rows}
+
+    def _save_enrollments(self, conn, data):
+        conn.execute("DELETE FROM enrollments")
+        conn.executemany(
+            "INSERT OR IGNORE INTO enrollments (teacher_id, student_id, position) VALUES (?, ?, ?)",
+            [(tid, sid, position) for tid, roster in data.items() for position, sid in enumerate(roster)])
+
+    # Switch
+    def _load_switch(self, conn):
+        return {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM switch")}
+
+    def _save_switch(self, conn, data):
+        conn.execute("DELETE FROM switch")
+        conn.executemany("INSERT INTO switch (key, value) VALUES (?, ?)",
+                         [(key, _dumps(value)) for key, value in data.items()])
+
+
+# --- Backend selection ---
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend(paths=None):
+    """
+    Returns the process-wide backend, creating it on first use.
+
+    Set ENROLL_STORAGE=sqlite (and optionally ENROLL_SQLITE_PATH) to use SQLite;
+    the default is the original JSON files.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            kind = os.environ.get("ENROLL_STORAGE", "json").lower()
+            if kind == "sqlite":
+                _backend = SqliteBackend(os.environ.get("ENROLL_SQLITE_PATH", DEFAULT_SQLITE_PATH), paths)
+            elif kind == "json":
+                _backend = JsonFileBackend(paths)
+            else:
+                raise ValueError(f"Unknown ENROLL_STORAGE backend: {kind}")
+            migrate_ratings(_backend)
+        return _backend
+
+
+def migrate_json_to_sqlite(db_path=DEFAULT_SQLITE_PATH, paths=None):
+    """
+    Copies every JSON database into the SQLite database at db_path, replacing
+    whatever the tables held before. Returns {collection: record count}.
+    """
+    source = JsonFileBackend(paths)
+    target = SqliteBackend(db_path, paths)
+    counts = {}
+    try:
+        for collection, path in source.paths.items():
+            data = source.load(path)
+            target.save(path, data)
+            counts[collection] = len(data)
+        migrate_ratings(target)
+    finally:
+        source.close()
+        target.close()
+    return counts
+
+
+def migrate_ratings(backend):
+    """
+    Moves the `rated` blobs out of teacher records into the ratings store.
+    Safe to run repeatedly; returns the number of rating entries moved.
+    """
+    teachers_path = backend.paths[TEACHERS]
+    teachers = backend.load(teachers_path)
+    if not any("rated" in details for details in teachers.values() if isinstance(details, dict)):
+        return 0
+
+    ratings_path = backend.paths[RATINGS]
+    ratings = copy_state(backend.load(ratings_path))
+    moved = 0
+    for teacher_id, details in teachers.items():
+        rated = details.get("rated") if isinstance(details, dict) else None
+        if not isinstance(rated, dict):
+            continue
+        by_student = dict(ratings.get(teacher_id, {}))
+        for student_id, entries in rated.items():
+            periods = dict(by_student.get(student_id, {}))
+            for entry in entries:
+                periods[entry.get("date", "")] = {"stars": entry.get("stars"), "feedback": entry.get("feedback")}
+                moved += 1
+            by_student[student_id] = periods
+        ratings[teacher_id] = by_student
+    backend.save(ratings_path, ratings)  # Ratings first: a crash in between leaves them duplicated, never lost
+    backend.save(teachers_path, {tid: {k: v for k, v in details.items() if k != "rated"}
+                                 if isinstance(details, dict) else details for tid, details in teachers.items()})
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enrollment storage tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="Copy the JSON databases into SQLite")
+    migrate.add_argument("--db", default=DEFAULT_SQLITE_PATH, help="SQLite database file")
+    sub.add_parser("migrate-ratings", help="Move teacher `rated` blobs into ratings.json")
+    sub.add_parser("migrate-schema", help="Normalize legacy record shapes (see models.py)")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        for collection, count in migrate_json_to_sqlite(args.db).items():
+            print(f"{collection}: {count} records")
+    elif args.command == "migrate-ratings":
+        backend = JsonFileBackend()
+        try:
+            print(f"Moved {migrate_ratings(backend)} rating entries")
+        finally:
+            backend.close()
+    elif args.command == "migrate-schema":
+        import models  # models imports this module
+        backend = get_backend()
+        try:
+            changed = models.migrate(backend)
+            print("\n".join(f"{c}: {n} records normalized" for c, n in changed.items()) or "Already up to date")
+        finally:
+            backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+# geo imports these at module level; stand-ins let its tests run where they are not installed
+for _name, _attrs in (("pycountry", {"countries": []}), ("reverse_geocoder", {"search": None}),
+                      ("timezonefinder", {"TimezoneFinder": None})):
+    try:
+        __import__(_name)
+    except ImportError:
+        sys.modules[_name] = types.SimpleNamespace(__name__=_name, **_attrs)
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return {collection: str(tmp_path / name) for collection, name in storage.DEFAULT_PATHS.items()}
+
+
+@pytest.fixture
+def backend(paths):
+    backend = storage.JsonFileBackend(paths)
+    yield backend
+    backend.close()
+
+
+class FakeCountries(list):
+    def get(self, alpha_2):
+        return next((c for c in self if c.alpha_2 == alpha_2), None)
+
+    def lookup(self, value):
+        value = value.casefold()
+        for c in self:
+            if value in {str(v).casefold() for v in vars(c).values()}:
+                return c
+        raise LookupError(value)
+
+
+@pytest.fixture
+def fake_pycountry():
+    """A few countries (with the awkward ISO names) and subdivisions in pycountry's shape."""
+    def country(alpha_2, alpha_3, name, **names):
+        return types.SimpleNamespace(alpha_2=alpha_2, alpha_3=alpha_3, name=name, **names)
+    subdivisions = {"US": [types.SimpleNamespace(code="US-IL", name="Illinois"),
+                           types.SimpleNamespace(code="US-MA", name="Massachusetts")]}
+    return types.SimpleNamespace(
+        LOCALES_DIR=os.devnull,
+        countries=FakeCountries([
+            country("US", "USA", "United States", official_name="United States of America"),
+            country("RU", "RUS", "Russian Federation"),
+            country("KR", "KOR", "Korea, Republic of"),
+            country("VN", "VNM", "Viet Nam", official_name="Socialist Republic of Viet Nam"),
+            country("TW", "TWN", "Taiwan, Province of China", official_name="Taiwan, Province of China",
+                    common_name="Taiwan")]),
+        subdivisions=types.SimpleNamespace(get=lambda country_code: subdivisions.get(country_code)))
+
+
+@pytest.fixture
+def fake_geonamescache():
+    """geonamescache with a handful of cities; its country names differ from pycountry's on purpose."""
+    countries = {"US": {"iso3": "USA", "name": "United States"}, "RU": {"iso3": "RUS", "name": "Russia"},
+                 "KR": {"iso3": "KOR", "name": "South Korea"}, "VN": {"iso3": "VNM", "name": "Vietnam"},
+                 "TW": {"iso3": "TWN", "name": "Taiwan"}}
+    cities = [("Springfield", "US", "IL", "America/Chicago", 116000),
+              ("Springfield", "US", "MA", "America/New_York", 155000),
+              ("Springfield", "US", "MO", "America/Chicago", 169000),
+              ("Boston", "US", "MA", "America/New_York", 667000),
+              ("Salem", "US", "MA", "America/New_York", 44000),
+              ("Moscow", "RU", "48", "Europe/Moscow", 10381222),
+              ("Seoul", "KR", "11", "Asia/Seoul", 10349312),
+              ("Hanoi", "VN", "44", "Asia/Bangkok", 1431270),
+              ("Taipei", "TW", "03", "Asia/Taipei", 7871900),
+              ("Atlantis", "US", "FL", "Not/AZone", 1)]
+    cities = {str(i): {"name": name, "countrycode": cc, "admin1code": admin1, "timezone": zone, "population": people}
+              for i, (name, cc, admin1, zone, people) in enumerate(cities)}
+
+    class GeonamesCache:
+        def get_countries(self):
+            return countries
+
+        def get_us_states(self):
+            return {"IL": {"name": "Illinois"}, "MA": {"name": "Massachusetts"}, "MO": {"name": "Missouri"}}
+
+        def get_cities(self):
+            return cities
+    return types.SimpleNamespace(GeonamesCache=GeonamesCache)
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import storage
+
+RECORDS = {
+    "teachers": {"t1": {"name": "王老师", "subject_en": "Math", "grade": "5", "enrollment_cap": 12, "rating": 4.5,
+                        "is_active": True, "allow_enroll": False, "timezone": "Asia/Shanghai"}},
+    "students": {"s1": {"name": "Zoë \"Z\" Müller", "country": "Viet Nam", "city": "Hà Nội", "timezone": None},
+                 "s2": "Bare name from an old version"},
+    "ratings": {"t1": {"s1": {"2026-01-07 08:00-2026-01-08 08:00": {"stars": 5, "feedback": "很好 👍\nline two"}}}},
+    "switch": {"rating": False, "Open Enrollment Delay": "2 days, 0:00:00",
+               "Schedule Overrides": {"2026-01-10 08:00": {"skip": True}}, "schema_version": 2},
+    "nested": {"lists": [[1, 2, [3]], [], [{"a": []}]], "big": 2 ** 53 + 1, "negative": -7, "zero": 0},
+}
+
+
+@pytest.mark.parametrize("name", ["pretty", "compact", "fast"])
+def test_round_trip_keeps_the_real_record_shapes(name):
+    codec = storage.CODECS[name]
+    for data in RECORDS.values():
+        decoded = codec.decode(codec.encode(data))
+        assert decoded == data
+        assert json.dumps(decoded, sort_keys=True) == json.dumps(data, sort_keys=True)  # Same types too
+        assert codec.decode(codec.encode_line(data)) == data
+        assert b"\n" not in codec.encode_line(data)
+    assert type(codec.decode(codec.encode(RECORDS["teachers"]))["t1"]["enrollment_cap"]) is int
+    assert codec.decode(codec.encode(RECORDS["nested"]))["big"] == 2 ** 53 + 1
+
+
+def test_every_codec_reads_what_the_others_write():
+    for writer in storage.CODECS.values():
+        for reader in storage.CODECS.values():
+            assert reader.decode(writer.encode(RECORDS)) == RECORDS
+
+
+def test_rosters_are_written_as_lists():
+    data = storage.decode_enrollments({"t1": ["s2", "s1"], "t2": []})
+    for codec in storage.CODECS.values():
+        assert codec.decode(codec.encode(data)) == {"t1": ["s2", "s1"], "t2": []}
+
+
+def test_fast_codec_without_orjson_uses_msgspec(monkeypatch):
+    pytest.importorskip("msgspec")
+    monkeypatch.setattr(storage, "orjson", None)
+    codec = storage._fast_codec()
+    assert codec.decode(codec.encode(RECORDS)) == RECORDS
+    with pytest.raises(ValueError):
+        codec.decode(b'{"t1": ')
+
+
+def test_fast_codec_falls_back_to_the_stdlib(monkeypatch):
+    monkeypatch.setattr(storage, "orjson", None)
+    monkeypatch.setattr(storage, "msgspec", None)
+    codec = storage._fast_codec()
+    assert codec.encode is storage._stdlib_compact
+    assert codec.decode(codec.encode(RECORDS)) == RECORDS
+    assert storage.CODECS["pretty"].decode(codec.encode(RECORDS)) == RECORDS
+    with pytest.raises(ValueError):
+        codec.decode(b'{"t1": ')
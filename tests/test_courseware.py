@@ -0,0 +1,96 @@
+import io
+import os
+
+import pytest
+
+import courseware
+import models
+import storage
+
+
+def blob_totals(store):
+    blobs = list(store._blobs())
+    return len(blobs), sum(os.path.getsize(p) for p in blobs)
+
+
+def test_card_lookups_do_not_touch_the_file_system(tmp_path, monkeypatch):
+    store = courseware.CoursewareStore(str(tmp_path), check_interval=3600)
+    store.put("t1", "deck.pdf", io.BytesIO(b"v1"))
+    stats = []
+    signature = storage.JsonFileCache.signature
+    monkeypatch.setattr(storage.JsonFileCache, "signature", staticmethod(lambda p: stats.append(p) or signature(p)))
+    os_stat = os.stat
+    monkeypatch.setattr(os, "stat", lambda *a, **k: stats.append(a[0]) or os_stat(*a, **k))
+    for _ in range(100):
+        assert store.info("t1")["filename"] == "deck.pdf"
+        assert [f["filename"] for f in store.files("t1")] == ["deck.pdf"]
+        assert store.path("t1").endswith(os.path.join("deck.pdf", "v1"))
+    monkeypatch.undo()
+    assert stats == []
+
+
+def test_writes_by_another_process_are_picked_up(tmp_path):
+    store = courseware.CoursewareStore(str(tmp_path), check_interval=0)
+    store.put("t1", "deck.pdf", io.BytesIO(b"v1"))
+    other = courseware.CoursewareStore(str(tmp_path))
+    other.put("t2", "notes.txt", io.BytesIO(b"n"))
+    version = store.version
+    assert store.info("t2")["filename"] == "notes.txt"
+    assert store.version > version
+
+
+def test_stats_are_kept_up_to_date_without_walking(tmp_path):
+    store = courseware.CoursewareStore(str(tmp_path), keep_versions=1)
+    store.put("t1", "deck.pdf", io.BytesIO(b"v1"))
+    assert (store.stats()["blobs"], store.stats()["bytes"]) == blob_totals(store)
+    store.put("t1", "deck.pdf", io.BytesIO(b"v2-longer"))
+    store.put("t2", "deck.pdf", io.BytesIO(b"v1"))  # Deduplicated
+    assert (store.stats()["blobs"], store.stats()["bytes"]) == blob_totals(store) == (2, 11)
+    store.prune()
+    store.remove("t2")
+    assert (store.stats()["blobs"], store.stats()["bytes"]) == blob_totals(store) == (1, 9)
+    assert store.stats()["versions"] == 1
+
+
+def test_versions_and_latest_pointer(tmp_path):
+    store = courseware.CoursewareStore(str(tmp_path))
+    store.put("t1", "deck.pdf", io.BytesIO(b"v1"))
+    store.put("t1", "deck.pdf", io.BytesIO(b"v2"))
+    assert store.info("t1")["version"] == 2
+    with open(store.path("t1", "deck.pdf", 1), "rb") as f:
+        assert f.read() == b"v1"
+
+    store.put("t1", "notes.txt", io.BytesIO(b"n"))
+    assert store.info("t1")["filename"] == "notes.txt"
+    # Re-uploading deck.pdf unchanged adds no version but makes it the latest again
+    store.put("t1", "deck.pdf", io.BytesIO(b"v2"))
+    assert store.info("t1")["filename"] == "deck.pdf"
+    assert store.info("t1")["version"] == 2
+    assert [f["filename"] for f in store.files("t1")] == ["deck.pdf", "notes.txt"]
+
+
+def test_saving_the_teacher_table_unchanged_keeps_courseware(tmp_path):
+    store = courseware.CoursewareStore(str(tmp_path))
+    store.put("t1", "deck.pdf", io.BytesIO(b"v1"))
+    teachers = {"t1": {"name": "Ms. Li"}, "t2": {"name": "Mr. Wu"}}
+    for teacher_id in models.removed_teachers(teachers, set(teachers)):
+        store.remove(teacher_id)
+    assert [f["filename"] for f in store.files("t1")] == ["deck.pdf"]
+    assert models.removed_teachers(teachers, {"t2"}) == ["t1"]
+
+
+def test_put_fails_without_hard_links(tmp_path, monkeypatch):
+    store = courseware.CoursewareStore(str(tmp_path))
+    store.put("t1", "deck.pdf", io.BytesIO(b"v1"))
+
+    def no_link(src, dst):
+        raise OSError(1, "Operation not permitted")
+    monkeypatch.setattr(os, "link", no_link)
+    with pytest.raises(OSError):
+        store.put("t1", "deck.pdf", io.BytesIO(b"v2"))
+    monkeypatch.undo()
+    assert store.info("t1")["version"] == 1
+    store.collect_garbage()  # Drops the unlinked v2 blob, keeps v1
+    with open(store.path("t1"), "rb") as f:
+        assert f.read() == b"v1"
+    assert store.stats()["blobs"] == 1
@@ -0,0 +1,156 @@
+import datetime
+import json
+
+import pytest
+
+import enroll_schedule
+import storage
+
+SCHEDULE = {
+    "Open Enrollment Date": "2026-01-05 08:00",
+    "Close Enrollment Date": "2026-01-06 08:00",
+    "Open Ratings Date": "2026-01-07 08:00",
+    "Close Ratings Date": "2026-01-08 08:00",
+    "Open Enrollment Delay": "2 days, 0:00:00",
+    "rating": False, "all_hidden": False, "all_closed": True,
+}
+
+
+def at(text):
+    return enroll_schedule.parse_instant(text)
+
+
+def executor(backend, tmp_path):
+    return enroll_schedule.ScheduleExecutor(backend, log_path=str(tmp_path / "schedule_log.jsonl"))
+
+
+def fired(backend, paths):
+    return backend.load(paths[storage.SWITCH])[enroll_schedule.FIRED_KEY]
+
+
+def test_due_transition_fires_exactly_once(backend, paths, tmp_path):
+    backend.save(paths[storage.SWITCH], SCHEDULE)
+    runner = executor(backend, tmp_path)
+    assert runner.run_pending(at("2026-01-04 00:00")) == [enroll_schedule.SYNC]  # First sight of the schedule
+    assert runner.run_pending(at("2026-01-04 00:00")) == []
+
+    assert runner.run_pending(at("2026-01-05 09:00")) == [enroll_schedule.OPEN_ENROLLMENT]
+    assert runner.run_pending(at("2026-01-05 09:30")) == []
+    assert backend.load(paths[storage.SWITCH])["all_closed"] is False
+    assert fired(backend, paths)["at"] == "2026-01-05 08:00"
+
+    # Woken late: everything missed since is applied once, in order
+    assert runner.run_pending(at("2026-01-07 09:00")) == [enroll_schedule.CLOSE_ENROLLMENT,
+                                                          enroll_schedule.OPEN_RATINGS]
+    switch = backend.load(paths[storage.SWITCH])
+    assert (switch["all_closed"], switch["rating"]) == (True, True)
+    with open(tmp_path / "schedule_log.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line)["action"] for line in f] == ["sync", "open_enrollment", "close_enrollment",
+                                                               "open_ratings"]
+
+
+def test_nothing_refires_after_a_restart(backend, paths, tmp_path):
+    backend.save(paths[storage.SWITCH], SCHEDULE)
+    executor(backend, tmp_path).run_pending(at("2026-01-05 09:00"))
+    backend.close()
+
+    reopened = storage.JsonFileBackend(paths)  # A new server process on the same switch.json
+    try:
+        runner = executor(reopened, tmp_path)
+        assert runner.run_pending(at("2026-01-05 10:00")) == []
+        assert runner.run_pending(at("2026-01-06 08:00")) == [enroll_schedule.CLOSE_ENROLLMENT]
+    finally:
+        reopened.close()
+
+
+def test_sync_reconciles_the_switches_after_a_schedule_edit(backend, paths, tmp_path):
+    backend.save(paths[storage.SWITCH], SCHEDULE)
+    runner = executor(backend, tmp_path)
+    runner.run_pending(at("2026-01-05 09:00"))
+    assert backend.load(paths[storage.SWITCH])["all_closed"] is False
+
+    # The admin moves the cycle so that "now" is in its ratings window
+    edited = {**backend.load(paths[storage.SWITCH]), "Open Enrollment Date": "2026-01-01 08:00",
+              "Close Enrollment Date": "2026-01-02 08:00", "Open Ratings Date": "2026-01-05 08:00",
+              "Close Ratings Date": "2026-01-06 08:00"}
+    backend.save(paths[storage.SWITCH], edited)
+    assert runner.run_pending(at("2026-01-05 10:00")) == [enroll_schedule.SYNC]
+    switch = backend.load(paths[storage.SWITCH])
+    assert (switch["all_closed"], switch["rating"]) == (True, True)
+    assert fired(backend, paths) == {"schedule": enroll_schedule.schedule_signature(edited), "at": "2026-01-05 08:00"}
+    # The boundaries the sync already covered do not fire again; the next one does
+    assert runner.run_pending(at("2026-01-05 11:00")) == []
+    assert runner.run_pending(at("2026-01-06 08:00")) == [enroll_schedule.CLOSE_RATINGS]
+
+
+def test_phase_at_and_next_transition():
+    timeline = enroll_schedule.Timeline({**SCHEDULE, "Open Enrollment Delay": None}, at("2026-01-01 00:00"))
+    phases = [(text, timeline.phase_at(at(text))) for text in
+              ("2026-01-05 07:59", "2026-01-05 08:00", "2026-01-06 12:00", "2026-01-07 08:00", "2026-01-09 00:00")]
+    assert phases == [("2026-01-05 07:59", enroll_schedule.BEFORE), ("2026-01-05 08:00", enroll_schedule.ENROLLMENT),
+                      ("2026-01-06 12:00", enroll_schedule.CLOSED), ("2026-01-07 08:00", enroll_schedule.RATING),
+                      ("2026-01-09 00:00", enroll_schedule.GAP)]
+    assert timeline.flags_at(at("2026-01-05 12:00")) == {"all_closed": False, "rating": False}
+    assert timeline.next_transition(at("2026-01-05 08:00")) == (at("2026-01-06 08:00"),
+                                                                 enroll_schedule.CLOSE_ENROLLMENT)
+    assert timeline.next_transition(at("2026-01-08 08:00")) is None  # A one-off schedule ends
+    assert not enroll_schedule.Timeline({"rating": False})  # Nothing saved
+    assert enroll_schedule.Timeline({"rating": False}).phase_at(at("2026-01-05 08:00")) is None
+
+
+def test_validate_cycle_rejects_out_of_order_and_overlapping_cycles():
+    cycle = [at("2026-01-12 08:00"), at("2026-01-13 08:00"), at("2026-01-14 08:00"), at("2026-01-15 08:00")]
+    enroll_schedule.validate_cycle(cycle, previous_end=at("2026-01-08 08:00"), next_start=at("2026-01-17 08:00"))
+    with pytest.raises(ValueError):  # Ratings open before enrollment closes
+        enroll_schedule.validate_cycle([cycle[0], cycle[2], cycle[1], cycle[3]])
+    with pytest.raises(ValueError):  # Closes before it opens
+        enroll_schedule.validate_cycle([cycle[1], cycle[0], cycle[2], cycle[3]])
+    with pytest.raises(ValueError):  # Overlaps the previous cycle's ratings
+        enroll_schedule.validate_cycle(cycle, previous_end=at("2026-01-12 09:00"))
+    with pytest.raises(ValueError):  # Runs into the next cycle
+        enroll_schedule.validate_cycle(cycle, next_start=at("2026-01-15 07:00"))
+
+
+def test_override_moves_or_skips_one_occurrence_only():
+    recurrence = enroll_schedule.Recurrence(SCHEDULE)  # Every 5 days from 2026-01-05 08:00
+    moved = [at("2026-01-10 12:00"), at("2026-01-11 08:00"), at("2026-01-12 08:00"), at("2026-01-13 08:00")]
+    switch = enroll_schedule.with_override(SCHEDULE, "2026-01-10 08:00", moved)
+    cycles = enroll_schedule.Recurrence(switch).cycles(0, 3)
+    assert cycles[1].instants == moved and cycles[1].overridden
+    assert [c.instants for c in (cycles[0], cycles[2])] == [recurrence.cycle(0).instants, recurrence.cycle(2).instants]
+    assert SCHEDULE.get(enroll_schedule.OVERRIDES_KEY) is None  # The caller's dict is left alone
+
+    skipped = enroll_schedule.with_override(switch, "2026-01-15 08:00", skip=True)
+    timeline = enroll_schedule.Timeline(skipped, at("2026-01-14 00:00"))
+    assert timeline.next_transition(at("2026-01-14 00:00"))[0] == at("2026-01-20 08:00")  # Cycle 2 does not run
+    restored = enroll_schedule.with_override(skipped, "2026-01-10 08:00")
+    assert enroll_schedule.Recurrence(restored).cycle(1).instants == recurrence.cycle(1).instants
+
+    with pytest.raises(ValueError):  # Not the start of a cycle
+        enroll_schedule.with_override(SCHEDULE, "2026-01-11 08:00", skip=True)
+    with pytest.raises(ValueError):  # Would run into the next occurrence
+        enroll_schedule.with_override(SCHEDULE, "2026-01-10 08:00", moved[:3] + [at("2026-01-15 09:00")])
+
+
+def test_weekly_window_rolls_over_the_week_boundary(backend, paths):
+    # Enrollment Saturday evening to Sunday evening, ratings on Monday; every 7 days
+    weekly = {**SCHEDULE, "Open Enrollment Date": "2026-01-10 20:00", "Close Enrollment Date": "2026-01-11 20:00",
+              "Open Ratings Date": "2026-01-12 08:00", "Close Ratings Date": "2026-01-12 20:00",
+              "Open Enrollment Delay": "5 days, 0:00:00"}
+    backend.save(paths[storage.SWITCH], weekly)
+    first = enroll_schedule.get_timeline(backend, at("2026-01-10 00:00"))
+    assert enroll_schedule.get_timeline(backend, at("2026-01-11 00:00")) is first  # Same switch.json, same window
+
+    later = at("2026-01-10 20:00") + datetime.timedelta(weeks=enroll_schedule.LOOKAHEAD + 2)
+    assert first.expired(later)
+    timeline = enroll_schedule.get_timeline(backend, later)
+    assert timeline is not first
+
+    def hours(n):  # Saturday 20:00 + n hours
+        return later + datetime.timedelta(hours=n)
+    assert timeline.phase_at(hours(4)) == enroll_schedule.ENROLLMENT  # Past midnight into Sunday
+    assert timeline.phase_at(hours(40)) == enroll_schedule.RATING  # Monday noon
+    assert timeline.due(hours(40), after=hours(1)) == [(hours(24), enroll_schedule.CLOSE_ENROLLMENT),
+                                                       (hours(36), enroll_schedule.OPEN_RATINGS)]
+    assert timeline.next_transition(hours(40)) == (hours(48), enroll_schedule.CLOSE_RATINGS)
+    assert timeline.next_transition(hours(48)) == (hours(7 * 24), enroll_schedule.OPEN_ENROLLMENT)
@@ -0,0 +1,202 @@
+import concurrent.futures
+import sys
+import types
+
+import pytest
+
+import geo
+import storage
+
+
+@pytest.fixture
+def country_names(monkeypatch, fake_pycountry):
+    """geo.country_name() over the fake pycountry (it is lru_cached, so start and end empty)."""
+    geo.country_name.cache_clear()
+    monkeypatch.setattr(geo, "pycountry", fake_pycountry)
+    yield
+    geo.country_name.cache_clear()
+
+
+@pytest.fixture
+def city_index(tmp_path, monkeypatch, fake_pycountry, fake_geonamescache):
+    monkeypatch.setattr(geo, "pycountry", fake_pycountry)
+    monkeypatch.setitem(sys.modules, "geonamescache", fake_geonamescache)
+    path = str(tmp_path / "city_timezones.idx")
+    geo.build_city_timezone_index(path)
+    return geo.CityTimezoneIndex(path)
+
+
+def test_country_names_from_the_location_picker_resolve(city_index):
+    # The picker stores pycountry's names, which geonamescache spells differently
+    assert city_index.country_code("Russian Federation") == "RU"
+    assert city_index.country_code("Socialist Republic of Viet Nam") == "VN"
+    assert city_index.timezone("Korea, Republic of", "Seoul") == "Asia/Seoul"
+    assert city_index.timezone("Taiwan, Province of China", "Taipei") == "Asia/Taipei"
+    assert city_index.timezone("Vietnam", "Hanoi") == "Asia/Bangkok"  # geonamescache's own name still works
+
+
+def test_index_built_without_pycountry_names_falls_back_to_a_lookup(tmp_path, monkeypatch, fake_pycountry,
+                                                                     fake_geonamescache):
+    monkeypatch.setattr(geo, "pycountry", type(fake_pycountry)(countries=[]))
+    monkeypatch.setitem(sys.modules, "geonamescache", fake_geonamescache)
+    path = str(tmp_path / "city_timezones.idx")
+    geo.build_city_timezone_index(path)
+    monkeypatch.setattr(geo, "pycountry", fake_pycountry)
+    index = geo.CityTimezoneIndex(path)
+    assert index.timezone("Russian Federation", "Moscow") == "Europe/Moscow"
+    assert index.country_code("Atlantis") is None
+
+
+def test_one_timezone_finder_serves_every_thread(monkeypatch):
+    created = []
+
+    class Finder:
+        def __init__(self, in_memory):
+            created.append(in_memory)
+
+        def timezone_at(self, lng, lat):
+            return None if lat == 0 else "Europe/London"
+    monkeypatch.setattr(geo, "TimezoneFinder", Finder)
+    service = geo.TimezoneService()
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        zones = list(pool.map(lambda _: service.timezone_at(51.5, -0.1), range(32)))
+    assert zones == ["Europe/London"] * 32
+    assert created == [False]  # Built (and warmed) once, not per lookup
+    assert service.timezone_at(0.0, 0.0) is None  # Open sea
+    stats = service.stats()
+    assert (stats["lookups"], stats["misses"]) == (33, 1)
+    assert stats["warm_ms"] is not None
+
+
+def test_reverse_geocoder_batches_lookups_that_arrive_together(monkeypatch, country_names):
+    batches = []
+
+    def search(points, mode, verbose):
+        batches.append(len(points))
+        return [{"name": f"City {lat:g}", "admin1": "Somewhere", "cc": "US"} for lat, _ in points]
+    monkeypatch.setattr(geo, "rg", types.SimpleNamespace(search=search))
+    geocoder = geo.ReverseGeocoder(batch_window=0.2)
+    geocoder.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(16) as pool:
+            places = list(pool.map(lambda i: geocoder.lookup(i, 0.0), range(16)))
+    finally:
+        geocoder.stop()
+    assert places[3] == geo.Place("City 3", "Somewhere", "US", "United States")
+    assert batches[0] == 1  # The warm-up query
+    assert sum(batches[1:]) == 16 and len(batches) - 1 < 16
+    assert geocoder.stats()["lookups"] == 16
+
+
+def test_reverse_geocoder_failures_reach_every_caller(monkeypatch, country_names):
+    def search(points, mode, verbose):
+        raise RuntimeError("dataset missing")
+    monkeypatch.setattr(geo, "rg", types.SimpleNamespace(search=search))
+    geocoder = geo.ReverseGeocoder(batch_window=0.0)
+    geocoder.start()
+    try:
+        with pytest.raises(RuntimeError):
+            geocoder.lookup(1.0, 2.0)
+        with pytest.raises(RuntimeError):
+            geocoder.lookup(3.0, 4.0)  # The worker is still alive after a failed batch
+    finally:
+        geocoder.stop()
+
+
+def test_city_index_binary_search(city_index, tmp_path):
+    # Every line is found, whatever its position in the file
+    with open(city_index.path, "rb") as f:
+        lines = [line.rstrip(b"\n").partition(b"\t") for line in f]
+    assert all(city_index._get(key) == value.decode("utf-8") for key, _, value in lines)
+    assert city_index._get(b"") is None and city_index._get(b"\xff") is None  # Before the first, after the last
+
+    assert city_index.candidates("United States", "Springfield") == ["America/Chicago", "America/New_York"]
+    assert city_index.timezone("USA", " springfield ") == "America/Chicago"  # Most populous first
+    assert city_index.timezone("US", "Springfield", "Massachusetts") == "America/New_York"
+    assert city_index.timezone("US", "Springfield", "MA") == "America/New_York"
+    assert city_index.timezone("US", "Springfield", "Texas") == "America/Chicago"  # Unknown state: whole country
+    assert city_index.timezone("US", "Nowhere") is None
+    assert city_index.timezone("Atlantis", "Boston") is None
+    assert city_index.timezone("US", "Atlantis") is None  # Its zone is not a real IANA zone
+    assert city_index.stats()["lookups"] == 8
+
+    empty = tmp_path / "empty.idx"
+    empty.write_bytes(b"")
+    assert geo.CityTimezoneIndex(str(empty)).timezone("US", "Boston") is None
+
+
+def test_grid_cache_expires_entries_after_the_ttl(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(geo.time, "monotonic", lambda: clock[0])
+    cache, computed = geo.GridCache(grid_km=1.0, ttl=60.0), []
+
+    def compute():
+        computed.append(1)
+        return len(computed)
+    assert cache.get(40.0, -74.0, compute) == 1
+    assert cache.get(40.001, -74.001, compute) == 1  # ~150 m away: same cell
+    clock[0] += 59
+    assert cache.get(40.0, -74.0, compute) == 1
+    clock[0] += 2
+    assert cache.get(40.0, -74.0, compute) == 2  # Expired: computed again
+    assert cache.get(40.05, -74.0, compute) == 3  # ~5.5 km north: another cell
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 3
+
+
+def test_grid_cache_evicts_the_least_recently_used_cell():
+    cache = geo.GridCache(grid_km=1.0, maxsize=2)
+    values = iter(range(100))
+    a, b, c = (10.0, 10.0), (20.0, 20.0), (30.0, 30.0)
+    first_a, first_b = cache.get(*a, lambda: next(values)), cache.get(*b, lambda: next(values))
+    assert cache.get(*a, lambda: next(values)) == first_a  # a is now the most recently used
+    cache.get(*c, lambda: next(values))  # Evicts b
+    assert cache.get(*a, lambda: next(values)) == first_a
+    assert cache.get(*b, lambda: next(values)) != first_b
+    assert cache.stats()["entries"] == 2
+
+
+def test_failed_resolutions_are_not_cached():
+    class Geocoder:
+        calls = 0
+
+        def lookup(self, latitude, longitude):
+            self.calls += 1
+            if self.calls == 1:
+                raise TimeoutError
+            return geo.Place("Boston", "Massachusetts", "US", "United States")
+    timezones = types.SimpleNamespace(timezone_at=lambda latitude, longitude: "America/New_York")
+    resolver = geo.LocationResolver(timezones, Geocoder(), geo.GridCache())
+    with pytest.raises(TimeoutError):
+        resolver.resolve(42.36, -71.06)
+    assert resolver.resolve(42.36, -71.06).timezone == "America/New_York"
+    assert resolver.resolve(42.3601, -71.0601).city == "Boston"
+    assert resolver.cache.stats() == {"hits": 1, "misses": 2, "entries": 1, "hit_rate": 1 / 3}
+
+
+def test_backfill_locations_reports_a_status_per_student(backend, paths, city_index):
+    boston = {"country": "United States", "state": "Massachusetts", "city": "Boston"}
+    springfield = {"country": "United States", "state": "Illinois", "city": "Springfield"}
+    backend.save(paths[storage.STUDENTS], {
+        "ok": {"name": "A", **boston, "timezone": "America/New_York"},
+        "filled": {"name": "B", **boston, "timezone": ""},
+        "fixed": {"name": "C", **springfield, "timezone": "Mars/Olympus_Mons"},
+        "mismatch": {"name": "D", **boston, "timezone": "America/Chicago"},
+        "not offered": {"name": "E", "country": "Korea, Republic of", "city": "Seoul", "timezone": ""},
+        "unresolved": {"name": "F", "country": "United States", "city": "Nowhere", "timezone": ""},
+        "no location": {"name": "G", "country": "United States", "timezone": ""},
+        "legacy": "H",  # Bare-name record from an old version: no location, no timezone
+    })
+
+    report = geo.backfill_locations(backend, city_index, dry_run=True)
+    assert report["counts"] == {"ok": 1, "filled": 1, "fixed": 1, "mismatch": 1, "not offered": 1,
+                                "unresolved": 1, "no location": 2}
+    assert report["written"] == 0
+    assert backend.load(paths[storage.STUDENTS])["filled"]["timezone"] == ""
+    assert {row["student_id"]: row["resolved"] for row in report["issues"]}["fixed"] == "America/Chicago"
+
+    report = geo.backfill_locations(backend, city_index)
+    assert report["written"] == 2
+    students = backend.load(paths[storage.STUDENTS])
+    assert (students["filled"]["timezone"], students["fixed"]["timezone"]) == ("America/New_York", "America/Chicago")
+    assert students["mismatch"]["timezone"] == "America/Chicago"  # Reported, not changed
+    assert geo.backfill_locations(backend, city_index)["counts"]["ok"] == 3
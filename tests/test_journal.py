@@ -0,0 +1,107 @@
+import hashlib
+import json
+
+import storage
+
+
+def write_lines(path, *records, tail=b""):
+    with open(path, "ab") as f:
+        for record in records:
+            f.write(json.dumps(record).encode("utf-8") + b"\n")
+        f.write(tail)
+
+
+def reset_marker(payload):
+    return {"op": "reset", "sha256": hashlib.sha256(payload).hexdigest()}
+
+
+def test_load_returns_a_snapshot_appends_do_not_change(tmp_path):
+    journal = storage.Journal(str(tmp_path / "teachers.json"))
+    journal.append({"op": "update", "k": "t1", "f": {"name": "A"}})
+    before = journal.load()
+    journal.append({"op": "update", "k": "t2", "f": {"name": "B"}},
+                   {"op": "update", "k": "t1", "f": {"name": "A2"}},
+                   {"op": "delete", "k": "t1"})
+    assert before == {"t1": {"name": "A"}}
+    assert journal.load() == {"t2": {"name": "B"}}
+    journal.close()
+
+
+def test_replace_does_not_adopt_the_callers_dict(tmp_path):
+    journal = storage.Journal(str(tmp_path / "teachers.json"))
+    data = {"t1": {"name": "A"}}
+    journal.replace(data)
+    data["t2"] = {"name": "B"}
+    assert journal.load() == {"t1": {"name": "A"}}
+    journal.close()
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    snapshot = tmp_path / "teachers.json"
+    snapshot.write_bytes(b'{"t1": {"name": "A"}}')
+    write_lines(str(snapshot) + ".journal", {"op": "update", "k": "t2", "f": {"name": "B"}},
+                tail=b'{"op": "update", "k": "t3", "f": {"na')  # Crash mid-append
+    journal = storage.Journal(str(snapshot))
+    assert journal.load() == {"t1": {"name": "A"}, "t2": {"name": "B"}}
+    journal.close()
+
+
+def test_reset_marker_skips_records_the_snapshot_already_covers(tmp_path):
+    # replace() crashed after writing the new snapshot but before deleting the log
+    snapshot = tmp_path / "enrollments.json"
+    payload = b'{"t1": ["s1", "s2"]}'
+    snapshot.write_bytes(payload)
+    write_lines(str(snapshot) + ".journal", {"op": "cancel", "t": "t1", "s": "s1"}, reset_marker(payload),
+                {"op": "enroll", "t": "t1", "s": "s3"})
+    journal = storage.Journal(str(snapshot), storage.decode_enrollments)
+    assert journal.load() == {"t1": ["s1", "s2", "s3"]}
+    journal.close()
+
+
+def test_reset_marker_for_an_unwritten_snapshot_is_ignored(tmp_path):
+    # replace() crashed after the marker but before the snapshot was swapped in
+    snapshot = tmp_path / "enrollments.json"
+    snapshot.write_bytes(b'{"t1": ["s1"]}')
+    write_lines(str(snapshot) + ".journal", {"op": "enroll", "t": "t1", "s": "s2"},
+                reset_marker(b'{"t1": ["s9"]}'))
+    journal = storage.Journal(str(snapshot), storage.decode_enrollments)
+    assert journal.load() == {"t1": ["s1", "s2"]}
+    journal.close()
+
+
+def test_interrupted_compaction_is_replayed_and_finished(tmp_path):
+    # Crash after the log was moved aside, before the compacted snapshot was written
+    snapshot = tmp_path / "enrollments.json"
+    snapshot.write_bytes(b'{"t1": ["s1"]}')
+    write_lines(str(snapshot) + ".journal.compacting", {"op": "enroll", "t": "t1", "s": "s2"})
+    write_lines(str(snapshot) + ".journal", {"op": "cancel", "t": "t1", "s": "s1"})
+    journal = storage.Journal(str(snapshot), storage.decode_enrollments)
+    assert journal.load() == {"t1": ["s2"]}
+    journal.close()
+    assert not (tmp_path / "enrollments.json.journal.compacting").exists()
+    assert json.loads(snapshot.read_bytes()) == {"t1": ["s2"]}
+
+
+def test_compaction_swapped_in_but_not_cleaned_up(tmp_path):
+    # Crash after the compacted snapshot replaced the old one, before .compacting was deleted
+    snapshot = tmp_path / "enrollments.json"
+    payload = b'{"t1": ["s1", "s2"]}'
+    snapshot.write_bytes(payload)
+    write_lines(str(snapshot) + ".journal.compacting", {"op": "enroll", "t": "t1", "s": "s1"},
+                {"op": "enroll", "t": "t1", "s": "s2"}, reset_marker(payload))
+    write_lines(str(snapshot) + ".journal", {"op": "cancel", "t": "t1", "s": "s1"})
+    journal = storage.Journal(str(snapshot), storage.decode_enrollments)
+    assert journal.load() == {"t1": ["s2"]}
+    journal.close()
+
+
+def test_compaction_round_trip(tmp_path):
+    path = str(tmp_path / "enrollments.json")
+    journal = storage.Journal(path, storage.decode_enrollments, compact_after=10**9)
+    journal.append(*({"op": "enroll", "t": "t1", "s": f"s{i}"} for i in range(5)))
+    journal.compact()
+    journal.append({"op": "cancel", "t": "t1", "s": "s0"})
+    journal.close()
+    reopened = storage.Journal(path, storage.decode_enrollments)
+    assert reopened.load() == {"t1": ["s1", "s2", "s3", "s4"]}
+    reopened.close()
@@ -0,0 +1,46 @@
+import logging
+import time
+
+import live
+import storage
+
+
+def test_check_publishes_only_what_changed(backend, paths):
+    backend.save(paths[storage.SWITCH], {"rating": False, "all_hidden": False, "all_closed": False})
+    backend.update_records(paths[storage.TEACHERS], {"t1": {"name": "A"}, "t2": {"name": "B"}})
+    hub = live.Hub(backend)
+    assert hub.check() == set()  # First pass only records the state
+
+    t1 = (live.SWITCH_TOPIC, live.teacher_topic("t1"))
+    t2 = (live.SWITCH_TOPIC, live.teacher_topic("t2"))
+    before = hub.token(t1), hub.token(t2)
+    backend.update_records(paths[storage.TEACHERS], {"t2": {"allow_enroll": False}})
+    assert hub.check() == {live.teacher_topic("t2")}
+    assert hub.token(t1) == before[0]
+    assert hub.token(t2) != before[1]
+
+    backend.update_records(paths[storage.TEACHERS], {"t1": {"name": "A2"}})  # Not an availability change
+    assert hub.check() == set()
+
+    backend.save(paths[storage.SWITCH], {"rating": False, "all_hidden": False, "all_closed": True})
+    assert hub.check() == {live.SWITCH_TOPIC, live.teacher_topic("t1")}  # t2 was closed already
+    assert hub.token(t1) != before[0]
+
+
+def test_failed_checks_are_logged_and_the_watcher_keeps_going(backend, caplog, monkeypatch):
+    hub = live.Hub(backend, poll_interval=0.01)
+    passes = []
+
+    def check():
+        passes.append(1)
+        if len(passes) == 1:
+            raise OSError("switch.json unreadable")
+    monkeypatch.setattr(hub, "check", check)
+    with caplog.at_level(logging.ERROR, logger="live"):
+        hub.start()
+        deadline = time.monotonic() + 5
+        while len(passes) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        hub.stop()
+    assert len(passes) >= 2
+    assert [r.exc_info[1].args[0] for r in caplog.records] == ["switch.json unreadable"]
@@ -0,0 +1,34 @@
+import sys
+
+import pytest
+
+import locations
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch, fake_pycountry, fake_geonamescache):
+    monkeypatch.setitem(sys.modules, "pycountry", fake_pycountry)
+    monkeypatch.setitem(sys.modules, "geonamescache", fake_geonamescache)
+    directory = str(tmp_path / "location_catalog")
+    locations.build_catalog(directory)
+    return locations.LocationCatalog(directory)
+
+
+def test_search_cities_by_prefix(catalog):
+    assert catalog.search_cities("United States", "spr") == ["Springfield"]  # One name across three states
+    assert catalog.search_cities("United States", "S", subdivision="Massachusetts") == ["Salem", "Springfield"]
+    assert catalog.search_cities("United States", "sa", subdivision="Massachusetts") == ["Salem"]
+    assert catalog.search_cities("United States", "  SPRÍNG") == ["Springfield"]  # Case and accents ignored
+    assert catalog.search_cities("United States", "", limit=2) == ["Atlantis", "Boston"]
+    assert catalog.search_cities("United States", "S", limit=1) == ["Salem"]
+    assert catalog.search_cities("United States", "x") == []
+    assert catalog.search_cities("Narnia", "s") == []
+
+
+def test_cities_fall_back_to_the_whole_country(catalog):
+    assert catalog.cities("United States", "Illinois") == ["Springfield"]
+    # Missouri is not a listed subdivision here, so its city is only in the country-wide list
+    assert catalog.cities("United States", "Missouri") == ["Atlantis", "Boston", "Salem", "Springfield"]
+    assert catalog.subdivisions("United States") == ("Illinois", "Massachusetts")
+    assert catalog.country_code("Korea, Republic of") == "KR"
+    assert catalog.stats() == {"countries": 5, "loaded": 1}  # Only the country that was asked about
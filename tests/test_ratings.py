@@ -0,0 +1,65 @@
+import pytest
+
+import enroll_schedule
+import models
+import storage
+
+SCHEDULE = {
+    "Open Enrollment Date": "2026-01-05 08:00",
+    "Close Enrollment Date": "2026-01-06 08:00",
+    "Open Ratings Date": "2026-01-07 08:00",
+    "Close Ratings Date": "2026-01-08 08:00",
+    "Open Enrollment Delay": "2 days, 0:00:00",
+    "rating": False, "all_hidden": False, "all_closed": True,
+}
+
+
+def at(text):
+    return enroll_schedule.parse_instant(text)
+
+
+def test_submit_rating_end_to_end(backend, paths):
+    backend.save(paths[storage.SWITCH], SCHEDULE)
+    backend.update_records(paths[storage.TEACHERS], {"t1": {"name": "Ms. Li"}})
+    backend.update_records(paths[storage.STUDENTS], {"s1": {"name": "Ann", "timezone": "Asia/Shanghai"}})
+
+    period = models.submit_rating(backend, "t1", "s1", 4, "Great", now=at("2026-01-07 12:00"))
+    assert period == "2026-01-07 08:00-2026-01-08 08:00"
+    assert backend.ratings_for_student("s1") == {"t1": {period: {"stars": 4, "feedback": "Great"}}}
+
+    # Rating again in the same window replaces the entry
+    models.submit_rating(backend, "t1", "s1", "5", None, now=at("2026-01-07 13:00"))
+    backend.close()
+    reopened = storage.JsonFileBackend(paths)  # Replayed from the journal on disk
+    try:
+        assert reopened.ratings_for_teacher("t1") == {"s1": {period: {"stars": 5, "feedback": ""}}}
+    finally:
+        reopened.close()
+
+
+def test_rating_period_follows_the_recurring_schedule(backend, paths):
+    backend.save(paths[storage.SWITCH], SCHEDULE)
+    assert enroll_schedule.rating_period(backend, at("2026-01-07 08:00")) == "2026-01-07 08:00-2026-01-08 08:00"
+    assert enroll_schedule.rating_period(backend, at("2026-01-08 08:00")) is None  # Closed; the gap runs
+    # The cycle repeats every 5 days (close ratings + delay - open enrollment)
+    assert enroll_schedule.rating_period(backend, at("2026-01-12 09:00")) == "2026-01-12 08:00-2026-01-13 08:00"
+
+
+def test_submit_rating_before_any_window_is_rejected(backend, paths):
+    backend.save(paths[storage.SWITCH], SCHEDULE)
+    with pytest.raises(ValueError):
+        models.submit_rating(backend, "t1", "s1", 3, "", now=at("2026-01-05 09:00"))
+    assert backend.ratings_for_student("s1") == {}
+
+
+def test_ratings_enabled_by_hand_outside_the_schedule(backend, paths):
+    # No schedule saved: the admin's "Enable Rating for All" alone opens ratings
+    backend.save(paths[storage.SWITCH], {"rating": True, enroll_schedule.MANUAL_RATINGS_KEY: "2026-02-01 10:00"})
+    assert models.submit_rating(backend, "t1", "s1", 4, "", now=at("2026-02-02 09:00")) == "manual 2026-02-01 10:00"
+
+    # Between scheduled windows as well; inside one the window's key wins
+    backend.save(paths[storage.SWITCH], {**SCHEDULE, "rating": True, enroll_schedule.MANUAL_RATINGS_KEY: "2026-01-09 10:00"})
+    assert models.submit_rating(backend, "t1", "s1", 5, "", now=at("2026-01-09 11:00")) == "manual 2026-01-09 10:00"
+    assert enroll_schedule.rating_period(backend, at("2026-01-12 09:00")) == "2026-01-12 08:00-2026-01-13 08:00"
+    assert backend.ratings_for_student("s1") == {"t1": {"manual 2026-02-01 10:00": {"stars": 4, "feedback": ""},
+                                                        "manual 2026-01-09 10:00": {"stars": 5, "feedback": ""}}}
@@ -0,0 +1,54 @@
+import threading
+
+import models
+import storage
+
+
+def test_update_and_delete_records(backend, paths):
+    teachers = paths[storage.TEACHERS]
+    backend.update_records(teachers, {"t1": {"name": "A", "grade": "3"}})
+    backend.update_records(teachers, {"t1": {"grade": "4"}, "t2": {"name": "B"}})
+    backend.delete_records(teachers, ["t2"])
+    assert backend.load(teachers) == {"t1": {"name": "A", "grade": "4"}}
+
+
+def test_registrations_while_other_sessions_iterate(backend, paths):
+    students, teachers = paths[storage.STUDENTS], paths[storage.TEACHERS]
+    backend.update_records(teachers, {"t0": {"name": "T0", "id": "t0"}})
+    done = threading.Event()
+
+    def register():
+        for i in range(2000):
+            backend.update_records(students, {f"s{i}": {"name": f"S{i}"}})
+            backend.update_records(teachers, {f"t{i}": {"name": f"T{i}", "id": f"t{i}"}})
+        done.set()
+
+    writer = threading.Thread(target=register)
+    writer.start()
+    view = models.get_view(backend, students, models.Student)
+    seen = 0
+    while not done.is_set():  # Raised "dictionary changed size during iteration" before copy-on-write
+        seen = max(seen, sum(1 for _ in backend.load(students).items()))
+        assert any(details.get("id") == "t0" for details in backend.load(teachers).values())
+        view.get()
+    writer.join()
+    assert len(backend.load(students)) == 2000
+    assert len(view.get()) == 2000
+
+
+def test_migrate_normalizes_records_and_unlayers_switches(backend, paths):
+    backend.save(paths[storage.SWITCH], {"rating": False, "all_hidden": False, "all_closed": True})
+    backend.save(paths[storage.TEACHERS], {"t1": {"name": "A", "enrollment_cap": "0", "rating": "None",
+                                                  "allow_enroll": False}})
+    backend.save(paths[storage.STUDENTS], {"s1": "Ann"})
+    backend.save(paths[storage.RATINGS], {"t1": {"s1": {"p": {"stars": "4", "feedback": None}}}})
+
+    assert models.migrate(backend) == {storage.TEACHERS: 1, storage.STUDENTS: 1, storage.RATINGS: 1,
+                                       "teacher flags": 1}
+    teacher = backend.load(paths[storage.TEACHERS])["t1"]
+    assert (teacher["enrollment_cap"], teacher["rating"], teacher["allow_enroll"]) == (None, None, True)
+    assert backend.load(paths[storage.STUDENTS])["s1"]["name"] == "Ann"
+    assert backend.load(paths[storage.RATINGS]) == {"t1": {"s1": {"p": {"stars": 4, "feedback": ""}}}}
+    switch = models.load_switch(backend)
+    assert (switch.schema_version, switch.all_closed) == (models.SCHEMA_VERSION, True)
+    assert models.migrate(backend) == {}  # Recorded in switch.json: runs once
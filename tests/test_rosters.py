@@ -0,0 +1,63 @@
+import sys
+import threading
+
+import storage
+
+
+def test_roster_is_an_ordered_set():
+    roster = storage.Roster(["a", "b", "a"])
+    assert roster == ["a", "b"]
+    assert roster.update(["b", "c", "d"]) == 2
+    assert roster.difference_update(["a", "x"]) == 1
+    assert roster.to_list() == ["b", "c", "d"]
+
+
+def test_enroll_and_cancel_do_not_change_loaded_rosters(backend, paths):
+    backend.enroll_many([("t1", "s1"), ("t1", "s2")])
+    before = backend.load(paths[storage.ENROLLMENTS])
+    roster = before["t1"]
+    backend.enroll("t1", "s3")
+    backend.cancel_many([("t1", "s1"), ("t1", "s2")])
+    assert roster == ["s1", "s2"]
+    assert before == {"t1": ["s1", "s2"]}
+    assert backend.load(paths[storage.ENROLLMENTS]) == {"t1": ["s3"]}
+    assert backend.teachers_for_student("s3") == {"t1"}
+    assert backend.teachers_for_student("s1") == set()
+
+
+def test_clicks_while_other_sessions_iterate_rosters(backend, paths):
+    enrollments = paths[storage.ENROLLMENTS]
+    backend.enroll_many([("t1", f"s{i}") for i in range(100)])
+    done = threading.Event()
+
+    def click():
+        for i in range(100, 3000):
+            backend.enroll("t1", f"s{i}")
+            backend.cancel("t1", f"s{i - 100}")
+            backend.enroll(f"t{i % 7 + 2}", f"s{i}")
+        done.set()
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # Switch threads often enough to hit the race
+    try:
+        writer = threading.Thread(target=click)
+        writer.start()
+        while not done.is_set():  # Raised "dictionary changed size during iteration" before rosters were copied
+            for teacher_id, roster in backend.load(enrollments).items():
+                assert len(list(roster)) == len(roster)
+            backend.teachers_for_student("s50")
+        writer.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert len(backend.load(enrollments)["t1"]) == 100
+
+
+def test_append_after_outside_snapshot_change_rebuilds_index(backend, paths):
+    enrollments = paths[storage.ENROLLMENTS]
+    backend.enroll("t1", "s1")
+    assert backend.teachers_for_student("s1") == {"t1"}
+    with open(enrollments, "w") as f:  # Another tool rewrites the snapshot behind the backend's back
+        f.write('{"t9": ["s1", "s2"]}')
+    backend.enroll("t2", "s2")  # The append's load() replays the new snapshot
+    assert backend.teachers_for_student("s1") == {"t1", "t9"}
+    assert backend.teachers_for_student("s2") == {"t2", "t9"}
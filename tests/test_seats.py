@@ -0,0 +1,74 @@
+import threading
+import time
+
+import seats
+import storage
+
+
+class SlowEnrollBackend(storage.JsonFileBackend):
+    """Widens the window between a won CAS and the seat reaching the database."""
+
+    def enroll(self, teacher_id, student_id):
+        time.sleep(0.005)
+        super().enroll(teacher_id, student_id)
+
+
+def run_concurrently(count, target):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def worker(i):
+        barrier.wait()
+        results[i] = target(i)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_exactly_cap_seats_are_granted(backend, paths):
+    inventory = seats.SeatInventory(backend, paths[storage.ENROLLMENTS], max_retries=10000)
+    outcomes = run_concurrently(50, lambda i: inventory.reserve("t1", f"s{i}", 7))
+    assert outcomes.count(seats.GRANTED) == 7
+    assert outcomes.count(seats.FULL) == 43
+    assert len(backend.load(paths[storage.ENROLLMENTS])["t1"]) == 7
+    assert inventory.reserve("t1", "s0", 7) in (seats.ALREADY_ENROLLED, seats.FULL)
+
+
+def test_exactly_cap_seats_are_granted_across_resets(paths):
+    backend = SlowEnrollBackend(paths)
+    enrollments = paths[storage.ENROLLMENTS]
+    teachers = [f"t{i}" for i in range(5)]
+    backend.enroll_many([(t, "s-existing") for t in teachers])
+    inventory = seats.SeatInventory(backend, enrollments, max_retries=10000)
+    stop = threading.Event()
+
+    def keep_resetting():
+        while not stop.is_set():
+            inventory.reset()
+            inventory.reset(lambda: backend.save(enrollments, backend.load(enrollments)))  # Admin-style rewrite
+
+    resetter = threading.Thread(target=keep_resetting)
+    resetter.start()
+    try:
+        for teacher_id in teachers:
+            outcomes = run_concurrently(40, lambda i: inventory.reserve(teacher_id, f"s{i}", 5))
+            assert outcomes.count(seats.GRANTED) == 4  # One seat was already taken
+    finally:
+        stop.set()
+        resetter.join()
+    assert all(len(roster) == 5 for roster in backend.load(enrollments).values())
+    backend.close()
+
+
+def test_release_frees_a_seat(backend, paths):
+    inventory = seats.SeatInventory(backend, paths[storage.ENROLLMENTS])
+    assert inventory.reserve("t1", "a", 1) == seats.GRANTED
+    assert inventory.reserve("t1", "b", 1) == seats.FULL
+    assert inventory.release("t1", "a")
+    assert not inventory.release("t1", "a")
+    assert inventory.reserve("t1", "b", 1) == seats.GRANTED
+    assert backend.load(paths[storage.ENROLLMENTS]) == {"t1": ["b"]}
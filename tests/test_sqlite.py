@@ -0,0 +1,50 @@
+import models
+import storage
+
+
+def make(tmp_path, paths):
+    return storage.SqliteBackend(str(tmp_path / "enroll.sqlite3"), paths)
+
+
+def test_version_changes_only_with_its_collection(tmp_path, paths):
+    backend = make(tmp_path, paths)
+    teachers, enrollments, ratings = paths[storage.TEACHERS], paths[storage.ENROLLMENTS], paths[storage.RATINGS]
+    versions = {path: backend.version(path) for path in paths.values()}
+    assert backend.version(teachers) == versions[teachers]  # Stable without writes
+
+    backend.update_records(teachers, {"t1": {"name": "A"}})
+    assert backend.version(teachers) != versions[teachers]
+    assert backend.version(enrollments) == versions[enrollments]
+
+    for write in (lambda: backend.enroll("t1", "s1"), lambda: backend.cancel("t1", "s1"),
+                  lambda: backend.save(enrollments, {"t1": ["s2"]})):
+        before = backend.version(enrollments)
+        write()
+        assert backend.version(enrollments) != before
+    before = backend.version(ratings)
+    backend.append_rating("t1", "s2", "p", {"stars": 5, "feedback": ""})
+    assert backend.version(ratings) != before
+    assert backend.version(str(tmp_path / "unknown.json")) is None
+    backend.close()
+
+
+def test_version_sees_other_connections(tmp_path, paths):
+    reader, writer = make(tmp_path, paths), make(tmp_path, paths)
+    teachers = paths[storage.TEACHERS]
+    before = reader.version(teachers)
+    writer.delete_records(teachers, ["nobody"])
+    assert reader.version(teachers) != before
+    reader.close()
+    writer.close()
+
+
+def test_typed_view_is_reused_until_a_write(tmp_path, paths):
+    backend = make(tmp_path, paths)
+    teachers = paths[storage.TEACHERS]
+    backend.update_records(teachers, {"t1": {"name": "A"}})
+    view = models.TypedView(backend, teachers, models.Teacher)
+    first = view.get()
+    assert view.get() is first
+    backend.update_records(teachers, {"t1": {"name": "B"}})
+    assert view.get()["t1"].name == "B"
+    backend.close()